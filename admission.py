@@ -0,0 +1,158 @@
+import time
+import socket
+import threading
+
+"""
+Admission control for logins. Every new connection spends a token from its
+address's bucket, every password attempt one from the username's, and only
+so many logins may be in progress at once. Failed passwords put the address
+and the username into an exponential backoff.
+
+All of this is decided from a few dict lookups before a profile is opened or
+a password hashed, so reconnect storms and guessing bots are cheap to turn
+away. A login that has not finished within LOGIN_TIMEOUT is dropped, so a
+client that connects and then sits idle or trickles its input cannot keep
+a slot.
+"""
+
+# New connections allowed per address: a burst, then one every 1/rate seconds
+ADDRESS_BURST = 10
+ADDRESS_RATE = 0.5
+
+# Password attempts allowed per username
+USERNAME_BURST = 5
+USERNAME_RATE = 0.2
+
+# Logins in progress at once, across every address
+MAX_LOGINS = 20
+
+# Seconds a connection has to finish logging in
+LOGIN_TIMEOUT = 60.0
+
+# Backoff after the first failure, doubling with each one after, up to the max
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 300.0
+
+# Backoffs no longer than this are waited out on the connection, longer
+# ones disconnect
+BACKOFF_INLINE = 8.0
+
+# Forget idle buckets and old failures once a table grows this large
+PRUNE_SIZE = 10000
+
+
+class TokenBucket(object):
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, now):
+        self.refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def full(self, now):
+        self.refill(now)
+        return self.tokens >= self.burst
+
+
+class Gate(object):
+
+    __slots__ = ("lock", "addresses", "usernames", "failures", "inflight")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.addresses = {}
+        self.usernames = {}
+        # key -> [failures in a row, time the backoff ends]
+        self.failures = {}
+        self.inflight = 0
+
+    def _bucket(self, table, key, rate, burst, now):
+        if key not in table:
+            if len(table) >= PRUNE_SIZE:
+                for stale in [k for k in table if table[k].full(now)]:
+                    del table[stale]
+            table[key] = TokenBucket(rate, burst, now)
+        return table[key]
+
+    def _backoff(self, key, now):
+        """Seconds left on a key's backoff"""
+        if key not in self.failures:
+            return 0
+        return max(0, self.failures[key][1] - now)
+
+    def connect(self, address):
+        """
+        Admit a new connection, or return why not. Admitted connections hold
+        a login slot until release is called.
+        """
+        now = time.time()
+        with self.lock:
+            if self.inflight >= MAX_LOGINS:
+                return "The server is busy with other logins. Try again shortly."
+            if self._backoff(("address", address), now) > BACKOFF_INLINE:
+                return "Too many failed logins from your address. Try again later."
+            if not self._bucket(self.addresses, address, ADDRESS_RATE, ADDRESS_BURST, now).take(now):
+                return "Too many connections from your address. Try again later."
+            self.inflight += 1
+        return None
+
+    def release(self):
+        with self.lock:
+            self.inflight = max(0, self.inflight - 1)
+
+    def attempt(self, address, username):
+        """Allow a password attempt, or return why not"""
+        now = time.time()
+        with self.lock:
+            if not self._bucket(self.usernames, username.lower(), USERNAME_RATE, USERNAME_BURST, now).take(now):
+                return "Too many login attempts for " + username + ". Try again later."
+            wait = max(self._backoff(("address", address), now), self._backoff(("username", username.lower()), now))
+        if wait > BACKOFF_INLINE:
+            return "Too many failed logins. Try again in " + str(int(wait) + 1) + " seconds."
+        time.sleep(wait)
+        return None
+
+    def failed(self, address, username):
+        now = time.time()
+        with self.lock:
+            if len(self.failures) >= PRUNE_SIZE:
+                for stale in [k for k in self.failures if self.failures[k][1] + BACKOFF_MAX < now]:
+                    del self.failures[stale]
+            for key in (("address", address), ("username", username.lower())):
+                count = self.failures.get(key, [0, 0])[0] + 1
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (count - 1))
+                self.failures[key] = [count, now + delay]
+
+    def succeeded(self, address, username):
+        with self.lock:
+            self.failures.pop(("address", address), None)
+            self.failures.pop(("username", username.lower()), None)
+
+
+def receive(sock, deadline):
+    """
+    Read from a connection that is still logging in. Raises socket.timeout
+    once the deadline, a time.time() value, has passed.
+    """
+    left = deadline - time.time()
+    if left <= 0:
+        raise socket.timeout("login timed out")
+    sock.settimeout(left)
+    return sock.recv(4096)
+
+
+# Shared by every listener in this process
+gate = Gate()
@@ -0,0 +1,166 @@
+import os
+import json
+import uuid
+import threading
+
+import inventory
+
+"""
+Warm restarts. A Checkpointer periodically writes the parts of the session
+that never reach a profile, the rooms and their scenes, the brushes, the
+initiative tracker, the party's shared tallies and bags and every player's
+unsaved tallies and bags, to a single file. On startup, restore rebuilds
+the rooms and tracker from it, and holds each player's share until they log
+back in and reclaim it.
+
+Capturing, encoding and writing all happen on the Checkpointer's own thread,
+and an unchanged session is not rewritten. Capture takes no lock, so it
+never holds up the Dispatcher: it copies dicts and lists while commands may
+be changing them. A checkpoint taken mid-command can be a moment out of
+step, and one that trips over a dict changing size is given up; either
+way, the next checkpoint catches up.
+"""
+
+CHECKPOINT_PATH = "./session.checkpoint"
+
+# Seconds between checkpoints
+CHECKPOINT_INTERVAL = 10.0
+
+# name.lower() -> {"tallies", "bags", "brush", "location"} from the last
+# checkpoint, for players who have not logged back in yet
+held = {}
+
+
+def capture(session):
+    """Copy what needs saving out of the session, without encoding anything"""
+    rooms = []
+    for r in session.rooms.values():
+        rooms.append(r.snapshot())
+
+    players = dict(held)
+    lingering = [entry[0] for entry in session.lingering.values()]
+    for e in session.connections.values() + lingering:
+        tallies = {}
+        for key, value in e.tallies.items():
+            if key not in e.tallies_persist:
+                tallies[key] = value
+        bags = {}
+        # bags nobody has opened since login hold nothing unsaved
+        if e.isLoaded("bags"):
+            for key, value in e.bags.items():
+                if key not in e.bags_persist:
+                    bags[key] = value.serialize()
+        players[e.name.lower()] = {"tallies": tallies, "bags": bags,
+                                   "brush": session.stage.brushes.get(e),
+                                   "location": session.locate(e).name}
+
+    return {"rooms": rooms, "lobby": session.lobby.name,
+            "tracker": session.tracker.snapshot(), "party": session.party.snapshot(),
+            "players": players}
+
+
+def write(encoded, path=CHECKPOINT_PATH):
+    """Write an encoded state over the last checkpoint in one rename"""
+    temp = path + ".tmp." + uuid.uuid4().hex
+    f = open(temp, "w")
+    f.write(encoded)
+    f.close()
+    if os.name == "nt" and os.path.exists(path):
+        # Windows will not rename over an existing file
+        os.remove(path)
+    os.rename(temp, path)
+
+
+def restore(session, path=CHECKPOINT_PATH):
+    """Rebuild rooms, scenes and the tracker from the last checkpoint"""
+    if not os.path.exists(path):
+        return False
+    f = open(path)
+    try:
+        state = json.loads(f.read())
+    except ValueError:
+        print "Server: The session checkpoint is unreadable, starting fresh."
+        return False
+    finally:
+        f.close()
+
+    for layout in state["rooms"]:
+        target = session.createRoom(layout["name"])
+        scene = layout["stage"]
+        target.stage.title = scene["title"]
+        target.stage.body = scene["body"]
+        target.stage.objects = dict(scene["objects"])
+    for layout in state["rooms"]:
+        target = session.getRoom(layout["name"])
+        for key in layout["exits"]:
+            other = session.getRoom(key)
+            if other is not None:
+                session.linkRooms(target, other)
+
+    session.tracker.queue = [tuple(entry) for entry in state["tracker"]["queue"]]
+    session.tracker.order = list(state["tracker"]["order"])
+    if "party" in state:
+        session.party.load(state["party"])
+
+    held.clear()
+    held.update(state["players"])
+    return True
+
+
+def reclaim(session, e):
+    """
+    Give a player back what they had when the last checkpoint was taken.
+    Call before session.add, so they land in the room they left from.
+    """
+    state = held.pop(e.name.lower(), None)
+    if state is None:
+        return
+    for key, value in state["tallies"].items():
+        if key not in e.tallies:
+            e.tallies[key] = value
+    for key, value in state["bags"].items():
+        if key not in e.bags:
+            e.bags[key] = inventory.load(value)
+    e.markDirty("tallies", "bags")
+    if state["brush"] is not None:
+        session.stage.setBrush(e, state["brush"])
+    if state["location"] is not None:
+        e.location = session.getRoom(state["location"])
+
+
+class Checkpointer(threading.Thread):
+
+    __slots__ = ("session", "path", "interval", "running", "wakeup", "last")
+
+    def __init__(self, session, path=CHECKPOINT_PATH, interval=CHECKPOINT_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.session = session
+        self.path = path
+        self.interval = interval
+        self.running = True
+        self.wakeup = threading.Event()
+        # the last encoded state, so an idle session is not rewritten
+        self.last = None
+
+    def checkpoint(self):
+        encoded = json.dumps(capture(self.session), sort_keys=True)
+        if encoded == self.last:
+            return
+        write(encoded, self.path)
+        self.last = encoded
+
+    def kill(self):
+        self.running = False
+        self.wakeup.set()
+        self.checkpoint()
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(self.interval)
+            if not self.running:
+                break
+            try:
+                self.checkpoint()
+            except:
+                print "Server: Exception thrown while checkpointing the session."
@@ -3,6 +3,7 @@ import traceback
 import namedtuple
 import commands
 import functionmapper
+import sessionlog
 
 
 CommandArgs = namedtuple.namedtuple('CommandArgs', 'name tokens full actor')
@@ -22,11 +23,13 @@ class CommandParser(object):
     __metaclass__ = Singleton
     __slots__ = ("queue", "dispatcher", "parsing", "event")
 
-    def __init__(self):
-        print "  CommandParser: Creating and launching the Dispatcher"
+    def __init__(self, dispatcher=None):
         self.queue = []
-        self.dispatcher = Dispatcher()
-        self.dispatcher.start()
+        if dispatcher is None:
+            print "  CommandParser: Creating and launching the Dispatcher"
+            dispatcher = Dispatcher()
+            dispatcher.start()
+        self.dispatcher = dispatcher
 
     def parseLine(self, line, entity):
         line = line.strip()
@@ -40,10 +43,19 @@ class CommandParser(object):
             newargs = CommandArgs(name=tokens[0], tokens=tokens, full=line, actor=args.actor.mask)
             args = newargs
 
-        # This is for input blocking
+        # This is for input blocking: hold off reading until the command has
+        # had the chance to put the connection in an input mode
         if (args.name in functionmapper.commandFunctions and 
             functionmapper.commandFunctions[args.name] in commands.INPUT_BLOCK):
-            entity.proxy.bypass = True
+            entity.proxy.ready.clear()
+
+        # Commands issued by other commands (masks) are not new input, but
+        # part of the command that issued them
+        if sessionlog.recorder is not None:
+            if threading.current_thread() is not self.dispatcher:
+                sessionlog.recorder.accept(args, entity, line)
+            else:
+                sessionlog.recorder.spawned(self.dispatcher.current, args)
 
         self.dispatcher.enqueueCommand(args)
         self.dispatcher.notify()
@@ -54,13 +66,15 @@ class CommandParser(object):
 
 class Dispatcher(threading.Thread):
 
-    __slots__ = ("queue", "lock", "dispatching")
+    __slots__ = ("queue", "lock", "dispatching", "current")
 
     def __init__(self):
         super(Dispatcher, self).__init__()
         self.lock = threading.Event()
         self.dispatching = False
         self.queue = []
+        # the command being executed, as it was queued
+        self.current = None
 
     def enqueueCommand(self, args):
         self.queue.append(args)
@@ -68,6 +82,23 @@ class Dispatcher(threading.Thread):
     def notify(self):
         self.lock.set()
 
+    def defer(self, function, *arguments):
+        """Have the Dispatcher's thread call a function, between commands"""
+        self.enqueueCommand((function, arguments))
+        self.notify()
+
+    def dispatch(self, item):
+        """Run one thing taken off the queue, a command or a deferred call"""
+        if isinstance(item, CommandArgs):
+            self.execute(item)
+            return
+        function, arguments = item
+        try:
+            function(*arguments)
+        except:
+            print "Server: An error has occured in a deferred call."
+            print traceback.format_exc()
+
     def kill(self):
         self.dispatching = False
         self.lock.set()
@@ -83,37 +114,49 @@ class Dispatcher(threading.Thread):
                 break
             
             # get the next command in the queue and execute it
-            args = self.queue.pop()
-            args = functionmapper.shorthandHandler(args)
-            command = args.name
-
-            # handle the command if it exists
-            if command in functionmapper.commandFunctions:
-                try:
-                    ret = functionmapper.commandFunctions[command](args)  # this calls the function
-                    if not ret:
-                        args.actor.sendMessage("What?")
-                except:
-                    print "Server: An error has occured."
-                    print "-----------------------------"
-                    print traceback.format_exc()
-            # check to see if it's an alias
-            elif command in args.actor.aliases:
-                new_line = args.actor.aliases[command].strip()
-                new_tokens = new_line.split(" ")
-                new_args = CommandArgs(name=new_tokens[0], tokens=new_tokens, full=new_line, actor=args.actor)
-                self.queue.append(new_args)
-                self.lock.set()
-            # check spectator
-            elif (args.actor.spectator and 
-                    args.name not in commands.commandFunctions and 
-                    functionmapper.commandFunctions[args.name] not in commands.SPECTATORABLE):
-                args.actor.sendMessage("Only actual players can use that command. Check help spectator for more info.")
-            else:
-                args.actor.sendMessage("What?")
+            self.dispatch(self.queue.pop())
 
             # if that was the last command, set the block again
             if len(self.queue) == 0:
                 self.lock.clear()
 
         print "    Dispatcher: Done."
+
+    def execute(self, args):
+        accepted = args
+        self.current = accepted
+        args = functionmapper.shorthandHandler(args)
+        command = args.name
+
+        # handle the command if it exists
+        if command in functionmapper.commandFunctions:
+            try:
+                ret = functionmapper.commandFunctions[command](args)  # this calls the function
+                if not ret:
+                    args.actor.sendMessage("What?")
+            except:
+                print "Server: An error has occured."
+                print "-----------------------------"
+                print traceback.format_exc()
+            if functionmapper.commandFunctions[command] in commands.INPUT_BLOCK and args.actor.proxy is not None:
+                args.actor.proxy.ready.set()
+        # check to see if it's an alias
+        elif command in args.actor.aliases:
+            new_line = args.actor.aliases[command].strip()
+            new_tokens = new_line.split(" ")
+            new_args = CommandArgs(name=new_tokens[0], tokens=new_tokens, full=new_line, actor=args.actor)
+            if sessionlog.recorder is not None:
+                sessionlog.recorder.spawned(accepted, new_args)
+            self.enqueueCommand(new_args)
+            self.notify()
+        # check spectator
+        elif (args.actor.spectator and 
+                args.name not in commands.commandFunctions and 
+                functionmapper.commandFunctions[args.name] not in commands.SPECTATORABLE):
+            args.actor.sendMessage("Only actual players can use that command. Check help spectator for more info.")
+        else:
+            args.actor.sendMessage("What?")
+
+        self.current = None
+        if sessionlog.recorder is not None:
+            sessionlog.recorder.executed(accepted)
@@ -1,12 +1,16 @@
+import os
 import sys
-import inspect
-import urllib2
-import json
+import time
+import threading
 
 import namedtuple
 import persist
 import editor
 import dice
+import inventory
+import history as history_index
+import helpindex
+import docstore
 
 from mushyutils import swatch, colorfy, wrap
 
@@ -24,7 +28,7 @@ full - full input, untokenized
 actor - being object who used the command
 """
 
-# These functions need to be identified for the bypass flag
+# These functions need to be identified for the input mode handoff
 INPUT_BLOCK = set()
 MASKABLE = set()
 SPECTATORABLE = set()
@@ -102,7 +106,7 @@ def alias(args):
         if key in args.actor.aliases:
             del args.actor.aliases[key]
             args.actor.sendMessage('Alias "' + key + '" removed.')
-            persist.saveEntity(args.actor)
+            persist.queueSave(args.actor, "aliases")
         else:
             args.actor.sendMessage('Alias "' + key + '" does not exist.')
 
@@ -125,7 +129,7 @@ def alias(args):
         alias_cmd = args.full[len(args.tokens[0] + args.tokens[1]) + 2:]
         args.actor.aliases[key] = alias_cmd
         args.actor.sendMessage('Alias "' + key + '" added.')
-        persist.saveEntity(args.actor)
+        persist.queueSave(args.actor, "aliases")
 
     return True
 
@@ -141,6 +145,8 @@ def configure(args):
     Below are a list of configurable options:
         wrap <number>  - number of columns per line, 0 = unwrapped (default:)
         saywrap        - wraps say output, toggle (default: off)
+        rows <number>  - lines per page of long output, 0 = no paging
+                         (default: 40)
     """
     if len(args.tokens) < 2:
         return False
@@ -156,6 +162,15 @@ def configure(args):
             args.actor.sendMessage("Lines will now wrap at " + args.tokens[2] + " characters.")
         except Exception:
             args.actor.sendMessage("Value must be a number (0 for unwrapped).")
+    elif setting == "rows":
+        try:
+            if len(args.tokens) < 3:
+                args.actor.sendMessage("Usage: configure rows <number>")
+                return True
+            args.actor.settings["rows"] = int(args.tokens[2])
+            args.actor.sendMessage("Long output will now page every " + args.tokens[2] + " lines.")
+        except Exception:
+            args.actor.sendMessage("Value must be a number (0 for no paging).")
     elif setting == "saywrap":
         args.actor.settings["saywrap"] = not args.actor.settings["saywrap"]
         if args.actor.settings["saywrap"]:
@@ -165,7 +180,7 @@ def configure(args):
     else:
         args.actor.sendMessage("That is not a valid setting. Check help settings for more details.")
 
-    persist.saveEntity(args.actor)
+    persist.queueSave(args.actor, "settings")
     return True
 
 
@@ -229,7 +244,7 @@ def language(args):
         e.languages.append(language)
         args.actor.sendMessage(target + " now understands the language: " + colorfy(language, "green"))
         e.sendMessage("You have learned the language: " + colorfy(language, "green"))
-        persist.saveEntity(e)
+        persist.queueSave(e, "languages")
 
     elif subcommand in ('forget', 'unregister') and target in args.actor.session:
         e = args.actor.session.getEntity(target)
@@ -254,61 +269,59 @@ def help(args):
     syntax: help <subject>
             subject - the subject or command which you want to check for help
 
-    Known bug: Doesn't always play nice with column wrapping.
+            help search <words>
+            words - find the commands whose help mentions all of these
     """
     # This would normally be circular, but this is an exceptional case
     import functionmapper
 
-    # generate the docstring mapping first
-    docs = {}
-    functions = inspect.getmembers(sys.modules[__name__], inspect.isfunction)
-    for functionName, function in functions:
-        docs[functionName] = function.__doc__
+    index = helpindex.index
+    if index is None:
+        index = helpindex.build(sys.modules[__name__], functionmapper.commandFunctions)
 
     if len(args.tokens) == 1:
-        commands = functionmapper.commandFunctions.keys()
-        commands.sort()
-
-        msg = "    "
-        i = 0
-        for command in commands:
-            if command not in docs or docs[command] is None:
-                continue
-            msg = msg + command + (' ' * (15 - len(command)))
-            i = (i + 1) % 4
-            if i == 0:
-                msg = msg + "\n    "
-
         args.actor.sendMessage("There are help files on the following commands.\nType help <command> for details.")
-        args.actor.sendMessage(msg)
-
+        args.actor.page(index.listing(args.actor.settings["cols"]))
         return True
 
-    docstring = None
-    if args.tokens[1] in docs:
-        docstring = docs[args.tokens[1]]
+    if args.tokens[1] == "search" and len(args.tokens) > 2:
+        results = index.search(" ".join(args.tokens[2:]))
+        if len(results) == 0:
+            args.actor.sendMessage("No help files mention " + " ".join(args.tokens[2:]) + ".")
+            return True
+        lines = ["    " + topic + (' ' * (helpindex.COLUMN - len(topic))) + summary for topic, summary in results]
+        args.actor.page("Help files that mention " + " ".join(args.tokens[2:]) + ":\n" + "\n".join(lines))
+        return True
 
-    if docstring is None:
+    page = index.page(args.tokens[1])
+    if page is None:
         args.actor.sendMessage("There is no helpfile for " + args.tokens[1] + ".")
     else:
-        prelude = "help file for: " + args.tokens[1] + "\n" + ("-" * len("help file for: " + args.tokens[1]))
-        prelude = colorfy(prelude, 'green')
-        args.actor.sendMessage(prelude + docstring)
+        args.actor.page(page)
 
     return True
 
 
-def _speak(args, second_tense, third_tense, speak_color):
+def _speak(args, second_tense, third_tense, speak_color, near=False):
     """
     Internal function used by say, whisper, and yell.
 
     second_tense - You say/whisper/yell
     third_tense - He says/whispers/yells
+    near - also reach the rooms next to the speaker's
     """
     if len(args.tokens) < 2:
         return False
 
     full = args.full
+    audience = args.actor.session.hearers(args.actor, near)
+
+    # Only someone who can hear you can be spoken to
+    def findTarget(name):
+        target = args.actor.session.getEntity(name)
+        if target is not None and target in audience:
+            return target
+        return None
 
     # Get rid of the "say" command token
     rest_tokens = args.tokens[1:]
@@ -331,14 +344,14 @@ def _speak(args, second_tense, third_tense, speak_color):
 
         # see if there's a target in here
         if len(rest_tokens) >= 3 and rest_tokens[0].lower() == 'to':
-            target_entity = args.actor.session.getEntity(rest_tokens[1])
+            target_entity = findTarget(rest_tokens[1])
             if target_entity is not None:
                 full = full[len(rest_tokens[0]) + len(rest_tokens[1]) + 2:]
                 rest_tokens = rest_tokens[2:]
 
     # CASE 2: Match on SAY TO
     elif len(rest_tokens) >= 3 and rest_tokens[0].lower() == 'to':
-        target_entity = args.actor.session.getEntity(rest_tokens[1])
+        target_entity = findTarget(rest_tokens[1])
 
         if target_entity is not None:
             full = full[len(rest_tokens[0]) + len(rest_tokens[1]) + 2:]
@@ -375,7 +388,7 @@ def _speak(args, second_tense, third_tense, speak_color):
 
     # Say stuff to a target
     if target_entity is not None:
-        for e in args.actor.session.getAllEntities():
+        for e in audience:
             # in a language
             if lang is not None:
                 if e == args.actor:
@@ -400,7 +413,7 @@ def _speak(args, second_tense, third_tense, speak_color):
                     sendMessage(e, colorfy(args.actor.name + ' ' + third_tense + ' to ' + target_entity.name + ', "' + full + '"', speak_color))
     # Say stuff to everyone
     else:
-        for e in args.actor.session.getAllEntities():
+        for e in audience:
             # in a language
             if lang is not None:
                 if e == args.actor:
@@ -416,6 +429,22 @@ def _speak(args, second_tense, third_tense, speak_color):
                 else:
                     sendMessage(e, colorfy(args.actor.name + ' ' + third_tense + ', "' + full + '"', speak_color))
 
+    # Publish what a spectator would have seen, and for speech in a language,
+    # what someone who doesn't know it heard instead
+    heard = args.actor.name + ' ' + third_tense
+    garbled = None
+    if target_entity is not None:
+        heard += ' to ' + target_entity.name
+    if lang is not None:
+        garbled = args.actor.name + ' ' + third_tense + ' something'
+        if target_entity is not None:
+            garbled += ' to ' + target_entity.name
+        garbled = colorfy(garbled + ' in ' + color_lang + '.', speak_color)
+        heard += ' in ' + color_lang
+    args.actor.session.publish("broadcast", text=colorfy(heard + ', "' + full + '"', speak_color), source=args.actor.name,
+                               rooms=args.actor.session.nearby(args.actor, near), language=lang, garbled=garbled,
+                               hearers=[e.name for e in audience])
+
     return True
 
 
@@ -423,7 +452,7 @@ def _speak(args, second_tense, third_tense, speak_color):
 def say(args):
     """
     Say something out loud, in character. Unless otherwise specified, things
-    are said in common.
+    are said in common. Only the people in your room will hear you.
 
     syntax: say [modifiers] <message>
 
@@ -464,7 +493,7 @@ def say(args):
 def whisper(args):
     """
     Works just like "say", just with whisper flavor. For more info,
-    check "help say".
+    check "help say". Like "say", only the people in your room hear it.
 
     syntax: whisper [modifiers] <message>
     """
@@ -475,11 +504,11 @@ def whisper(args):
 def yell(args):
     """
     Works just like "say", just with yell flavor. For more info,
-    check "help say".
+    check "help say". Yells carry into the rooms next to yours.
 
     syntax: yell [modifiers] <message>
     """
-    return _speak(args, 'yell', 'yells', 'byellow')
+    return _speak(args, 'yell', 'yells', 'byellow', near=True)
 
 
 def pm(args):
@@ -511,15 +540,18 @@ def who(args):
 
     syntax: who
     """
+    session = args.actor.session
     msg = colorfy("Currently connected players:\n", "cyan")
-    for e in args.actor.session.getAllEntities():
+    for e in session.getAllEntities():
         name = colorfy(e.name, "cyan")
         if e.dm:
             name = name + colorfy(" (DM)", "bright red")
         elif e.spectator:
             name = name + colorfy(" (S)", "bright yellow")
+        if len(session.rooms) > 1:
+            name = name + " - " + session.locate(e).name
         msg = msg + "    " + name + "\n"
-    args.actor.sendMessage(msg)
+    args.actor.page(msg)
     return True
 
 
@@ -532,7 +564,9 @@ def logout(args):
     """
     args.actor.sendMessage(colorfy("[SERVER] You have quit the session.", "bright yellow"))
     args.actor.session.broadcastExclude(colorfy("[SERVER] " + args.actor.name + " has quit the session.", "bright yellow"), args.actor)
-    persist.saveEntity(args.actor)
+    persist.flushEntity(args.actor)
+    # leaving on purpose, so there is nothing to resume
+    args.actor.session.revokeTokens(args.actor)
     try:
         args.actor.proxy.running = False
         args.actor.session.remove(args.actor)
@@ -546,6 +580,7 @@ def logout(args):
 def emote(args):
     """
     Perform an emote. Use the ";" or "*" token as a placeholder for your name.
+    Only the people in your room will see it.
 
     syntax: emote <description containing ; somewhere>
 
@@ -581,7 +616,8 @@ def emote(args):
     else:
         rest = rest.replace(';', args.actor.name)
 
-    args.actor.session.broadcast(colorfy(marking + rest, "dark gray"))
+    session = args.actor.session
+    session.broadcastRoom(session.locate(args.actor), colorfy(marking + rest, "dark gray"), source=args.actor.name)
     return True
 
 
@@ -614,7 +650,7 @@ def ooc(args):
     marking = colorfy(marking, "bright red")
 
     rest = args.full[len(args.name + " "):]
-    args.actor.session.broadcast(marking + rest)
+    args.actor.session.broadcast(marking + rest, source=args.actor.name)
 
     return True
 
@@ -697,7 +733,7 @@ def roll(args):
     msg = pre + msg + "    (total = " + colorfy(str(result), "yellow") + ")"
 
     if visible:
-        args.actor.session.broadcast(msg)
+        args.actor.session.broadcast(msg, source=args.actor.name)
     else:
         args.actor.sendMessage(msg)
         if args.tokens[0] == 'droll':
@@ -709,7 +745,7 @@ def roll(args):
 def fudge(args):
     result, out = dice.fudge()
     msg = args.actor.name + " rolls the dice: " + out + "    (total = " + result + ")"    
-    args.actor.session.broadcast(msg)
+    args.actor.session.broadcast(msg, source=args.actor.name)
     return True
 
 
@@ -757,6 +793,7 @@ def mask(args):
             huskname = args.tokens[1][0].upper() + args.tokens[1][1:]
             husk = entity.Entity(name=huskname, session=args.actor.session)
             husk.languages = args.actor.languages
+            husk.location = args.actor.location
             args.actor.mask = husk
             args.actor.sendMessage("You put on a " + colorfy(huskname, "green") + " mask.")
         return True
@@ -777,6 +814,7 @@ def mask(args):
 
     husk = entity.Entity(name=args.tokens[1][0].upper() + args.tokens[1][1:], session=args.actor.session)
     husk.languages = args.actor.languages
+    husk.location = args.actor.location
     commandparser.CommandParser().parseLine(new_full, husk)
     return True
 
@@ -978,7 +1016,7 @@ def colors(args):
 
 def paint(args):
     """
-    A DM may "paint" the current scene of the session for players to
+    A DM may "paint" the scene of the room they are in for players to
     view. Two things may be painted in a scene.
         "Scene" title - The name of the scene
         "Scene" body - The description of the scene
@@ -1002,17 +1040,19 @@ def paint(args):
         return False
 
     tokens = args.tokens
-    stage = args.actor.session.stage
-    color = stage.getBrush(args.actor)
+    session = args.actor.session
+    location = session.locate(args.actor)
+    stage = location.stage
+    color = session.stage.getBrush(args.actor)
     snip = len(tokens[0]) + len(tokens[1]) + 2
 
     if tokens[1] == "title":
         stage.paintSceneTitle(colorfy(args.full[snip:], color))
-        args.actor.session.broadcast(colorfy(args.actor.name + " gives the scene a name.", "bright red"))
+        session.broadcastRoom(location, colorfy(args.actor.name + " gives the scene a name.", "bright red"))
 
     elif tokens[1] == "body":
         stage.paintSceneBody(colorfy(args.full[snip:], color))
-        args.actor.session.broadcast(colorfy(args.actor.name + " paints the scene.", "bright red"))
+        session.broadcastRoom(location, colorfy(args.actor.name + " paints the scene.", "bright red"))
 
     else:
         return False
@@ -1044,19 +1084,22 @@ def sculpt(args):
     if not args.actor.dm:
         return False
 
+    session = args.actor.session
+    location = session.locate(args.actor)
+    stage = location.stage
+
     if args.tokens[1] == 'remove':
         tag = args.tokens[2]
-        if tag in args.actor.session.stage.objects:
-            args.actor.session.stage.eraseObject(tag)
+        if tag in stage.objects:
+            stage.eraseObject(tag)
         else:
             args.actor.sendMessage("There is no " + tag + " in the scene.")
 
     else:
-        stage = args.actor.session.stage
-        color = stage.getBrush(args.actor)
+        color = session.stage.getBrush(args.actor)
         snip = len(args.tokens[0]) + len(args.tokens[1]) + 2
         stage.paintObject(args.tokens[1], colorfy(args.full[snip:], color))
-        args.actor.session.broadcast(colorfy(args.actor.name + " sculpts an object into the scene.", "bright red"))
+        session.broadcastRoom(location, colorfy(args.actor.name + " sculpts an object into the scene.", "bright red"))
 
     return True
 
@@ -1096,17 +1139,18 @@ def brush(args):
 
 def wipe(args):
     """
-    A DM may wipe an entire scene and all objects painted in it.
+    A DM may wipe the entire scene of their room and all objects painted in it.
 
     syntax: wipe
     """
     if not args.actor.dm:
         return False
 
-    stage = args.actor.session.stage
-    stage.wipeScene()
-    stage.wipeObjects()
-    args.actor.session.broadcast(colorfy(args.actor.name + " wipes the whole scene.", "bright red"))
+    session = args.actor.session
+    location = session.locate(args.actor)
+    location.stage.wipeScene()
+    location.stage.wipeObjects()
+    session.broadcastRoom(location, colorfy(args.actor.name + " wipes the whole scene.", "bright red"))
 
     return True
 
@@ -1120,8 +1164,11 @@ def look(args):
             tag - the identifier to use when "looking" at an object
 
     To view a list of objects in the scene, simply use look without arguments.
+    You only see the scene of the room you are in.
     """
-    stage = args.actor.session.stage
+    session = args.actor.session
+    location = session.locate(args.actor)
+    stage = location.stage
 
     if len(args.tokens) == 1:
         scene = stage.viewScene()
@@ -1129,6 +1176,9 @@ def look(args):
             args.actor.sendMessage("The scene is blank.")
         else:
             args.actor.sendMessage(scene)
+        if len(location.exits) > 0:
+            exits = [session.rooms[key].name for key in sorted(location.exits) if key in session.rooms]
+            args.actor.sendMessage("Exits: " + colorfy(", ".join(exits), "green"))
         return True
 
     description = stage.viewObject(args.tokens[1])
@@ -1140,6 +1190,155 @@ def look(args):
     return True
 
 
+@spectatorable
+def go(args):
+    """
+    Move to another room. Players may only walk to a room connected to the
+    one they are in. The DM may go anywhere.
+
+    syntax: go <room>
+
+    Use "look" to see the exits of your room, and "rooms" for a list of
+    every room in the session.
+    """
+    if len(args.tokens) < 2:
+        return False
+
+    session = args.actor.session
+    here = session.locate(args.actor)
+    there = session.getRoom(args.tokens[1])
+
+    if there is None:
+        args.actor.sendMessage('There is no room called "' + args.tokens[1] + '".')
+        return True
+    elif there is here:
+        args.actor.sendMessage("You are already in " + here.name + ".")
+        return True
+    elif there.name.lower() not in here.exits and not args.actor.dm:
+        args.actor.sendMessage("You can't get to " + there.name + " from here.")
+        return True
+
+    _relocate(args.actor, there)
+    return True
+
+
+def _relocate(target, there):
+    """
+    Internal function used by go and room move. Tells both rooms about it.
+    """
+    session = target.session
+    here = session.locate(target)
+    session.broadcastRoom(here, colorfy(target.name + " leaves for " + there.name + ".", "dark gray"), exclude=target)
+    session.move(target, there)
+    session.broadcastRoom(there, colorfy(target.name + " arrives from " + here.name + ".", "dark gray"), exclude=target)
+    target.sendMessage("You go to " + colorfy(there.name, "green") + ".")
+    scene = there.stage.viewScene()
+    if scene != "":
+        target.sendMessage(scene)
+
+
+@spectatorable
+def rooms(args):
+    """
+    Lists the rooms in the session, how many people are in each, and where
+    they lead.
+
+    syntax: rooms
+    """
+    session = args.actor.session
+    here = session.locate(args.actor)
+    msg = colorfy("Rooms in this session:\n", "cyan")
+    for key in sorted(session.rooms):
+        r = session.rooms[key]
+        line = "    " + colorfy(r.name, "green") + " (" + str(len(r)) + ")"
+        if r is here:
+            line = line + colorfy("  <--- You are here", "bred")
+        if len(r.exits) > 0:
+            line = line + "\n        exits: " + ", ".join(session.rooms[k].name for k in sorted(r.exits) if k in session.rooms)
+        msg = msg + line + "\n"
+    args.actor.sendMessage(msg)
+    return True
+
+
+def room(args):
+    """
+    A DM may build rooms for players to move between. Every room has its own
+    scene and objects, painted from inside it. Speech stays within a room,
+    except for yells, which carry into connected rooms.
+
+    syntax: room <subcommand>
+
+    List of subcommands and syntax:
+        Create:         room create <name>
+        Destroy:        room destroy <name>
+        Link/Unlink:    room link/unlink <name> <name>
+        Move:           room move <player> <name>
+
+    Everyone begins in the Lobby, which cannot be destroyed. Players in a
+    destroyed room are sent back to the Lobby.
+    """
+    if not args.actor.dm:
+        return False
+
+    if len(args.tokens) < 3:
+        return False
+
+    session = args.actor.session
+    subcommand = args.tokens[1]
+
+    if subcommand == 'create':
+        if session.getRoom(args.tokens[2]) is not None:
+            args.actor.sendMessage("Room " + args.tokens[2] + " already exists.")
+        else:
+            new_room = session.createRoom(args.tokens[2][0].upper() + args.tokens[2][1:])
+            args.actor.sendMessage("Room " + colorfy(new_room.name, "green") + " created.")
+
+    elif subcommand == 'destroy':
+        target = session.getRoom(args.tokens[2])
+        if target is None:
+            args.actor.sendMessage("Room " + args.tokens[2] + " does not exist.")
+        elif not session.destroyRoom(target):
+            args.actor.sendMessage("The " + target.name + " cannot be destroyed.")
+        else:
+            args.actor.sendMessage("Room " + target.name + " destroyed.")
+
+    elif subcommand in ('link', 'unlink'):
+        if len(args.tokens) < 4:
+            args.actor.sendMessage("Usage: room " + subcommand + " <name> <name>")
+            return True
+        a = session.getRoom(args.tokens[2])
+        b = session.getRoom(args.tokens[3])
+        if a is None or b is None or a is b:
+            args.actor.sendMessage("You need two different rooms that exist.")
+        elif subcommand == 'link':
+            session.linkRooms(a, b)
+            args.actor.sendMessage("Linked " + a.name + " and " + b.name + ".")
+        else:
+            session.unlinkRooms(a, b)
+            args.actor.sendMessage("Unlinked " + a.name + " and " + b.name + ".")
+
+    elif subcommand == 'move':
+        if len(args.tokens) < 4:
+            args.actor.sendMessage("Usage: room move <player> <name>")
+            return True
+        if args.tokens[2] not in session:
+            args.actor.sendMessage("There is no person named " + args.tokens[2] + ".")
+            return True
+        target = session.connections[args.tokens[2].lower()]
+        there = session.getRoom(args.tokens[3])
+        if there is None:
+            args.actor.sendMessage("Room " + args.tokens[3] + " does not exist.")
+        else:
+            _relocate(target, there)
+            if target is not args.actor:
+                args.actor.sendMessage("Moved " + target.name + " to " + there.name + ".")
+
+    else:
+        return False
+
+    return True
+
+
 def tally(args):
     """
     A player or DM may create a generic "tally" to keep track of something.
@@ -1342,14 +1541,19 @@ def bag(args):
 
     List of subcommands and syntax:
 
-        Add/Remove:     bag add/remove <tag> <item>
+        Add/Remove:     bag add/remove <tag> <items>
         Check:          bag check [tag]
-        Create:         bag create <tag> [initial]
+        Create:         bag create <tag> [items]
         Empty:          bag empty <tag>
         Destroy:        bag destroy <tag>
         Share:          bag share <tag | all> [entity]
         Save/Unsave:    bag save/unsave <tag>
 
+    Items may be given a quantity, and several may be added or removed at
+    once:
+        bag add quiver 40 arrows
+        bag add pack 2 torches rope 10 rations
+        bag remove quiver 3 arrows
 
 
     You may also check the contents for all your bags by simply entering
@@ -1381,7 +1585,9 @@ def bag(args):
         if tag in args.actor.bags:
             args.actor.sendMessage("Bag " + tag + " already exists.")
         else:
-            args.actor.bags[tag] = []
+            args.actor.bags[tag] = inventory.Bag()
+            for item, quantity in inventory.parseItems(tokens[3:]):
+                args.actor.bags[tag].add(item, quantity)
             args.actor.sendMessage("Bag " + tag + " created.")
 
     elif subcommand == 'destroy':
@@ -1392,31 +1598,40 @@ def bag(args):
             args.actor.sendMessage("Bag " + tag + " does not exist.")
 
     elif subcommand == 'add' or subcommand == 'put':
-        if len(tokens) < 4:
-            args.actor.sendMessage("Usage: bag add <tag> <item>")
+        items = inventory.parseItems(tokens[3:])
+        if len(items) == 0:
+            args.actor.sendMessage("Usage: bag add <tag> [quantity] <item> ...")
         elif tag in args.actor.bags:
-            item = tokens[3]
-            args.actor.bags[tag].append(item)
-            args.actor.sendMessage("Item " + item + " added to bag " + tag + ".")
+            added = inventory.Bag()
+            for item, quantity in items:
+                args.actor.bags[tag].add(item, quantity)
+                added.add(item, quantity)
+            args.actor.sendMessage("Added " + str(added) + " to bag " + tag + ".")
         else:
             args.actor.sendMessage("Bag " + tag + " does not exist.")
 
     elif subcommand == 'remove' or subcommand == 'take':
-        if len(tokens) < 4:
-            args.actor.sendMessage("Usage: bag remove <tag> <item>")
+        items = inventory.parseItems(tokens[3:])
+        if len(items) == 0:
+            args.actor.sendMessage("Usage: bag remove <tag> [quantity] <item> ...")
         elif tag in args.actor.bags:
-            item = tokens[3]
-            if item in args.actor.bags[tag]:
-                args.actor.bags.remove(item)
-                args.actor.sendMessage("Item " + item + " removed from bag " + tag + ".")
-            else:
-                args.actor.sendMessage("Bag " + tag + " does not contain item " + tokens[3] + ".")
+            removed = inventory.Bag()
+            missing = []
+            for item, quantity in items:
+                taken = args.actor.bags[tag].remove(item, quantity)
+                removed.add(item, taken)
+                if taken < quantity:
+                    missing.append(item)
+            if len(removed) > 0:
+                args.actor.sendMessage("Removed " + str(removed) + " from bag " + tag + ".")
+            if len(missing) > 0:
+                args.actor.sendMessage("Bag " + tag + " did not have enough " + ", ".join(missing) + ".")
         else:
             args.actor.sendMessage("Bag " + tag + " does not exist.")
 
     elif subcommand == 'empty':
         if tag in args.actor.bags:
-            args.actor.bags[tag] = []
+            args.actor.bags[tag].clear()
             args.actor.sendMessage("Bag " + tag + " emptied.")
         else:
             args.actor.sendMessage("Bag " + tag + " does not exist.")
@@ -1432,16 +1647,17 @@ def bag(args):
             if len(tokens) > 3:
                 if tokens[3] in args.actor.session:
                     target = args.actor.session.getEntity(tokens[3])
-                    target.sendMessage(args.actor.name + " shares some bags with you: ")
-                    args.actor.sendMessage("You share your bags with " + tokens[3] + ".")
+                    msg = args.actor.name + " shares some bags with you: "
                     for key in keys:
-                        target.sendMessage("    " + key + ": " + str(args.actor.bags[key]))
+                        msg += "\n    " + key + ": " + str(args.actor.bags[key])
+                    target.page(msg)
+                    args.actor.sendMessage("You share your bags with " + tokens[3] + ".")
             else:
                 args.actor.sendMessage("You share your bags.")
                 msg = args.actor.name + " shares some bags:"
                 for key in keys:
                     msg += "\n    " + key + ": " + str(args.actor.bags[key])
-                args.actor.session.broadcastExclude(msg, args.actor)
+                args.actor.session.broadcastExclude(msg, args.actor, paged=True)
 
         elif tag in args.actor.bags:
             if len(tokens) > 3:
@@ -1491,6 +1707,173 @@ def bag(args):
     else:
         return False
 
+    # everything but looking may change what gets saved
+    if subcommand not in ('share', 'show', 'display', 'check', 'list'):
+        args.actor.markDirty("bags")
+    return True
+
+
+def party(args):
+    """
+    Tallies and bags shared by the whole party, like a purse of gold or a
+    wagon full of supplies. Anyone may change them, and everyone is told.
+
+    syntax: party <tally | bag> <subcommand> <tag>
+
+    List of subcommands and syntax:
+        Check:          party
+        Create:         party tally/bag create <tag> [initial]
+        Destroy:        party tally/bag destroy <tag>
+        Add/Sub:        party tally add/sub <tag> [amount]
+        Set:            party tally set <tag> <value> [if <expected>]
+        Add/Remove:     party bag add/remove <tag> <items>
+        Give/Take:      party tally give/take <tag> <amount>
+                        party bag give/take <tag> <items>
+
+    Giving moves something from your own tally or bag into the party's one
+    of the same name, and taking moves it back out. With "if", a tally is
+    only set if it still holds the value you expected, so two people
+    settling the same pool at once cannot overwrite each other.
+
+    example:
+        party tally create gold 100
+        party tally give gold 25
+        party bag add wagon 10 rations 2 tents
+        party bag take wagon 3 rations
+    """
+    shared = args.actor.session.party
+    tokens = args.tokens
+
+    if len(tokens) == 1:
+        tallies = shared.tallies
+        bags = shared.bags
+        if len(tallies) == 0 and len(bags) == 0:
+            args.actor.sendMessage("The party has no shared tallies or bags.")
+            return True
+        msg = "------PARTY------"
+        for tag in sorted(tallies):
+            msg += "\n    " + tag + ": " + str(tallies[tag])
+        for tag in sorted(bags):
+            msg += "\n    " + tag + " (bag): " + str(bags[tag])
+        args.actor.page(msg)
+        return True
+
+    if len(tokens) < 4 or tokens[1] not in ('tally', 'bag'):
+        return False
+
+    kind, subcommand, tag = tokens[1], tokens[2], tokens[3]
+    name = args.actor.name
+
+    def tell(message):
+        args.actor.session.broadcast(colorfy("[PARTY] " + message, "cyan"))
+
+    if kind == 'tally':
+        amount = None
+        if len(tokens) > 4:
+            try:
+                amount = int(tokens[4])
+            except ValueError:
+                return False
+
+        if subcommand == 'create':
+            if shared.createTally(tag, amount or 0):
+                tell(name + " starts a party tally, " + tag + ", at " + str(amount or 0) + ".")
+            else:
+                args.actor.sendMessage("The party already has a tally called " + tag + ".")
+        elif subcommand in ('destroy', 'delete'):
+            if shared.destroyTally(tag):
+                tell(name + " does away with the party tally " + tag + ".")
+            else:
+                args.actor.sendMessage("The party has no tally called " + tag + ".")
+        elif subcommand in ('add', 'sub', 'subtract'):
+            if amount is None:
+                amount = 1
+            if subcommand != 'add':
+                amount = -amount
+            value = shared.increment(tag, amount)
+            if value is None:
+                args.actor.sendMessage("The party has no tally called " + tag + ".")
+            else:
+                tell(name + " changes the party's " + tag + " by " + str(amount) + ", to " + str(value) + ".")
+        elif subcommand in ('set', 'change'):
+            if amount is None:
+                return False
+            if len(tokens) > 6 and tokens[5] == 'if':
+                try:
+                    expected = int(tokens[6])
+                except ValueError:
+                    return False
+                swapped, value = shared.compareAndSet(tag, expected, amount)
+            else:
+                swapped, value = False, None
+                while not swapped and tag in shared.tallies:
+                    swapped, value = shared.compareAndSet(tag, shared.tallies[tag], amount)
+            if value is None:
+                args.actor.sendMessage("The party has no tally called " + tag + ".")
+            elif swapped:
+                tell(name + " sets the party's " + tag + " to " + str(value) + ".")
+            else:
+                args.actor.sendMessage("The party's " + tag + " is " + str(value) + " now, not " + tokens[6] + ". Nothing was changed.")
+        elif subcommand in ('give', 'take'):
+            if amount is None or amount < 1:
+                args.actor.sendMessage("Usage: party tally " + subcommand + " <tag> <amount>")
+                return True
+            if subcommand == 'take':
+                amount = -amount
+            result = shared.transferTally(args.actor, tag, amount)
+            if result is None:
+                args.actor.sendMessage("You and the party both need a tally called " + tag + ".")
+            elif amount > 0:
+                tell(name + " gives " + str(amount) + " " + tag + " to the party, which now has " + str(result[1]) + ".")
+            else:
+                tell(name + " takes " + str(-amount) + " " + tag + " from the party, which now has " + str(result[1]) + ".")
+        else:
+            return False
+        return True
+
+    items = inventory.parseItems(tokens[4:])
+    if subcommand == 'create':
+        if shared.createBag(tag):
+            if len(items) > 0:
+                shared.addItems(tag, items)
+            tell(name + " starts a party bag, " + tag + ".")
+        else:
+            args.actor.sendMessage("The party already has a bag called " + tag + ".")
+    elif subcommand in ('destroy', 'delete'):
+        if shared.destroyBag(tag):
+            tell(name + " does away with the party bag " + tag + ".")
+        else:
+            args.actor.sendMessage("The party has no bag called " + tag + ".")
+    elif len(items) == 0:
+        args.actor.sendMessage("Usage: party bag " + subcommand + " <tag> [quantity] <item> ...")
+    elif subcommand in ('add', 'put'):
+        if shared.addItems(tag, items):
+            added = inventory.Bag()
+            for item, quantity in items:
+                added.add(item, quantity)
+            tell(name + " adds " + str(added) + " to the party's " + tag + ".")
+        else:
+            args.actor.sendMessage("The party has no bag called " + tag + ".")
+    elif subcommand == 'remove':
+        taken = shared.removeItems(tag, items)
+        if taken is None:
+            args.actor.sendMessage("The party has no bag called " + tag + ".")
+        elif len(taken) == 0:
+            args.actor.sendMessage("The party's " + tag + " has none of that.")
+        else:
+            tell(name + " removes " + str(taken) + " from the party's " + tag + ".")
+    elif subcommand in ('give', 'take'):
+        moved = shared.transferItems(args.actor, tag, items, shared=(subcommand == 'give'))
+        if moved is None:
+            args.actor.sendMessage("You and the party both need a bag called " + tag + ".")
+        elif len(moved) == 0:
+            args.actor.sendMessage("There was none of that to move.")
+        elif subcommand == 'give':
+            tell(name + " puts " + str(moved) + " into the party's " + tag + ".")
+        else:
+            tell(name + " takes " + str(moved) + " out of the party's " + tag + ".")
+    else:
+        return False
     return True
 
 
@@ -1626,8 +2009,7 @@ def initiative(args):
         if len(tracker.order) == 0:
             args.actor.sendMessage("No ordering has been committed.")
             return True
-        args.actor.session.broadcast(str(tracker))
-        args.actor.session.broadcast(colorfy("It is now " + tracker.peek() + "'s turn.", "bred"))
+        args.actor.session.broadcast(str(tracker) + "\n" + colorfy("It is now " + tracker.peek() + "'s turn.", "bred"), paged=True)
 
     elif subcommand == 'reset':
         tracker.reset()
@@ -1650,18 +2032,163 @@ def initiative(args):
     return True
 
 
+@spectatorable
+def recap(args):
+    """
+    Shows what was said recently in the session, or in your room. Handy if
+    you joined late or stepped away.
+
+    syntax: recap [count]
+            count - how many messages to show (default 20)
+    """
+    count = 20
+    if len(args.tokens) > 1:
+        try:
+            count = int(args.tokens[1])
+        except ValueError:
+            return False
+    session = args.actor.session
+    languages = args.actor.languages
+    if args.actor.spectator:
+        languages = None
+    lines = session.scrollback.recent(count, session.locate(args.actor).name, languages=languages)
+    if len(lines) == 0:
+        args.actor.sendMessage("Nothing has been said yet.")
+        return True
+    args.actor.page(colorfy("------RECAP------", "cyan") + "\n" + "\n".join(lines))
+    return True
+
+
+@spectatorable
+def more(args):
+    """
+    Long output is sent a page at a time. Shows the next page, or throws
+    away the rest. Set the page size with "configure rows".
+
+    syntax: more [stop]
+    """
+    if len(args.tokens) > 1:
+        if args.tokens[1] != "stop":
+            return False
+        args.actor.stopPaging()
+        return True
+    if not args.actor.more():
+        args.actor.sendMessage("There is nothing more to show.")
+    return True
+
+
+@spectatorable
+def history(args):
+    """
+    Searches everything said in past sessions, when the server keeps
+    transcripts. Shows the newest matches.
+
+    syntax: history search <query>
+
+    A query is any of:
+        words           messages with all of these words
+        "a phrase"      messages with these words in this order
+        by:<name>       messages said by someone
+        since:<date>    messages from this date on, as YYYY-MM-DD
+        until:<date>    messages up to and including this date
+
+    Example: history search amulet by:king since:2026-01-01
+
+    You only find what you could have understood: things said everywhere or
+    within your hearing at the time, and speech in languages you know.
+    """
+    if len(args.tokens) < 3 or args.tokens[1] != "search":
+        return False
+
+    target = history_index.index
+    if target is None:
+        args.actor.sendMessage("This server is not keeping transcripts.")
+        return True
+
+    query = args.full.split(None, 2)[2]
+    reader = args.actor.name
+    languages = list(args.actor.languages)
+    if args.actor.dm or args.actor.spectator:
+        reader = languages = None
+    # This would normally be circular, like in help
+    import commandparser
+    dispatcher = commandparser.CommandParser().dispatcher
+
+    # searches can read a lot of the index, so keep them off the Dispatcher,
+    # and hand the results back to it to be shown
+    def run():
+        try:
+            results = target.query(query, reader=reader, languages=languages)
+        except ValueError:
+            # unbalanced quotes or a malformed date
+            dispatcher.defer(args.actor.sendMessage, "That search doesn't make sense. Check help history.")
+            return
+        except:
+            dispatcher.defer(args.actor.sendMessage, colorfy("[SERVER] The search failed.", "bright red"))
+            return
+        if len(results) == 0:
+            dispatcher.defer(args.actor.sendMessage, "Nothing found.")
+            return
+        lines = [history_index.render(result) for result in reversed(results)]
+        dispatcher.defer(args.actor.page, colorfy("------HISTORY------", "cyan") + "\n" + "\n".join(lines))
+
+    worker = threading.Thread(target=run)
+    worker.daemon = True
+    worker.start()
+    return True
+
+
 @spectatorable
 def save(args):
     """
-    Saves all persistent stuff.
+    Saves all persistent stuff. Saves are written in the background, so it
+    may take a few seconds to reach the disk.
 
     Syntax: save
     """
-    persist.saveEntity(args.actor)
+    persist.queueSave(args.actor)
     args.actor.sendMessage("Profile saved.")
     return True
 
 
+def backup(args):
+    """
+    DMs can write every profile to a single archive while the game goes on.
+    Saves made during the backup are held and written once it finishes.
+    Archives go in the server's backups directory. Names ending in .gz are
+    compressed.
+
+    syntax: backup [name]
+    """
+    if not args.actor.dm:
+        return False
+
+    name = "profiles-" + time.strftime("%Y%m%d-%H%M%S") + ".jsonl.gz"
+    if len(args.tokens) > 1:
+        name = args.tokens[1]
+    # only a plain file name, so a backup can't land outside the directory
+    if ("/" in name or "\\" in name or ".." in name or name.startswith(".") or
+            os.path.basename(name) != name):
+        args.actor.sendMessage("Backup names can't contain paths.")
+        return True
+    if not os.path.isdir(persist.BACKUP_DIRECTORY):
+        os.makedirs(persist.BACKUP_DIRECTORY)
+    path = os.path.join(persist.BACKUP_DIRECTORY, name)
+
+    def run():
+        try:
+            count = persist.exportProfiles(path)
+            args.actor.sendMessage(colorfy("[SERVER] Backed up " + str(count) + " profiles to " + path + ".", "bright yellow"))
+        except:
+            args.actor.sendMessage(colorfy("[SERVER] The backup to " + path + " failed.", "bright red"))
+
+    args.actor.sendMessage("Backing up profiles to " + path + "...")
+    worker = threading.Thread(target=run)
+    worker.daemon = True
+    worker.start()
+    return True
+
+
 def aspect(args):
     """
     DMs can set aspects on players. Anyone can check aspects.
@@ -1703,9 +2230,9 @@ def aspect(args):
             s = ""
             for e in args.actor.session:
                 s += e.name + " has the following aspects:\n    " + "\n    ".join(e.aspects) + "\n\n"
-            args.actor.sendMessage(s)
+            args.actor.page(s)
         elif target:
-            args.actor.sendMessage(target.name + " has the following aspects:\n    " + "\n    ".join(target.aspects))
+            args.actor.page(target.name + " has the following aspects:\n    " + "\n    ".join(target.aspects))
         else:
             return False
             
@@ -1745,7 +2272,7 @@ def description(args):
     """
     if len(args.tokens) > 1 and args.tokens[1] in ("clear", "erase", "clean"):
         args.actor.facade = ""
-        persist.saveEntity(args.actor)
+        persist.queueSave(args.actor, "facade")
         args.actor.sendMessage("Description erased.")
         return True
 
@@ -1757,7 +2284,7 @@ def description(args):
 
 def _description(args, text):
     args.actor.facade = text
-    persist.saveEntity(args.actor)
+    persist.queueSave(args.actor, "facade")
     args.actor.sendMessage("Profile saved.")
 
 
@@ -1766,9 +2293,9 @@ def docshare(args):
     """
     This is a command for sharing large text documents with the group.
 
-    It opens up the in-server editor, and sends the text to hastebin, 
-    a really nice minimalist pastebin alternative. The link is then broadcast
-    to all users for viewing.
+    It opens up the in-server editor, and keeps the text in the server's
+    document store. Everyone it is shared with is told its id, and can
+    read it with the read command.
 
     This is good for larger documents, because it can be shared with users 
     without spamming their client.
@@ -1785,28 +2312,47 @@ def docshare(args):
 
 def _docshare(args, text):
     """
-    Callback from hastepaste.
+    Callback from docshare.
     """
     try:
-        req = urllib2.Request("http://hastebin.com/documents", text)
-        response = urllib2.urlopen(req)
-        d = json.loads(response.read())
-        link = "http://hastebin.com/raw/" + d['key']
-
-        sent = []
-        if len(args.tokens[1:]) > 0:
-            names = args.tokens[1:]
-            for i in range(len(names)):
-                names[i] = names[i].lower()
-
-            for name in names:
-                target = args.actor.session.getEntity(name)
-                target.sendMessage(colorfy("DM " + args.actor.name + " shares a document with you: " + link, "red"))
-                sent.append(target.name)
-            args.actor.sendMessage(colorfy("You share a document with: " + str(sent), "red"))
-        else:
-            args.actor.session.broadcast(colorfy("DM " + args.actor.name + " shares a document with the session: " + link, "red"))
-    except urllib2.HTTPError:
-        print "Server: Exception occurred while uploading to hastebin."
-        args.actor.sendMessage("There was an issue with uploading your document to hastebin.")
-        args.actor.sendMessage("Chances are that either hastebin is down, or your document was too large.")
+        key = docstore.store.put(text, author=args.actor.name)
+    except (IOError, OSError):
+        print "Server: Exception occurred while storing a shared document."
+        args.actor.sendMessage("There was an issue with storing your document.")
+        return
+    link = "read " + docstore.shortId(key)
+
+    sent = []
+    if len(args.tokens[1:]) > 0:
+        for name in args.tokens[1:]:
+            target = args.actor.session.getEntity(name)
+            if target is None:
+                continue
+            target.sendMessage(colorfy("DM " + args.actor.name + " shares a document with you: " + link, "red"))
+            sent.append(target.name)
+        args.actor.sendMessage(colorfy("You share a document with: " + str(sent), "red"))
+    else:
+        args.actor.session.broadcast(colorfy("DM " + args.actor.name + " shares a document with the session: " + link, "red"))
+
+
+@spectatorable
+def read(args):
+    """
+    Reads a shared document, a page at a time. Type more for the next page.
+
+    syntax: read <id>
+            id - the id given when the document was shared
+    """
+    if len(args.tokens) != 2:
+        return False
+    try:
+        document = docstore.store.open(args.tokens[1])
+    except (IOError, OSError):
+        print "Server: Exception occurred while opening a shared document."
+        args.actor.sendMessage("That document can no longer be read.")
+        return True
+    if document is None:
+        args.actor.sendMessage("There is no document " + args.tokens[1] + ".")
+        return True
+    args.actor.page(document)
+    return True
@@ -1,6 +1,9 @@
 import random
 from mushyutils import colorfy
 
+# All rolls draw from this generator so sessions can be recorded and replayed
+rng = random.Random()
+
 class DiceException(Exception):
     __slots__ = ("msg")
     def __init__(self, msg):
@@ -24,7 +27,7 @@ def resolve(token):
             raise DiceException(str(token))
         dice = []
         for i in range(num):
-            d = random.randint(1, sides)
+            d = rng.randint(1, sides)
             r += d
             dice.append(str(d))
         msg = colorfy("(" + " + ".join(dice) + ")", "green")
@@ -34,7 +37,7 @@ def resolve(token):
 
 
 def fudge():
-    results = [random.randint(-1, 1) for _ in range(4)]
+    results = [rng.randint(-1, 1) for _ in range(4)]
     chars = {-1: '-', 0: '=', 1: '+'}
     tones = {-1: 'bred', 0: 'default', 1: 'bgreen'}
     result = sum(results)
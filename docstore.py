@@ -0,0 +1,198 @@
+import os
+import bisect
+import zlib
+import json
+import time
+import hashlib
+import threading
+
+"""
+Shared documents, kept on the server's own disk. A document is stored
+under the hash of its text, so sharing the same handout twice keeps one
+copy, and is looked up by that hash (or the first few characters of it)
+straight from its path. Ids given out are SHORT_ID characters long, and
+nothing shorter is looked up, so private handouts cannot be found by
+guessing a couple of characters.
+
+Text is cut into chunks of whole lines, about CHUNK bytes each. Chunks are
+compressed and stored under their own hash, so documents that share most
+of their text share most of their chunks too. A document's manifest lists
+its chunks and the line each one starts at, which lets a reader fetch just
+the lines it is showing.
+
+    <directory>/docs/<2 hex>/<hash>      manifest, JSON
+    <directory>/chunks/<2 hex>/<hash>    zlib compressed text
+"""
+
+# Where documents are kept unless the server is started with --documents
+DOCUMENTS_PATH = "./documents"
+
+# Rough size of a chunk of text, in bytes
+CHUNK = 64 * 1024
+
+# Characters of a document's hash shown to players, and the fewest that
+# will find one
+SHORT_ID = 10
+
+
+def _hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def _write(path, data):
+    """Write a file whole or not at all. Existing files are left alone."""
+    if os.path.exists(path):
+        return
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # another writer made it first
+            pass
+    temp = path + ".tmp" + str(threading.current_thread().ident)
+    f = open(temp, "wb")
+    f.write(data)
+    f.close()
+    os.rename(temp, path)
+
+
+class Document(object):
+    """
+    A stored document as a read-only sequence of its lines. Slicing only
+    reads and decompresses the chunks the slice covers.
+    """
+
+    __slots__ = ("store", "key", "manifest", "starts", "cached")
+
+    def __init__(self, store, key, manifest):
+        self.store = store
+        self.key = key
+        self.manifest = manifest
+        self.starts = [first for chunk, first, count in manifest["chunks"]]
+        # (chunk number, its lines) for the chunk read last
+        self.cached = (None, None)
+
+    def __len__(self):
+        return self.manifest["lines"]
+
+    def _chunk(self, number):
+        cached_number, lines = self.cached
+        if cached_number != number:
+            lines = self.store.chunk(self.manifest["chunks"][number][0]).split("\n")
+            self.cached = (number, lines)
+        return lines
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            if index < 0:
+                index += len(self)
+            if index < 0 or index >= len(self):
+                raise IndexError("line out of range")
+            return self[index:index + 1][0]
+        start, stop, step = index.indices(len(self))
+        ret = []
+        line = start
+        while line < stop:
+            number = bisect.bisect_right(self.starts, line) - 1
+            first = self.starts[number]
+            lines = self._chunk(number)
+            taken = lines[line - first:stop - first]
+            if len(taken) == 0:
+                break
+            ret.extend(taken)
+            line += len(taken)
+        return ret[::step]
+
+    def text(self):
+        return "\n".join(self[:])
+
+
+class DocumentStore(object):
+
+    __slots__ = ("directory",)
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, kind, key):
+        return os.path.join(self.directory, kind, key[:2], key)
+
+    def put(self, text, author=None):
+        """Store a document. Returns its id, the same one for the same text."""
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
+        key = _hash(text)
+        if os.path.exists(self._path("docs", key)):
+            return key
+
+        chunks = []
+        lines = text.split("\n")
+        first = 0
+        while first < len(lines):
+            size = 0
+            last = first
+            while last < len(lines) and (last == first or size + len(lines[last]) < CHUNK):
+                size += len(lines[last]) + 1
+                last += 1
+            data = "\n".join(lines[first:last])
+            chunk = _hash(data)
+            _write(self._path("chunks", chunk), zlib.compress(data))
+            chunks.append([chunk, first, last - first])
+            first = last
+
+        manifest = {"lines": len(lines), "bytes": len(text), "chunks": chunks,
+                    "created": time.time(), "author": author}
+        _write(self._path("docs", key), json.dumps(manifest))
+        return key
+
+    def resolve(self, key):
+        """The full id of a document from an id or the start of one, or None"""
+        key = key.lower()
+        if len(key) < SHORT_ID or any(c not in "0123456789abcdef" for c in key):
+            return None
+        if os.path.exists(self._path("docs", key)):
+            return key
+        directory = os.path.join(self.directory, "docs", key[:2])
+        if not os.path.isdir(directory):
+            return None
+        matches = [name for name in os.listdir(directory) if name.startswith(key) and ".tmp" not in name]
+        if len(matches) != 1:
+            return None
+        return matches[0]
+
+    def open(self, key):
+        """
+        The Document with an id or the start of one, or None. Raises IOError
+        if its manifest cannot be read.
+        """
+        key = self.resolve(key)
+        if key is None:
+            return None
+        f = open(self._path("docs", key), "rb")
+        try:
+            manifest = json.loads(f.read())
+        except ValueError:
+            raise IOError("Corrupt manifest for document " + key)
+        finally:
+            f.close()
+        return Document(self, key, manifest)
+
+    def chunk(self, key):
+        """A chunk's text. Raises IOError if it is missing or corrupt."""
+        f = open(self._path("chunks", key), "rb")
+        try:
+            data = zlib.decompress(f.read())
+        except zlib.error:
+            raise IOError("Corrupt chunk " + key)
+        finally:
+            f.close()
+        return data
+
+
+# Where shared documents go, see server.py for --documents
+store = DocumentStore(DOCUMENTS_PATH)
+
+
+def shortId(key):
+    return key[:SHORT_ID]
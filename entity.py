@@ -1,16 +1,60 @@
 import traceback
 import sys
 import threading
-import time
 import socket
 import commandparser
-from mushyutils import wrap
+from mushyutils import colorfy, wrap
+
+# Fields written to a profile
+PERSISTED = ("hcode", "salt", "tallies", "bags", "facade", "dm", "spectator",
+             "languages", "aliases", "settings", "aspects")
+
+# Fields that can be large, so are stored apart from the profile and only
+# read when something uses them
+LAZY = ("facade", "bags")
+
+# Stands in for a lazy field that has not been read yet
+UNLOADED = object()
+
+# Lines per page of long output, unless the player configures rows
+PAGE_ROWS = 40
+
+
+class LazyField(object):
+    """
+    Reads a field through the entity's loader the first time it is used.
+    persist.loadEntity sets the loader; entities made any other way start
+    with every field loaded.
+    """
+
+    __slots__ = ("field", "slot")
+
+    def __init__(self, field):
+        self.field = field
+        self.slot = "_" + field
+
+    def __get__(self, e, owner):
+        if e is None:
+            return self
+        value = getattr(e, self.slot)
+        if value is UNLOADED:
+            value = e.loader(self.field)
+            setattr(e, self.slot, value)
+        return value
+
+    def __set__(self, e, value):
+        setattr(e, self.slot, value)
+
 
 class Entity(object):
     __slots__ = ("proxy", "name", "session", "dm", "status", "tallies",
-                 "bags", "facade", "tallies_persist", "bags_persist",
+                 "_bags", "_facade", "tallies_persist", "bags_persist",
                  "languages", "aliases", "hcode", "salt", "mask", "settings", "test",
-                 "spectator", "aspects")
+                 "spectator", "aspects", "location", "dirty", "loader", "pager",
+                 "pager_at", "pager_rows", "pager_queue")
+
+    facade = LazyField("facade")
+    bags = LazyField("bags")
 
     def __init__(self, name="", hcode=None, salt=None, proxy=None, session=None):
         self.proxy = proxy
@@ -18,6 +62,7 @@ class Entity(object):
             self.proxy.setEntity(self)
         self.name = name
         self.session = session
+        self.location = None
         self.dm = False
         self.spectator = False
         self.mask = None
@@ -34,19 +79,131 @@ class Entity(object):
         self.aspects = []
         self.settings = {
             "cols": 0,
-            "saywrap": False
+            "saywrap": False,
+            "rows": PAGE_ROWS
         }
+        # fields changed since the profile was last loaded or saved; a new
+        # entity has never been saved, so all of them
+        self.dirty = set(PERSISTED)
+        self.loader = None
+        # lines of paged output, how far more has got through them, and the
+        # wrapped rows of a line that did not fit on the last page
+        self.pager = []
+        self.pager_at = 0
+        self.pager_rows = []
+        # more paged output waiting its turn behind what is being paged
+        self.pager_queue = []
 
-    def sendMessage(self, message):
+    def sendMessage(self, message, wrapped=False):
         if(self.proxy is not None):
             try:
-                if self.settings["cols"] != 0:
+                if self.settings["cols"] != 0 and not wrapped:
                     message = wrap(message, cols=self.settings["cols"])
                 self.proxy.socket.send(message + "\n")
             except:
                 print "Server: Exception thrown while sending " + self.name + " a message."
                 self.proxy.kill()
 
+    def paging(self):
+        """True while output is held for more"""
+        return (self.pager_at < len(self.pager) or len(self.pager_rows) > 0 or
+                len(self.pager_queue) > 0)
+
+    def page(self, message, behind=False):
+        """
+        Send a long message a page at a time. Only the first page goes out;
+        the rest is held until the player asks for it with more. The message
+        can also be any sequence of lines, which is only sliced a page at a
+        time. Lines are wrapped as they are paged, so a page is never more
+        than rows tall.
+
+        Paging something new throws away whatever was held before it, unless
+        behind is set, as it is for broadcasts: then it waits its turn after
+        what the player is already reading.
+        """
+        if isinstance(message, basestring):
+            lines = message.split("\n")
+        else:
+            lines = message
+        if behind and self.paging() and self.settings.get("rows", PAGE_ROWS) > 0:
+            self.pager_queue.append(lines)
+            self.sendMessage(colorfy("-- More output is waiting, type more to continue --", "cyan"))
+            return
+        self.stopPaging()
+        if self.settings.get("rows", PAGE_ROWS) <= 0:
+            try:
+                shown = lines[:]
+            except (IOError, OSError):
+                self.sendMessage("That can no longer be read.")
+                return
+            self.sendMessage("\n".join(shown))
+            return
+        self.pager = lines
+        self.more()
+
+    def more(self):
+        """Send the next page of held output. False if nothing is held."""
+        if not self.paging():
+            return False
+        lines = self.pager
+        cols = self.settings["cols"]
+        # one row of the page goes to the prompt
+        rows = max(self.settings.get("rows", PAGE_ROWS), 2) - 1
+        shown = self.pager_rows[:rows]
+        self.pager_rows = self.pager_rows[rows:]
+        while len(shown) < rows:
+            if self.pager_at >= len(lines):
+                if len(self.pager_queue) == 0:
+                    break
+                # on to the next output waiting its turn
+                lines = self.pager = self.pager_queue.pop(0)
+                self.pager_at = 0
+                continue
+            at = self.pager_at
+            try:
+                batch = lines[at:at + rows - len(shown)]
+            except (IOError, OSError):
+                # the rest of a stored document went missing
+                self.stopPaging()
+                self.sendMessage("The rest of that can no longer be read.")
+                return True
+            for line in batch:
+                at += 1
+                wrapped = [line]
+                if cols != 0:
+                    wrapped = wrap(line, cols=cols).split("\n")
+                room = rows - len(shown)
+                shown.extend(wrapped[:room])
+                if len(wrapped) > room:
+                    self.pager_rows = wrapped[room:]
+                    break
+            self.pager_at = at
+        left = len(lines) - self.pager_at + len(self.pager_rows)
+        left += sum(len(queued) for queued in self.pager_queue)
+        if left > 0:
+            shown.append(colorfy("-- " + str(left) + " more lines, type more to continue --", "cyan"))
+        else:
+            self.stopPaging()
+        self.sendMessage("\n".join(shown), wrapped=True)
+        return True
+
+    def stopPaging(self):
+        """Throw away any output held for more"""
+        self.pager = []
+        self.pager_at = 0
+        self.pager_rows = []
+        self.pager_queue = []
+
+    def markDirty(self, *fields):
+        """Note which persisted fields changed since the last save"""
+        if len(fields) == 0:
+            fields = PERSISTED
+        self.dirty.update(fields)
+
+    def isLoaded(self, field):
+        """False for a lazy field that has not been read from the store yet"""
+        return getattr(self, "_" + field) is not UNLOADED
+
     def hookProxy(self, proxy):
         self.proxy = proxy
         self.proxy.setEntity(self)
@@ -54,20 +211,33 @@ class Entity(object):
 
 class ClientProxy(threading.Thread):
 
-    __slots__ = ("socket", "entity", "running", "bypass", "parser")
+    __slots__ = ("socket", "entity", "running", "mode", "ready", "parser")
 
     def __init__(self, socket):
         threading.Thread.__init__(self)
         self.socket = socket
         self.entity = None
         self.running = False
-        self.bypass = False
+        # an input mode, such as the editor, takes every line read while set
+        self.mode = None
+        # cleared while a command that may start an input mode is pending,
+        # so nothing more is read until it has
+        self.ready = threading.Event()
+        self.ready.set()
         self.parser = commandparser.CommandParser()
 
     def setEntity(self, entity):
         self.entity = entity
 
+    def leaveMode(self):
+        """Take the connection out of its input mode, abandoning it"""
+        mode = self.mode
+        self.mode = None
+        if mode is not None:
+            mode.abandon()
+
     def kill(self):
+        self.ready.set()
         try:
             if self.socket:
                 self.socket.shutdown(socket.SHUT_RDWR)
@@ -76,23 +246,53 @@ class ClientProxy(threading.Thread):
         except:
             pass
 
+    def dropped(self):
+        """
+        The client went away without logging out. Keep the entity around in
+        case they resume, unless a logout, zap or reconnect already took it
+        out of the session.
+        """
+        self.running = False
+        self.leaveMode()
+        e = self.entity
+        if e is None or e.session is None or e.proxy is not self:
+            return
+        if e.session.connections.get(e.name.lower()) is not e:
+            return
+        e.session.linger(e)
+        e.session.broadcast(colorfy("[SERVER] " + e.name + " has lost their connection.", "bright yellow"))
+
     def run(self):
         try:
             self.running = True
             while self.running:
-                if self.bypass:
-                    time.sleep(0)
+                self.ready.wait()
+                data = self.socket.recv(4096)
+                if data == "":
+                    # an empty read is the client hanging up
+                    self.dropped()
+                    break
+                mode = self.mode
+                if mode is not None:
+                    mode.handle(data)
+                    continue
+                data = data.strip()
+                if not data:
+                    continue
                 else:
-                    data = self.socket.recv(4096).strip()
-                    if not data:
-                        continue
-                    else:
-                        self.parser.parseLine(data, self.entity)
+                    self.parser.parseLine(data, self.entity)
 
+        except socket.error:
+            self.dropped()
+            try:
+                self.socket.close()
+            except:
+                pass
         except:
             exc_type, exc_value, exc_traceback = sys.exc_info()
             traceback.print_exception(exc_type, exc_value, exc_traceback, limit=None, file=sys.stdout)
             self.running = False
+            self.leaveMode()
             if self.socket:
                 self.socket.close()
             print "Client connection closed"
\ No newline at end of file
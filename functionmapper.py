@@ -3,6 +3,8 @@ import namedtuple
 
 CommandArgs = namedtuple.namedtuple('CommandArgs', 'name tokens full actor')
 
+# Help is compiled from this table once the server starts, so anything that
+# changes it after that must call helpindex.rebuild()
 commandFunctions = {}
 commandFunctions["configure"] = commands.configure
 commandFunctions["config"] = commands.configure
@@ -19,6 +21,9 @@ commandFunctions["languages"] = commands.language
 commandFunctions["logout"] = commands.logout
 commandFunctions["help"] = commands.help
 commandFunctions["who"] = commands.who
+commandFunctions["recap"] = commands.recap
+commandFunctions["history"] = commands.history
+commandFunctions["more"] = commands.more
 commandFunctions["pm"] = commands.pm
 commandFunctions["emote"] = commands.emote
 commandFunctions["ooc"] = commands.ooc
@@ -36,17 +41,23 @@ commandFunctions["sculpt"] = commands.sculpt
 commandFunctions["brush"] = commands.brush
 commandFunctions["wipe"] = commands.wipe
 commandFunctions["look"] = commands.look
+commandFunctions["go"] = commands.go
+commandFunctions["rooms"] = commands.rooms
+commandFunctions["room"] = commands.room
 commandFunctions["tally"] = commands.tally
 commandFunctions["tallies"] = commands.tally
 commandFunctions["bag"] = commands.bag
 commandFunctions["bags"] = commands.bag
+commandFunctions["party"] = commands.party
 commandFunctions["save"] = commands.save
+commandFunctions["backup"] = commands.backup
 commandFunctions["desc"] = commands.description
 commandFunctions["description"] = commands.description
 commandFunctions["exa"] = commands.examine
 commandFunctions["examine"] = commands.examine
 commandFunctions["hastepaste"] = commands.docshare
 commandFunctions["docshare"] = commands.docshare
+commandFunctions["read"] = commands.read
 commandFunctions["zap"] = commands.zap
 commandFunctions["init"] = commands.initiative
 commandFunctions["initiative"] = commands.initiative
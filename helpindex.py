@@ -0,0 +1,130 @@
+import re
+import inspect
+import threading
+
+from mushyutils import colorfy
+
+"""
+The help corpus, compiled once from the command docstrings rather than on
+every help command. Holds each topic's rendered page, the command listing
+laid out for each wrap width it has been asked for, and a word index over
+the docstrings for help search.
+
+Build it with build() once the command table is complete, and call
+rebuild() whenever the table changes after that.
+"""
+
+# Width of a column in the command listing, and the indent before each row
+COLUMN = 15
+INDENT = 4
+
+# Columns in the listing when the player does not wrap
+LISTING_COLUMNS = 4
+
+# Most topics help search will list
+SEARCH_MAX = 15
+
+_word = re.compile(r"[a-z0-9]+")
+
+# The current HelpIndex, see build()
+index = None
+_lock = threading.Lock()
+
+# (module, commandFunctions) the index was last built from
+_source = None
+
+
+class HelpIndex(object):
+
+    __slots__ = ("pages", "summaries", "commands", "words", "listings")
+
+    def __init__(self, module, commandFunctions):
+        docs = {}
+        for functionName, function in inspect.getmembers(module, inspect.isfunction):
+            if function.__doc__ is not None:
+                docs[functionName] = function.__doc__
+
+        # a command's aliases share its help file
+        names = {}
+        for command, function in commandFunctions.items():
+            names.setdefault(function.__name__, []).append(command)
+        for functionName in names:
+            if functionName in docs:
+                for command in names[functionName]:
+                    docs.setdefault(command, docs[functionName])
+
+        self.pages = {}
+        self.summaries = {}
+        for topic in docs:
+            prelude = "help file for: " + topic + "\n" + ("-" * len("help file for: " + topic))
+            self.pages[topic] = colorfy(prelude, 'green') + docs[topic]
+            lines = [line.strip() for line in docs[topic].strip().splitlines()]
+            self.summaries[topic] = lines[0] if len(lines) > 0 else ""
+
+        self.commands = sorted(command for command in commandFunctions
+                               if command in docs and command == commandFunctions[command].__name__)
+
+        # word -> {topic: how often the word is in its docstring}
+        self.words = {}
+        for topic in self.commands:
+            for word in _word.findall((topic + " " + docs[topic]).lower()):
+                counts = self.words.setdefault(word, {})
+                counts[topic] = counts.get(topic, 0) + 1
+
+        # cols -> rendered listing
+        self.listings = {}
+
+    def page(self, topic):
+        return self.pages.get(topic)
+
+    def listing(self, cols=0):
+        """The command listing, laid out to fit lines of cols characters"""
+        listing = self.listings.get(cols)
+        if listing is not None:
+            return listing
+        columns = LISTING_COLUMNS
+        if cols > 0:
+            columns = max(1, (cols - INDENT) // COLUMN)
+        rows = []
+        for i in range(0, len(self.commands), columns):
+            rows.append(" " * INDENT + "".join(command + (' ' * (COLUMN - len(command)))
+                                               for command in self.commands[i:i + columns]).rstrip())
+        listing = "\n".join(rows)
+        # assignment is atomic, a race just renders the same listing twice
+        self.listings[cols] = listing
+        return listing
+
+    def search(self, text):
+        """Commands whose help has every word of text, best matches first"""
+        scores = None
+        for word in set(_word.findall(text.lower())):
+            counts = self.words.get(word, {})
+            if scores is None:
+                scores = dict(counts)
+            else:
+                scores = dict((topic, scores[topic] + counts[topic]) for topic in scores if topic in counts)
+            if len(scores) == 0:
+                return []
+        if scores is None:
+            return []
+        ranked = sorted(scores, key=lambda topic: (-scores[topic], topic))
+        return [(topic, self.summaries[topic]) for topic in ranked[:SEARCH_MAX]]
+
+
+def build(module, commandFunctions):
+    """Compile the help index from a commands module and its command table"""
+    global index, _source
+    with _lock:
+        index = HelpIndex(module, commandFunctions)
+        _source = (module, commandFunctions)
+    return index
+
+
+def rebuild():
+    """
+    Compile the help index again from what it was last built from, after
+    commands are added, removed or reloaded. Does nothing before build().
+    """
+    if _source is None:
+        return None
+    return build(*_source)
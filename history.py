@@ -0,0 +1,455 @@
+import os
+import re
+import sys
+import gzip
+import mmap
+import time
+import glob
+import array
+import bisect
+import struct
+import shlex
+import marshal
+import threading
+
+import transcript
+
+"""
+Full-text search over session transcripts. The Transcript hands every
+message it writes to an Index, which keeps
+
+    docs.bin        one fixed-size record per message: time, speaker,
+                    audience, language, and where its text is in texts.dat
+    texts.dat       the text of every message, colors stripped
+    speakers.txt    speaker names, one per line, numbered from 0
+    audiences.txt   who was in earshot of each message, likewise
+    languages.txt   the languages messages were spoken in, likewise
+    seg-<first>-<last>.terms, .post
+                    a sealed segment of the inverted index, covering
+                    messages first to last: a term dictionary, and the
+                    postings it points into as uint32 message numbers
+
+New messages are indexed in memory and sealed into a segment every
+SEGMENT_DOCS messages. Sealed segments never change, so their postings are
+memory-mapped and shared by every search. Anything not yet sealed when the
+server stops is indexed again from texts.dat on the next start.
+
+Queries are words, "quoted phrases", by:<speaker>, since:<YYYY-MM-DD> and
+until:<YYYY-MM-DD>. Words and speakers are looked up in the index, and
+messages are kept in time order, so dates are found by binary search;
+phrases narrow the matches down. A search for a player only finds what
+they could have understood: messages heard everywhere or said within
+their hearing, and speech in languages they know.
+
+usage: python history.py search <index directory> <query>
+       python history.py build <transcript directory> <index directory>
+"""
+
+# Messages per sealed segment
+SEGMENT_DOCS = 20000
+
+# Results a search returns unless asked for more
+RESULTS = 10
+
+# time, speaker, audience, language, text offset, text length
+_doc = struct.Struct("<dIIIQI")
+
+# Stands for no speaker, a message heard everywhere, or no language
+NONE = 0xFFFFFFFF
+
+_word = re.compile(r"[a-z0-9']+")
+
+# The Index the server's transcript feeds, if any, for the history command
+index = None
+
+
+def words(text):
+    return _word.findall(transcript.stripAnsi(text).lower())
+
+
+def _speakerTerm(name):
+    # can't clash with a word, which never has a space in it
+    return "by " + name.lower()
+
+
+class Names(object):
+    """A numbered list of names kept in a text file, one per line"""
+
+    __slots__ = ("path", "names", "ids")
+
+    def __init__(self, path):
+        self.path = path
+        self.names = []
+        if os.path.exists(path):
+            f = open(path, "rb")
+            self.names = [line.rstrip("\n").decode("utf-8") for line in f]
+            f.close()
+        self.ids = dict((name.lower(), i) for i, name in enumerate(self.names))
+
+    def get(self, name):
+        return self.ids.get(name.lower())
+
+    def add(self, name):
+        if name is None:
+            return NONE
+        key = name.lower()
+        if key not in self.ids:
+            self.ids[key] = len(self.names)
+            self.names.append(name)
+            f = open(self.path, "ab")
+            if isinstance(name, unicode):
+                name = name.encode("utf-8")
+            f.write(name + "\n")
+            f.close()
+        return self.ids[key]
+
+    def name(self, number):
+        if number < len(self.names):
+            return self.names[number]
+        return None
+
+
+class Segment(object):
+    """A sealed, read-only piece of the inverted index"""
+
+    __slots__ = ("first", "last", "terms", "postings", "file")
+
+    def __init__(self, base, first, last):
+        self.first = first
+        self.last = last
+        f = open(base + ".terms", "rb")
+        self.terms = marshal.loads(f.read())
+        f.close()
+        self.file = open(base + ".post", "rb")
+        if os.path.getsize(base + ".post") > 0:
+            self.postings = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.postings = ""
+
+    def lookup(self, term):
+        if term not in self.terms:
+            return array.array("I")
+        start, count = self.terms[term]
+        ret = array.array("I")
+        ret.fromstring(self.postings[start * 4:(start + count) * 4])
+        return ret
+
+    def close(self):
+        if not isinstance(self.postings, str):
+            self.postings.close()
+        self.file.close()
+
+
+class _Stamps(object):
+    """The times of a run of message records, as a sequence bisect can search"""
+
+    __slots__ = ("docs", "count")
+
+    def __init__(self, docs, count):
+        self.docs = docs
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, number):
+        return _doc.unpack_from(self.docs, number * _doc.size)[0]
+
+
+class Index(object):
+
+    __slots__ = ("directory", "lock", "docs", "texts", "count", "speakers",
+                 "audiences", "languages", "segments", "memory", "memory_first")
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.docs = open(os.path.join(directory, "docs.bin"), "a+b")
+        self.texts = open(os.path.join(directory, "texts.dat"), "a+b")
+        self.docs.seek(0, 2)
+        # a record cut short by a crash is dropped
+        self.count = self.docs.tell() // _doc.size
+        self.docs.truncate(self.count * _doc.size)
+
+        self.speakers = Names(os.path.join(directory, "speakers.txt"))
+        # lowercased names of everyone who heard a message, tab separated
+        self.audiences = Names(os.path.join(directory, "audiences.txt"))
+        self.languages = Names(os.path.join(directory, "languages.txt"))
+
+        self.segments = []
+        for terms in sorted(glob.glob(os.path.join(directory, "seg-*.terms"))):
+            base = terms[:-len(".terms")]
+            first, last = os.path.basename(base)[len("seg-"):].split("-")
+            self.segments.append(Segment(base, int(first), int(last)))
+
+        # term -> message numbers, for messages not sealed into a segment yet
+        self.memory = {}
+        self.memory_first = 0
+        if len(self.segments) > 0:
+            self.memory_first = self.segments[-1].last + 1
+        for number in range(self.memory_first, self.count):
+            self.docs.seek(number * _doc.size)
+            stamp, speaker, audience, language, offset, length = _doc.unpack(self.docs.read(_doc.size))
+            self.texts.seek(offset)
+            self._remember(number, self.texts.read(length), self.speakers.name(speaker))
+
+    def _remember(self, number, text, speaker):
+        terms = set(words(text))
+        if speaker is not None:
+            terms.add(_speakerTerm(speaker))
+        for term in terms:
+            if term not in self.memory:
+                self.memory[term] = array.array("I")
+            self.memory[term].append(number)
+
+    def add(self, stamp, speaker, text, hearers=None, language=None):
+        """
+        Index one message, heard by the named players (None for everyone)
+        and spoken in a language, if any. Call commit once a batch has been
+        added.
+        """
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
+        text = transcript.stripAnsi(text)
+        with self.lock:
+            heard = NONE
+            if hearers is not None:
+                heard = self.audiences.add("\t".join(sorted(set(name.lower() for name in hearers))))
+            self.texts.seek(0, 2)
+            offset = self.texts.tell()
+            self.texts.write(text)
+            self.docs.seek(0, 2)
+            self.docs.write(_doc.pack(stamp, self.speakers.add(speaker), heard,
+                                      self.languages.add(language), offset, len(text)))
+            self._remember(self.count, text, speaker)
+            self.count += 1
+
+    def commit(self):
+        with self.lock:
+            self.texts.flush()
+            self.docs.flush()
+            if self.count - self.memory_first >= SEGMENT_DOCS:
+                self._seal()
+
+    def _seal(self):
+        """Write the in-memory postings out as a new segment"""
+        first, last = self.memory_first, self.count - 1
+        base = os.path.join(self.directory, "seg-%010d-%010d" % (first, last))
+        terms = {}
+        post = open(base + ".post.tmp", "wb")
+        start = 0
+        for term in sorted(self.memory):
+            numbers = self.memory[term]
+            terms[term] = (start, len(numbers))
+            numbers.tofile(post)
+            start += len(numbers)
+        post.close()
+        f = open(base + ".terms.tmp", "wb")
+        f.write(marshal.dumps(terms))
+        f.close()
+        # the terms file appearing is what makes the segment count
+        os.rename(base + ".post.tmp", base + ".post")
+        os.rename(base + ".terms.tmp", base + ".terms")
+        self.segments.append(Segment(base, first, last))
+        self.memory = {}
+        self.memory_first = self.count
+
+    def _frequency(self, term):
+        """How many messages have a term in them, without reading postings"""
+        ret = len(self.memory.get(term, ()))
+        for segment in self.segments:
+            if term in segment.terms:
+                ret += segment.terms[term][1]
+        return ret
+
+    def _postings(self, term):
+        ret = []
+        for segment in self.segments:
+            ret.extend(segment.lookup(term))
+        ret.extend(self.memory.get(term, []))
+        return ret
+
+    def search(self, terms=(), phrases=(), speaker=None, since=None, until=None, limit=RESULTS,
+               reader=None, languages=None):
+        """
+        The newest messages with every term and phrase in them, said by the
+        speaker, between the times given. Returns (time, speaker, text) for
+        each, newest first.
+
+        With a reader, only messages heard by everyone or by that player are
+        found, and with languages, only speech in those languages (or in
+        none). Leave both None to search everything.
+        """
+        needed = list(terms)
+        for phrase in phrases:
+            needed.extend(words(phrase))
+        if speaker is not None:
+            needed.append(_speakerTerm(speaker))
+
+        # only the postings and sizes are read under the lock; everything
+        # after works on a snapshot and leaves the transcript writer alone
+        with self.lock:
+            self.texts.flush()
+            self.docs.flush()
+            count = self.count
+            candidates = None
+            # rarest first, so the candidates shrink as fast as they can
+            for term in sorted(set(needed), key=self._frequency):
+                found = set(self._postings(term))
+                if candidates is None:
+                    candidates = found
+                else:
+                    candidates &= found
+                if len(candidates) == 0:
+                    return []
+            visible = None
+            if reader is not None:
+                reader = reader.lower()
+                visible = set(i for i, audience in enumerate(self.audiences.names)
+                              if reader in audience.split("\t"))
+            known = None
+            if languages is not None:
+                known = set(self.languages.get(language) for language in languages)
+            speakers = list(self.speakers.names)
+        if count == 0:
+            return []
+
+        docs = mmap.mmap(self.docs.fileno(), count * _doc.size, access=mmap.ACCESS_READ)
+        texts = None
+        if os.path.getsize(self.texts.name) > 0:
+            texts = mmap.mmap(self.texts.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # messages are in time order, so dates are a range of numbers
+            stamps = _Stamps(docs, count)
+            low, high = 0, count
+            if since is not None:
+                low = bisect.bisect_left(stamps, since)
+            if until is not None:
+                high = bisect.bisect_left(stamps, until)
+            if candidates is None:
+                candidates = xrange(high - 1, low - 1, -1)
+            else:
+                candidates = sorted((number for number in candidates if low <= number < high), reverse=True)
+
+            wanted = [" ".join(words(phrase)) for phrase in phrases]
+            ret = []
+            for number in candidates:
+                stamp, said_by, heard, language, offset, length = _doc.unpack_from(docs, number * _doc.size)
+                if visible is not None and heard != NONE and heard not in visible:
+                    continue
+                if known is not None and language != NONE and language not in known:
+                    continue
+                text = ""
+                if texts is not None:
+                    text = texts[offset:offset + length]
+                if len(wanted) > 0:
+                    flat = " " + " ".join(words(text)) + " "
+                    if not all(" " + w + " " in flat for w in wanted):
+                        continue
+                name = None
+                if said_by < len(speakers):
+                    name = speakers[said_by]
+                ret.append((stamp, name, text))
+                if len(ret) >= limit:
+                    break
+            return ret
+        finally:
+            docs.close()
+            if texts is not None:
+                texts.close()
+
+    def query(self, text, limit=RESULTS, reader=None, languages=None):
+        """Search with a query string, see the module docstring"""
+        terms = []
+        phrases = []
+        options = {}
+        for token in shlex.split(text):
+            key, colon, value = token.partition(":")
+            if colon and key in ("by", "since", "until") and value:
+                options[key] = value
+            elif " " in token:
+                phrases.append(token)
+            else:
+                terms.extend(words(token))
+        since = until = None
+        if "since" in options:
+            since = time.mktime(time.strptime(options["since"], "%Y-%m-%d"))
+        if "until" in options:
+            # until a date includes the whole of that day
+            until = time.mktime(time.strptime(options["until"], "%Y-%m-%d")) + 86400
+        return self.search(terms, phrases, options.get("by"), since, until, limit, reader, languages)
+
+    def close(self):
+        with self.lock:
+            for segment in self.segments:
+                segment.close()
+            self.docs.close()
+            self.texts.close()
+
+
+def render(result):
+    stamp, speaker, text = result
+    return time.strftime("[%Y-%m-%d %H:%M] ", time.localtime(stamp)) + text
+
+
+_line = re.compile(r"^\[(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)\] (.*)$")
+
+
+def build(transcripts, directory):
+    """
+    Index transcripts written before indexing was turned on. Transcripts
+    don't say who spoke, where, or in what language, so these messages
+    can't be searched by:, and players will find them wherever they are.
+    """
+    target = Index(directory)
+    count = 0
+    for path in sorted(glob.glob(os.path.join(transcripts, "transcript-*"))):
+        if path.endswith(".gz"):
+            f = gzip.open(path, "rb")
+        else:
+            f = open(path, "rb")
+        message = None
+        for line in f:
+            line = line.rstrip("\n")
+            match = _line.match(line)
+            if match is None and message is not None and line.startswith("  "):
+                message[1] += "\n" + line[2:]
+                continue
+            if message is not None:
+                target.add(message[0], None, message[1])
+                count += 1
+            message = None
+            if match is not None:
+                message = [time.mktime(time.strptime(match.group(1), "%Y-%m-%d %H:%M:%S")), match.group(2)]
+        if message is not None:
+            target.add(message[0], None, message[1])
+            count += 1
+        f.close()
+        target.commit()
+    target.close()
+    print "history: Indexed " + str(count) + " messages."
+
+
+def main():
+    argv = sys.argv[1:]
+    if len(argv) >= 3 and argv[0] == "search":
+        target = Index(argv[1])
+        start = time.time()
+        results = target.query(" ".join('"' + a + '"' if " " in a else a for a in argv[2:]), limit=50)
+        elapsed = time.time() - start
+        for result in reversed(results):
+            print render(result)
+        print "history: " + str(len(results)) + " results in " + ("%.1f" % (elapsed * 1000)) + "ms."
+        target.close()
+    elif len(argv) == 3 and argv[0] == "build":
+        build(argv[1], argv[2])
+    else:
+        print "usage: python history.py search <index directory> <query>"
+        print "       python history.py build <transcript directory> <index directory>"
+
+
+if __name__ == '__main__':
+    main()
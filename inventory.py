@@ -0,0 +1,95 @@
+class Bag(object):
+    """
+    A counted multiset of items. Forty arrows are one entry with a count of
+    forty, so adding, removing and counting cost the same however full the
+    bag gets.
+    """
+
+    __slots__ = ("counts",)
+
+    def __init__(self, counts=None):
+        self.counts = {}
+        if counts is not None:
+            for item in counts:
+                self.add(item, counts[item])
+
+    def add(self, item, quantity=1):
+        if quantity > 0:
+            self.counts[item] = self.counts.get(item, 0) + quantity
+
+    def remove(self, item, quantity=1):
+        """Take up to quantity of an item out. Returns how many were taken."""
+        held = self.counts.get(item, 0)
+        taken = min(held, quantity)
+        if taken == held:
+            self.counts.pop(item, None)
+        else:
+            self.counts[item] = held - taken
+        return taken
+
+    def count(self, item):
+        return self.counts.get(item, 0)
+
+    def clear(self):
+        self.counts.clear()
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def serialize(self):
+        """item -> count, the form bags are stored in"""
+        return dict(self.counts)
+
+    def __contains__(self, item):
+        return item in self.counts
+
+    def __iter__(self):
+        return iter(sorted(self.counts))
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __str__(self):
+        if len(self.counts) == 0:
+            return "(empty)"
+        entries = []
+        for item in sorted(self.counts):
+            if self.counts[item] == 1:
+                entries.append(item)
+            else:
+                entries.append(str(self.counts[item]) + " " + item)
+        return ", ".join(entries)
+
+
+def load(stored):
+    """A Bag from its stored form, or from a list of items as bags used to be"""
+    if isinstance(stored, dict):
+        return Bag(stored)
+    ret = Bag()
+    for item in stored:
+        ret.add(item)
+    return ret
+
+
+def loadAll(stored):
+    ret = {}
+    for tag in stored:
+        ret[tag] = load(stored[tag])
+    return ret
+
+
+def parseItems(tokens):
+    """
+    Read "[quantity] item" pairs, so "40 arrows 2 torches rope" is forty
+    arrows, two torches and a rope. Returns a list of (item, quantity).
+    """
+    ret = []
+    quantity = 1
+    for token in tokens:
+        if token.isdigit():
+            quantity = int(token)
+            continue
+        if quantity > 0:
+            ret.append((token, quantity))
+        quantity = 1
+    return ret
@@ -0,0 +1,165 @@
+import threading
+
+import inventory
+
+
+class Party(object):
+    """
+    Tallies and bags shared by everyone in the session, such as party gold
+    or a shared pool of hit points.
+
+    Writers take the lock, build a changed copy and swap it in. Readers just
+    take whatever tallies or bags are current, without locking, and always
+    see a whole update or none of it. Nothing read from here may be changed
+    in place.
+    """
+
+    __slots__ = ("lock", "tallies", "bags")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tallies = {}
+        self.bags = {}
+
+    def _setTally(self, tag, value):
+        tallies = dict(self.tallies)
+        if value is None:
+            del tallies[tag]
+        else:
+            tallies[tag] = value
+        self.tallies = tallies
+
+    def _setBag(self, tag, contents):
+        bags = dict(self.bags)
+        if contents is None:
+            del bags[tag]
+        else:
+            bags[tag] = contents
+        self.bags = bags
+
+    def createTally(self, tag, value=0):
+        with self.lock:
+            if tag in self.tallies:
+                return False
+            self._setTally(tag, value)
+            return True
+
+    def destroyTally(self, tag):
+        with self.lock:
+            if tag not in self.tallies:
+                return False
+            self._setTally(tag, None)
+            return True
+
+    def increment(self, tag, amount=1):
+        """Add to a tally. Returns the new value, or None if there is no such tally."""
+        with self.lock:
+            if tag not in self.tallies:
+                return None
+            value = self.tallies[tag] + amount
+            self._setTally(tag, value)
+            return value
+
+    def compareAndSet(self, tag, expected, value):
+        """
+        Set a tally only if it still holds what the caller last saw. Returns
+        (whether it was set, the value it holds now).
+        """
+        with self.lock:
+            if tag not in self.tallies:
+                return False, None
+            if self.tallies[tag] != expected:
+                return False, self.tallies[tag]
+            self._setTally(tag, value)
+            return True, value
+
+    def createBag(self, tag):
+        with self.lock:
+            if tag in self.bags:
+                return False
+            self._setBag(tag, inventory.Bag())
+            return True
+
+    def destroyBag(self, tag):
+        with self.lock:
+            if tag not in self.bags:
+                return False
+            self._setBag(tag, None)
+            return True
+
+    def addItems(self, tag, items):
+        """Add (item, quantity) pairs to a bag. False if there is no such bag."""
+        with self.lock:
+            if tag not in self.bags:
+                return False
+            contents = inventory.Bag(self.bags[tag].counts)
+            for item, quantity in items:
+                contents.add(item, quantity)
+            self._setBag(tag, contents)
+            return True
+
+    def removeItems(self, tag, items):
+        """Take (item, quantity) pairs out of a bag. Returns what was taken, or None."""
+        with self.lock:
+            if tag not in self.bags:
+                return None
+            contents = inventory.Bag(self.bags[tag].counts)
+            taken = inventory.Bag()
+            for item, quantity in items:
+                taken.add(item, contents.remove(item, quantity))
+            self._setBag(tag, contents)
+            return taken
+
+    def transferTally(self, e, tag, amount):
+        """
+        Move an amount from a player's tally to the shared one of the same
+        name, or back again with a negative amount. The player's tally is
+        made if they lack it. Returns (their value, the shared value), or
+        None if there is no such shared tally.
+        """
+        with self.lock:
+            if tag not in self.tallies:
+                return None
+            if tag not in e.tallies:
+                if amount > 0:
+                    return None
+                e.tallies[tag] = 0
+            e.tallies[tag] -= amount
+            self._setTally(tag, self.tallies[tag] + amount)
+            return e.tallies[tag], self.tallies[tag]
+
+    def transferItems(self, e, tag, items, shared=True):
+        """
+        Move items from a player's bag into the shared bag of the same name,
+        or with shared=False, out of it into theirs. Returns what was moved,
+        or None if either bag is missing.
+        """
+        with self.lock:
+            if tag not in self.bags:
+                return None
+            if tag not in e.bags:
+                if shared:
+                    return None
+                e.bags[tag] = inventory.Bag()
+            contents = inventory.Bag(self.bags[tag].counts)
+            source, target = e.bags[tag], contents
+            if not shared:
+                source, target = contents, e.bags[tag]
+            moved = inventory.Bag()
+            for item, quantity in items:
+                taken = source.remove(item, quantity)
+                target.add(item, taken)
+                moved.add(item, taken)
+            self._setBag(tag, contents)
+            e.markDirty("bags")
+            return moved
+
+    def snapshot(self):
+        bags = self.bags
+        return {"tallies": dict(self.tallies),
+                "bags": dict((tag, bags[tag].serialize()) for tag in bags)}
+
+    def load(self, state):
+        with self.lock:
+            self.tallies = dict(state["tallies"])
+            self.bags = inventory.loadAll(state["bags"])
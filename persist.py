@@ -1,51 +1,207 @@
-import json
 import os
+import gzip
+import json
 import entity
+import inventory
 import hashlib
+import hmac
 import uuid
+import threading
+import traceback
+import multiprocessing
+import storage
+
+from multiprocessing.pool import ThreadPool
 
 """
 Because this is so light-weight, and subject to change, things will be stored
-in a specific directory as JSON. This way, entries can be hand-modified if
-this program changes, and requires no external packages.
+in a specific directory as JSON by default. This way, entries can be
+hand-modified if this program changes, and requires no external packages.
+Where profiles actually live is up to the backend, see storage.py.
+
+The large fields in entity.LAZY, the facade and bags, are stored apart from
+the rest of the profile. Loading a profile leaves them out, and they are
+read the first time something uses them, so a long backstory costs nothing
+until someone examines its owner.
+
+Most saves go through queueSave, which marks the entity dirty and leaves the
+write to a background Saver. The Saver writes each dirty profile at most once
+per interval, so a burst of alias or configure changes costs a single write.
 """
 
+# Seconds between background flushes of dirty profiles
+SAVE_INTERVAL = 5.0
+
+# Which backend to use, see storage.openStore. "journal+json:./profiles/"
+# turns saves into small appends that are folded in the background, and
+# "sharded:./profiles/" spreads a large community over hashed subdirectories.
+STORE = storage.DEFAULT_SPEC
+
+# "json", or "binary" for smaller, faster profiles that can't be hand-edited
+ENCODING = "json"
+
+# Ask the backend to sync every write to disk
+FSYNC = False
+
+# Have the Saver write its batch first and sync it together, rather than
+# paying for one sync per profile
+GROUP_COMMIT = True
+
+# PBKDF2-SHA512 rounds for new password hashes. Raising it is safe: older
+# hashes still verify, and are redone at the new cost on the next login.
+# profiletool.py kdfbench shows what each setting costs in logins per second.
+KDF_ITERATIONS = 100000
+
+# Password hashes computed at once. Logins past this many wait their turn
+# instead of starving everything else of CPU.
+KDF_WORKERS = 2
+
+# Where the backup command writes its archives
+BACKUP_DIRECTORY = "./backups/"
+
+# Records checked and written per batch during an import. Only one batch is
+# in memory at a time, however large the archive.
+IMPORT_BATCH = 500
+
+# What a profile needs, and of which type, to be accepted by an import
+REQUIRED = {"hcode": basestring, "salt": basestring, "tallies": dict,
+            "dm": bool, "spectator": bool, "languages": list,
+            "aliases": dict, "settings": dict, "aspects": list}
+
+# What a lazy field is when the store has nothing for it
+LAZY_DEFAULTS = {"facade": lambda: None, "bags": dict}
+
+# The profile store, set up by initializeProfiles
+backend = None
+
+# Lowercased name -> name as stored, for every profile in the backend. Built
+# once at startup so logins and saves never have to ask the store. A process
+# reading a store another one writes, like the relay, may miss profiles made
+# since; resolveName asks the store about those and adds them.
+index = {}
+
+# Runs password hashing, started on first use
+kdf_pool = None
+
+# The running Saver, if any. Without one, queueSave writes immediately.
+saver = None
+
+stats = {"requested": 0, "written": 0, "avoided": 0}
 
-def initializeProfiles():
-    if not os.path.exists("./profiles/"):
-        os.mkdir("profiles")
+
+def initializeProfiles(spec=None, readonly=False):
+    """
+    Open the profile store. A read-only store is for another process, like
+    the relay, that reads profiles the server keeps: it never cleans up,
+    migrates or compacts what the server is writing.
+    """
+    global backend
+    if backend is not None:
+        backend.close()
+    backend = storage.openStore(spec or STORE, fsync=FSYNC, encoding=ENCODING)
+    backend.initialize(readonly=readonly)
+
+    index.clear()
+    for name in backend.names():
+        index[name.lower()] = name
 
 
 def profileExists(username):
-    return os.path.exists("./profiles/" + username + ".json")
+    return resolveName(username) is not None
+
+
+def resolveName(username):
+    """The stored spelling of a profile name, whatever case it was typed in"""
+    name = index.get(username.lower())
+    if name is None and backend is not None and backend.exists(username):
+        # made since the index was built, by whoever else writes the store
+        name = index.setdefault(username.lower(), username)
+    return name
+
 
+def deleteProfile(username):
+    name = resolveName(username)
+    if name is None:
+        return False
+    backend.delete(name)
+    del index[name.lower()]
+    return True
+
+
+def _kdf(password, salt, iterations):
+    global kdf_pool
+    if kdf_pool is None:
+        kdf_pool = ThreadPool(KDF_WORKERS)
+    # salts come back from JSON as unicode, which hashes differently
+    if isinstance(password, unicode):
+        password = password.encode("utf-8")
+    if isinstance(salt, unicode):
+        salt = salt.encode("utf-8")
+    return kdf_pool.apply(hashlib.pbkdf2_hmac, ("sha512", password, salt, iterations)).encode("hex")
 
-def hashPassword(password, salt=None):
+
+def hashPassword(password, salt=None, iterations=None):
+    """
+    Hash a password for storage. The hash records how it was made,
+    "pbkdf2_sha512$<iterations>$<hex digest>", so the cost can change later.
+    """
     if salt is None:
         salt = uuid.uuid4().hex
-    return salt, hashlib.sha512(password + salt).hexdigest()
+    if iterations is None:
+        iterations = KDF_ITERATIONS
+    return salt, "pbkdf2_sha512$" + str(iterations) + "$" + _kdf(password, salt, iterations)
 
 
-def validate(username, password):
-    if not profileExists(username):
+def checkPassword(hcode, salt, password):
+    if "$" not in hcode:
+        # profiles from before PBKDF2, a single salted SHA-512
+        attempt = hashlib.sha512(password + salt).hexdigest()
+    else:
+        iterations = int(hcode.split("$")[1])
+        salt, attempt = hashPassword(password, salt=salt, iterations=iterations)
+    return hmac.compare_digest(str(hcode), str(attempt))
+
+
+def needsRehash(hcode):
+    """Was this hash made the old way, or at a lower cost than we use now"""
+    if "$" not in hcode:
+        return True
+    return int(hcode.split("$")[1]) < KDF_ITERATIONS
+
+
+def upgradePassword(e, password):
+    """
+    After a successful login, redo a legacy or cheaper hash at the current
+    cost. The player never notices, besides one more hash at login.
+    """
+    if not needsRehash(e.hcode):
         return False
+    e.salt, e.hcode = hashPassword(password)
+    queueSave(e, "hcode", "salt")
+    return True
 
-    f = open("./profiles/" + username + ".json")
-    j = f.read().strip()
-    f.close()
-    data = json.loads(j)
-    hcode = data["hcode"]
-    salt = data["salt"]
 
-    salt, hcode_attempt = hashPassword(password, salt=salt)
+def validate(username, password):
+    name = resolveName(username)
+    if name is None:
+        return False
+    data = backend.load(name)
+    if data is None:
+        return False
 
-    return hcode == hcode_attempt
+    return checkPassword(data["hcode"], data["salt"], password)
 
 
-def saveEntity(e):
-    if profileExists(e.name):
-        os.remove("./profiles/" + e.name + ".json")
-    f = open("./profiles/" + e.name + ".json", "w")
+def _serialize(e):
+    """
+    The profile data for an entity, and the lazy fields to store beside it.
+    Only lazy fields marked dirty are included; the rest are already in the
+    store as they are.
+    """
+    # Take copies first, the dispatcher may be changing these while we write
+    tallies = dict(e.tallies)
+    changed = set(e.dirty)
+    e.dirty.clear()
 
     data = {}
     data["name"] = e.name
@@ -53,53 +209,371 @@ def saveEntity(e):
     data["salt"] = e.salt
 
     tally_data = {}
-    for key in e.tallies:
+    for key in tallies:
         if key in e.tallies_persist:
-            tally_data[key] = e.tallies[key]
+            tally_data[key] = tallies[key]
     data["tallies"] = tally_data
 
-    bag_data = {}
-    for key in e.bags:
-        if key in e.bags_persist:
-            bag_data[key] = e.bags[key]
-    data["bags"] = bag_data
+    fields = {}
+    if "bags" in changed and e.isLoaded("bags"):
+        bags = dict(e.bags)
+        bag_data = {}
+        for key in bags:
+            if key in e.bags_persist:
+                bag_data[key] = bags[key].serialize()
+        fields["bags"] = bag_data
+    if "facade" in changed and e.isLoaded("facade"):
+        fields["facade"] = e.facade
+    data["lazy"] = list(entity.LAZY)
+    data["bag_names"] = list(e.bags_persist)
 
-    data["facade"] = e.facade
     data["dm"] = e.dm
     data["spectator"] = e.spectator
 
-    data["languages"] = e.languages
-    data["aliases"] = e.aliases
-    data["settings"] = e.settings
+    data["languages"] = list(e.languages)
+    data["aliases"] = dict(e.aliases)
+    data["settings"] = dict(e.settings)
 
-    data["aspects"] = e.aspects
+    data["aspects"] = list(e.aspects)
 
-    f.write(json.dumps(data))
-    f.close()
+    return data, fields
 
 
-def loadEntity(username):
-    if not profileExists(username):
-        raise IOError("Cannot load non-existing json for profile " + entity.name)
+def _saveFields(name, fields):
+    for field in fields:
+        backend.saveField(name, field, fields[field])
 
-    f = open("./profiles/" + username + ".json")
-    j = f.read().strip()
-    f.close()
-    data = json.loads(j)
 
-    e = entity.Entity(name=username)
+def saveEntity(e):
+    data, fields = _serialize(e)
+    try:
+        # fields first, so a profile never names a field that was not written
+        _saveFields(e.name, fields)
+        backend.save(e.name, data)
+    except:
+        # nothing was saved, so everything is still to be
+        e.markDirty()
+        raise
+    index.setdefault(e.name.lower(), e.name)
+    stats["written"] += 1
+
+
+def saveEntities(entities):
+    """
+    Write a batch of entities in one go, so the backend can commit them
+    together. Returns the entities that could not be written.
+    """
+    items = []
+    failed = []
+    for e in entities:
+        try:
+            data, fields = _serialize(e)
+            _saveFields(e.name, fields)
+            items.append((e.name, data))
+        except:
+            print "Server: Exception thrown while saving " + e.name + "'s profile."
+            e.markDirty()
+            failed.append(e)
+    try:
+        backend.saveMany(items)
+    except:
+        print "Server: Exception thrown while saving a batch of " + str(len(items)) + " profiles."
+        print traceback.format_exc()
+        for e in entities:
+            e.markDirty()
+        return failed + [e for e in entities if e not in failed]
+    for name, data in items:
+        index.setdefault(name.lower(), name)
+    stats["written"] += len(items)
+    return failed
+
+
+def queueSave(e, *fields):
+    """
+    Mark fields of an entity as changed and have the Saver write it later.
+    With no fields given, the whole profile is considered changed.
+    """
+    e.markDirty(*fields)
+    stats["requested"] += 1
+    if saver is None or not saver.running:
+        saveEntity(e)
+    else:
+        saver.enqueue(e)
+
+
+def flushEntity(e):
+    """
+    Write an entity right away, dropping any pending background save. While
+    the Saver is held for an export, the entity is queued behind it instead.
+    """
+    if saver is not None:
+        if saver.held > 0:
+            saver.enqueue(e)
+            return
+        saver.discard(e)
+    saveEntity(e)
+
+
+def flushAll():
+    if saver is not None:
+        saver.flush()
+
+
+class Saver(threading.Thread):
+
+    __slots__ = ("pending", "lock", "running", "interval", "wakeup", "held")
+
+    def __init__(self, interval=SAVE_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        # set here rather than in run, so saves queued before the thread is
+        # scheduled still go through the background path
+        self.running = True
+        # while above zero, saves pile up in pending instead of being written
+        self.held = 0
+
+    def enqueue(self, e):
+        with self.lock:
+            if e.name.lower() in self.pending:
+                stats["avoided"] += 1
+            self.pending[e.name.lower()] = e
+
+    def discard(self, e):
+        with self.lock:
+            if e.name.lower() in self.pending:
+                del self.pending[e.name.lower()]
+
+    def hold(self):
+        """Stop writing to the store, without refusing any saves"""
+        with self.lock:
+            self.held += 1
+
+    def release(self):
+        with self.lock:
+            self.held = max(0, self.held - 1)
+        self.wakeup.set()
+
+    def requeue(self, entities):
+        """Put back saves that failed, behind any newer ones queued since"""
+        with self.lock:
+            for e in entities:
+                self.pending.setdefault(e.name.lower(), e)
+
+    def flush(self, force=False):
+        with self.lock:
+            if self.held > 0 and not force:
+                return
+            batch = self.pending.values()
+            self.pending = {}
+        if GROUP_COMMIT:
+            self.requeue(saveEntities(batch))
+            return
+        failed = []
+        for e in batch:
+            try:
+                saveEntity(e)
+            except:
+                print "Server: Exception thrown while saving " + e.name + "'s profile."
+                failed.append(e)
+        self.requeue(failed)
+
+    def kill(self):
+        self.running = False
+        self.wakeup.set()
+        self.flush(force=True)
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            if not self.running:
+                break
+            # the thread must outlive any one bad save, or nothing is
+            # written again while running still says otherwise
+            try:
+                self.flush()
+            except:
+                print "Server: An error has occured in the Saver."
+                print traceback.format_exc()
+
+
+def _openArchive(path, mode, compressed):
+    if compressed:
+        return gzip.open(path, mode + "b")
+    return open(path, mode + "b")
+
+
+def exportProfiles(path):
+    """
+    Write every profile, lazy fields and all, to a JSON Lines archive, one
+    profile per line, gzipped if the path ends in .gz. Profiles are streamed
+    one at a time. The Saver and any journal Compactor are held for the
+    duration, so the archive shows the store at a single point; saves queue
+    up meanwhile and are written once it is done. Returns how many profiles
+    were written.
+    """
+    compactor = getattr(backend, "compactor", None)
+    if saver is not None:
+        saver.hold()
+    if compactor is not None:
+        compactor.hold()
+    try:
+        temp = path + ".tmp." + uuid.uuid4().hex
+        out = _openArchive(temp, "w", path.endswith(".gz"))
+        count = 0
+        try:
+            for name in list(backend.names()):
+                data = backend.load(name)
+                if data is None:
+                    continue
+                fields = {}
+                for field in data.get("lazy", []):
+                    value = backend.loadField(name, field)
+                    if value is not None:
+                        fields[field] = value
+                out.write(json.dumps({"name": name, "data": data, "fields": fields}) + "\n")
+                count += 1
+        finally:
+            out.close()
+        if os.name == "nt" and os.path.exists(path):
+            os.remove(path)
+        os.rename(temp, path)
+    finally:
+        if compactor is not None:
+            compactor.release()
+        if saver is not None:
+            saver.release()
+    return count
+
+
+def checkRecord(line):
+    """
+    Parse and check one archive line. Returns (name, data, fields), or an
+    error message. Runs in the import's worker processes.
+    """
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return "not valid JSON"
+    if not isinstance(record, dict) or not isinstance(record.get("data"), dict):
+        return "not a profile record"
+    name = record.get("name")
+    data = record["data"]
+    if not isinstance(name, basestring) or len(name.split()) != 1:
+        return "bad profile name"
+    for field in REQUIRED:
+        if not isinstance(data.get(field), REQUIRED[field]):
+            return name + ": missing or malformed " + field
+    fields = record.get("fields", {})
+    if not isinstance(fields, dict):
+        return name + ": malformed fields"
+    for field in data.get("lazy", []):
+        if field not in entity.LAZY:
+            return name + ": unknown lazy field " + field
+    return name, data, fields
+
+
+def importProfiles(path, workers=None):
+    """
+    Load every profile in an archive made by exportProfiles into the store,
+    replacing profiles of the same name. Lines are checked in parallel by a
+    pool of worker processes, IMPORT_BATCH at a time, and each batch is
+    written with a single saveMany. Returns (imported, rejected).
+    """
+    pool = multiprocessing.Pool(workers)
+    archive = _openArchive(path, "r", path.endswith(".gz"))
+    imported = 0
+    rejected = 0
+    number = 0
+    try:
+        while True:
+            lines = []
+            for line in archive:
+                lines.append(line)
+                if len(lines) >= IMPORT_BATCH:
+                    break
+            if len(lines) == 0:
+                break
+
+            items = []
+            for result in pool.map(checkRecord, lines):
+                number += 1
+                if isinstance(result, basestring):
+                    print "import: Skipped line " + str(number) + ", " + result + "."
+                    rejected += 1
+                    continue
+                name, data, fields = result
+                for field in fields:
+                    backend.saveField(name, field, fields[field])
+                items.append((name, data))
+            backend.saveMany(items)
+            for name, data in items:
+                index[name.lower()] = name
+            imported += len(items)
+    finally:
+        archive.close()
+        pool.close()
+        pool.join()
+    return imported, rejected
+
+
+def startSaver(interval=SAVE_INTERVAL):
+    global saver
+    saver = Saver(interval)
+    saver.start()
+    return saver
+
+
+def _loadField(name, field):
+    value = backend.loadField(name, field)
+    if value is None:
+        return LAZY_DEFAULTS[field]()
+    if field == "bags":
+        return inventory.loadAll(value)
+    return value
+
+
+def loadEntity(username):
+    name = resolveName(username)
+    data = None
+    if name is not None:
+        data = backend.load(name)
+    if data is None:
+        raise IOError("Cannot load non-existing profile " + username)
+
+    e = entity.Entity(name=name)
     e.tallies = data["tallies"]
     e.tallies_persist = e.tallies.keys()
-    e.bags = data["bags"]
-    e.bags_persist = e.bags.keys()
     e.hcode = data["hcode"]
     e.salt = data["salt"]
     e.dm = data["dm"]
     e.spectator = data["spectator"]
-    e.facade = data["facade"]
+
+    lazy = data.get("lazy", [])
+    e.loader = lambda field: _loadField(name, field)
+    for field in entity.LAZY:
+        if field in lazy:
+            setattr(e, "_" + field, entity.UNLOADED)
+        else:
+            # profiles from before lazy fields keep them inline
+            setattr(e, field, data.get(field, LAZY_DEFAULTS[field]()))
+    if e.isLoaded("bags"):
+        e.bags = inventory.loadAll(e.bags)
+    if "bag_names" in data:
+        e.bags_persist = list(data["bag_names"])
+    else:
+        e.bags_persist = e.bags.keys()
+
     e.languages = data["languages"]
     e.aliases = data["aliases"]
     e.settings = data["settings"]
     e.aspects = data["aspects"]
 
+    # as it is in the store, except fields still kept inline from before
+    # lazy fields, which the next save moves out
+    e.dirty = set(field for field in entity.LAZY if field not in lazy)
     return e
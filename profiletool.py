@@ -0,0 +1,232 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+
+import storage
+import persist
+
+"""
+Offline maintenance for the profile store. Stop the server first.
+"""
+
+USAGE = """usage: python profiletool.py <command> [arguments]
+
+Commands:
+    migrate <from> <to>     copy every profile from one store to another,
+                            e.g. migrate json:./profiles/ sqlite:profiles.db
+    convert <store> <json|binary>
+                            rewrite every profile in the given encoding
+    export <store> <archive>
+                            write every profile to a JSON Lines archive,
+                            gzipped if it ends in .gz
+    import <store> <archive>
+                            load every profile in an archive into a store
+    shard <directory> [flat|sharded]
+                            move every profile in a json directory into
+                            hashed subdirectories (or back out of them)
+    bench [count]           compare load/save time and disk size of the
+                            json and binary encodings on synthetic profiles
+    kdfbench [logins]       time password checks at a range of PBKDF2 costs,
+                            with KDF_WORKERS logins running at once"""
+
+# Profiles copied per batch during a migration
+BATCH = 500
+
+
+def _copyFields(source, target, name, data):
+    """Copy the fields a profile keeps apart from itself, see persist"""
+    for field in data.get("lazy", []):
+        value = source.loadField(name, field)
+        if value is not None:
+            target.saveField(name, field, value)
+
+
+def migrate(source_spec, target_spec):
+    source = storage.openStore(source_spec)
+    target = storage.openStore(target_spec)
+    source.initialize()
+    target.initialize()
+
+    start = time.time()
+    copied = 0
+    batch = []
+    for name in source.names():
+        data = source.load(name)
+        if data is None:
+            continue
+        _copyFields(source, target, name, data)
+        batch.append((name, data))
+        if len(batch) >= BATCH:
+            target.saveMany(batch)
+            copied += len(batch)
+            batch = []
+            print "  migrate: " + str(copied) + " profiles copied..."
+    if len(batch) > 0:
+        target.saveMany(batch)
+        copied += len(batch)
+
+    source.close()
+    target.close()
+    print "migrate: Copied " + str(copied) + " profiles in " + ("%.2f" % (time.time() - start)) + "s."
+
+
+def convert(spec, encoding):
+    if encoding not in ("json", "binary"):
+        print "convert: The encoding must be json or binary."
+        sys.exit(2)
+    store = storage.openStore(spec, encoding=encoding)
+    store.initialize()
+
+    start = time.time()
+    converted = 0
+    for name in list(store.names()):
+        data = store.load(name)
+        if data is None:
+            continue
+        _copyFields(store, store, name, data)
+        store.save(name, data)
+        converted += 1
+    store.close()
+    print "convert: Rewrote " + str(converted) + " profiles as " + encoding + " in " + ("%.2f" % (time.time() - start)) + "s."
+
+
+def export(spec, path):
+    persist.initializeProfiles(spec)
+    start = time.time()
+    count = persist.exportProfiles(path)
+    persist.backend.close()
+    print "export: Wrote " + str(count) + " profiles to " + path + " in " + ("%.2f" % (time.time() - start)) + "s."
+
+
+def load(spec, path):
+    persist.initializeProfiles(spec)
+    start = time.time()
+    imported, rejected = persist.importProfiles(path)
+    persist.backend.close()
+    print "import: Loaded " + str(imported) + " profiles, skipped " + str(rejected) + ", in " + ("%.2f" % (time.time() - start)) + "s."
+
+
+def shard(directory, layout="sharded"):
+    if layout not in ("flat", "sharded"):
+        print "shard: The layout must be flat or sharded."
+        sys.exit(2)
+    store = storage.JsonDirectory(directory, sharded=(layout == "sharded"))
+    store.initialize(migrate=False)
+
+    start = time.time()
+    moved = 0
+    for path in store.misplaced():
+        if store.migrate(path):
+            moved += 1
+    store.close()
+    print "shard: Moved " + str(moved) + " profiles to the " + layout + " layout in " + ("%.2f" % (time.time() - start)) + "s."
+
+
+def _sampleProfile(i):
+    return {
+        "name": "Player" + str(i),
+        "hcode": "0" * 128,
+        "salt": "0" * 32,
+        "tallies": dict(("tally" + str(t), t) for t in range(40)),
+        "bags": dict(("bag" + str(b), ["item" + str(x) for x in range(50)]) for b in range(5)),
+        "facade": u"A long and storied past. " * 400,
+        "dm": False,
+        "spectator": False,
+        "languages": ["elven", "dwarven", "orcish"],
+        "aliases": dict(("a" + str(a), "say something " + str(a)) for a in range(20)),
+        "settings": {"cols": 80, "saywrap": True},
+        "aspects": ["Brave", "Stubborn", "Hunted by the crown"]
+    }
+
+
+def _diskSize(directory):
+    total = 0
+    for filename in os.listdir(directory):
+        total += os.path.getsize(os.path.join(directory, filename))
+    return total
+
+
+def bench(count="500"):
+    count = int(count)
+    profiles = [("Player" + str(i), _sampleProfile(i)) for i in range(count)]
+
+    print "bench: " + str(count) + " synthetic profiles, each with a 10kB facade"
+    print "  encoding     save (ms/profile)   load (ms/profile)   disk (bytes/profile)"
+    for encoding in ("json", "binary"):
+        directory = tempfile.mkdtemp(prefix="mushy-bench-")
+        try:
+            store = storage.JsonDirectory(directory, encoding=encoding)
+            store.initialize()
+
+            start = time.time()
+            for name, data in profiles:
+                store.save(name, data)
+            saved = time.time() - start
+
+            start = time.time()
+            for name, data in profiles:
+                store.load(name)
+            loaded = time.time() - start
+
+            size = _diskSize(directory)
+        finally:
+            shutil.rmtree(directory)
+        print "  %-12s %-19.3f %-19.3f %d" % (encoding, saved * 1000 / count, loaded * 1000 / count, size / count)
+
+
+def kdfbench(logins="20"):
+    logins = int(logins)
+    salt, unused = persist.hashPassword("warmup", iterations=1)
+
+    print "kdfbench: " + str(logins) + " logins per setting, " + str(persist.KDF_WORKERS) + " workers"
+    print "  iterations   ms/login (alone)   logins/s (concurrent)"
+    for iterations in (10000, 50000, 100000, 200000, 400000):
+        salt, hcode = persist.hashPassword("password", iterations=iterations)
+
+        start = time.time()
+        persist.checkPassword(hcode, salt, "password")
+        alone = time.time() - start
+
+        # as many logins at once as there are workers to take them
+        threads = []
+        for i in range(logins):
+            threads.append(threading.Thread(target=persist.checkPassword, args=(hcode, salt, "password")))
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        marker = "  (current)" if iterations == persist.KDF_ITERATIONS else ""
+        print "  %-12d %-18.1f %.1f%s" % (iterations, alone * 1000, logins / elapsed, marker)
+
+
+COMMANDS = {
+    "migrate": (migrate, 2),
+    "convert": (convert, 2),
+    "export": (export, 2),
+    "import": (load, 2),
+    "shard": (shard, 1),
+    "bench": (bench, 0),
+    "kdfbench": (kdfbench, 0)
+}
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+        print USAGE
+        sys.exit(2)
+
+    command, argc = COMMANDS[sys.argv[1]]
+    if len(sys.argv) - 2 < argc:
+        print USAGE
+        sys.exit(2)
+    command(*sys.argv[2:])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,443 @@
+import sys
+import json
+import time
+import socket
+import threading
+import traceback
+import collections
+import Queue
+
+import room
+import persist
+import admission
+import turnqueue
+
+from mushyutils import colorfy, wrap
+
+"""
+Spectator relays. The primary server runs an EventPublisher, which streams
+session events (broadcasts, scene changes, tracker changes, the roster) as
+JSON lines over a local socket. A relay process subscribes to that stream,
+keeps a mirror of the session, and serves read-only spectator logins on its
+own port. The primary never sees the spectators connected to a relay.
+
+usage: python relay.py <publisher port> [listen port] [--store <spec>]
+
+The relay checks passwords against the same profile store as the primary,
+so give it the same --store.
+"""
+
+# Number of recent events kept for subscribers that join late
+BACKLOG = 200
+
+
+class EventPublisher(threading.Thread):
+
+    def __init__(self, session, port, backlog=BACKLOG):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.session = session
+        self.port = port
+        self.socket = None
+        self.running = False
+        self.lock = threading.Lock()
+        self.backlog = collections.deque(maxlen=backlog)
+        self.subscribers = []
+
+    def publish(self, event):
+        """Session listener. Called on whichever thread changed the session."""
+        line = json.dumps(event) + "\n"
+        with self.lock:
+            self.backlog.append(line)
+            for subscriber in self.subscribers:
+                subscriber.push(line)
+
+    def drop(self, subscriber):
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+    def kill(self):
+        self.running = False
+        self.session.unsubscribe(self.publish)
+        try:
+            self.socket.close()
+        except:
+            pass
+        with self.lock:
+            for subscriber in self.subscribers:
+                subscriber.kill()
+            self.subscribers = []
+
+    def run(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('127.0.0.1', self.port))
+        self.socket.listen(5)
+        self.session.subscribe(self.publish)
+        self.running = True
+        print "  EventPublisher: Publishing session events on port " + str(self.port) + "."
+        while self.running:
+            try:
+                relay_socket, address = self.socket.accept()
+            except:
+                break
+            subscriber = Subscriber(relay_socket, self)
+            with self.lock:
+                # The backlog goes out before the snapshot so stale scene and
+                # tracker events are overwritten by the current state.
+                for line in self.backlog:
+                    subscriber.push(line)
+                snapshot = {"kind": "snapshot", "session": self.session.snapshot()}
+                subscriber.push(json.dumps(snapshot) + "\n")
+                self.subscribers.append(subscriber)
+            subscriber.start()
+            print "  EventPublisher: Relay subscribed from " + address[0] + "."
+        print "  EventPublisher: Done."
+
+
+class Subscriber(threading.Thread):
+    """
+    Writes events to a single relay. Each relay gets its own queue so a slow
+    relay never holds up the dispatcher.
+    """
+
+    def __init__(self, socket, publisher):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.socket = socket
+        self.publisher = publisher
+        self.queue = Queue.Queue()
+        self.running = False
+
+    def push(self, line):
+        self.queue.put(line)
+
+    def kill(self):
+        self.running = False
+        self.queue.put(None)
+
+    def run(self):
+        self.running = True
+        try:
+            while self.running:
+                line = self.queue.get()
+                if line is None:
+                    break
+                self.socket.sendall(line)
+        except:
+            print "  EventPublisher: Lost a relay subscriber."
+        finally:
+            self.running = False
+            self.publisher.drop(self)
+            try:
+                self.socket.close()
+            except:
+                pass
+
+
+class Relay(threading.Thread):
+    """
+    Subscribes to the primary's event stream and mirrors its session for
+    the spectators connected to this process.
+    """
+
+    def __init__(self, host, port, backlog=BACKLOG):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.host = host
+        self.port = port
+        self.lock = threading.Lock()
+        self.rooms = {}
+        self.lobby = None
+        self.tracker = turnqueue.TurnQueue()
+        self.players = []
+        self.recent = collections.deque(maxlen=backlog)
+        self.spectators = []
+        self.running = False
+
+    def join(self, spectator):
+        with self.lock:
+            self.spectators.append(spectator)
+            # in the lobby from the start, so they hear what is said there
+            self.locate(spectator)
+
+    def leave(self, spectator):
+        with self.lock:
+            if spectator in self.spectators:
+                self.spectators.remove(spectator)
+
+    def apply(self, event):
+        kind = event["kind"]
+        with self.lock:
+            if kind == "snapshot":
+                state = event["session"]
+                self._loadRooms(state["rooms"])
+                for layout in state["rooms"]:
+                    self._loadScene(layout["name"], layout["stage"])
+                self.lobby = state["lobby"].lower()
+                self._loadTracker(state["tracker"])
+                self.players = state["players"]
+                for spectator in self.spectators:
+                    self.locate(spectator)
+            elif kind == "rooms":
+                self._loadRooms(event["rooms"])
+                # anyone in a room that is gone goes back to the lobby
+                for spectator in self.spectators:
+                    self.locate(spectator)
+            elif kind == "scene":
+                self._loadScene(event["room"], event["scene"])
+            elif kind == "tracker":
+                self._loadTracker(event["tracker"])
+            elif kind == "who":
+                self.players = event["players"]
+            elif kind == "broadcast":
+                audience = event.get("rooms")
+                if audience is not None:
+                    audience = [name.lower() for name in audience]
+                self.recent.append((audience, event["text"]))
+                for spectator in self.spectators:
+                    if audience is None or spectator.room in audience:
+                        spectator.sendMessage(event["text"])
+
+    def locate(self, spectator):
+        if spectator.room not in self.rooms:
+            spectator.room = self.lobby
+        return self.rooms.get(spectator.room)
+
+    def _loadRooms(self, layouts):
+        current = {}
+        for layout in layouts:
+            key = layout["name"].lower()
+            mirror = self.rooms.get(key)
+            if mirror is None:
+                mirror = room.Room(layout["name"])
+            mirror.exits = set(layout["exits"])
+            current[key] = mirror
+        self.rooms = current
+
+    def _loadScene(self, name, scene):
+        key = name.lower()
+        if key not in self.rooms:
+            self.rooms[key] = room.Room(name)
+        stage = self.rooms[key].stage
+        stage.title = scene["title"]
+        stage.body = scene["body"]
+        stage.objects = scene["objects"]
+
+    def _loadTracker(self, tracker):
+        self.tracker.queue = [tuple(entry) for entry in tracker["queue"]]
+        self.tracker.order = tracker["order"]
+
+    def run(self):
+        self.running = True
+        stream = socket.create_connection((self.host, self.port))
+        print "Relay: Subscribed to the event stream on port " + str(self.port) + "."
+        reader = stream.makefile("r")
+        for line in reader:
+            if not self.running:
+                break
+            try:
+                self.apply(json.loads(line))
+            except:
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                traceback.print_exception(exc_type, exc_value, exc_traceback, limit=None, file=sys.stdout)
+        self.running = False
+        print "Relay: Event stream closed."
+        with self.lock:
+            for spectator in self.spectators:
+                spectator.sendMessage(colorfy("[SERVER] The session has ended.", "bright yellow"))
+                spectator.kill()
+
+
+class SpectatorProxy(threading.Thread):
+    """
+    A read-only connection served entirely by the relay.
+    """
+
+    def __init__(self, socket, relay, address):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.socket = socket
+        self.address = address
+        self.relay = relay
+        self.name = ""
+        self.room = None
+        self.running = False
+        # when the login gives up, see admission.LOGIN_TIMEOUT
+        self.deadline = None
+
+    def sendMessage(self, message):
+        try:
+            if isinstance(message, unicode):
+                message = message.encode("utf-8")
+            self.socket.send(message + "\n")
+        except:
+            self.kill()
+
+    def kill(self):
+        self.running = False
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+            self.socket.close()
+        except:
+            pass
+
+    def login(self):
+        self.socket.send("-- Welcome to Mushy (spectator relay) --\n")
+        self.socket.send("What is your name?\n")
+        username = admission.receive(self.socket, self.deadline).strip()
+        if len(username) < 1 or len(username.split()) != 1:
+            self.socket.send("Only use your first name!\n")
+            return False
+        username = username[0].upper() + username[1:]
+        if not persist.profileExists(username):
+            self.socket.send("Relays only accept existing profiles.\n")
+            return False
+        username = persist.resolveName(username)
+        self.socket.send("Enter in your password:\n")
+        password = admission.receive(self.socket, self.deadline).strip()
+        refusal = admission.gate.attempt(self.address, username)
+        if refusal is not None:
+            self.socket.send(refusal + " Disconnected.\n")
+            return False
+        if not persist.validate(username, password):
+            admission.gate.failed(self.address, username)
+            self.socket.send("Incorrect password. Disconnected.\n")
+            return False
+        admission.gate.succeeded(self.address, username)
+        self.name = username
+        return True
+
+    def run(self):
+        self.running = True
+        try:
+            self.deadline = time.time() + admission.LOGIN_TIMEOUT
+            try:
+                admitted = self.login()
+            except socket.timeout:
+                self.sendMessage("Took too long to log in. Disconnected.")
+                admitted = False
+            finally:
+                admission.gate.release()
+            if not admitted:
+                self.kill()
+                return
+            self.socket.settimeout(None)
+            self.relay.join(self)
+            self.sendMessage(colorfy("[SERVER] You are spectating through a relay.", "bright yellow"))
+            self.sendMessage(colorfy("[SERVER] Commands: look [tag], go <room>, rooms, who, init, recap, logout", "bright green"))
+            while self.running:
+                data = self.socket.recv(4096)
+                if not data:
+                    break
+                tokens = data.strip().split()
+                if len(tokens) > 0:
+                    self.command(tokens)
+        except:
+            pass
+        finally:
+            self.relay.leave(self)
+            self.kill()
+
+    def command(self, tokens):
+        relay = self.relay
+        with relay.lock:
+            here = relay.locate(self)
+            if here is None:
+                self.sendMessage("The relay has not caught up with the session yet.")
+            elif tokens[0] == "look":
+                if len(tokens) == 1:
+                    scene = here.stage.viewScene()
+                    self.sendMessage(scene if scene != "" else "The scene is blank.")
+                else:
+                    description = here.stage.viewObject(tokens[1])
+                    if description == "":
+                        self.sendMessage('There is no "' + tokens[1] + '" in the scene.')
+                    else:
+                        self.sendMessage(description)
+            elif tokens[0] == "who":
+                msg = colorfy("Currently connected players:\n", "cyan")
+                for player in relay.players:
+                    name = colorfy(player["name"], "cyan")
+                    if player["dm"]:
+                        name = name + colorfy(" (DM)", "bright red")
+                    elif player["spectator"]:
+                        name = name + colorfy(" (S)", "bright yellow")
+                    msg = msg + "    " + name + "\n"
+                self.sendMessage(msg)
+            elif tokens[0] in ("init", "initiative"):
+                if len(relay.tracker.order) == 0:
+                    self.sendMessage("No ordering has been committed.")
+                else:
+                    self.sendMessage(str(relay.tracker))
+            elif tokens[0] == "go" and len(tokens) > 1:
+                if tokens[1].lower() in relay.rooms:
+                    self.room = tokens[1].lower()
+                    self.sendMessage("You go to " + colorfy(relay.rooms[self.room].name, "green") + ".")
+                else:
+                    self.sendMessage('There is no room called "' + tokens[1] + '".')
+            elif tokens[0] == "rooms":
+                names = [relay.rooms[key].name for key in sorted(relay.rooms)]
+                self.sendMessage("Rooms in this session: " + ", ".join(names))
+            elif tokens[0] == "recap":
+                for audience, text in relay.recent:
+                    if audience is None or self.room in audience:
+                        self.sendMessage(text)
+            elif tokens[0] in ("logout", "quit"):
+                self.sendMessage(colorfy("[SERVER] You have quit the relay.", "bright yellow"))
+                self.running = False
+            else:
+                self.sendMessage(wrap("Spectators on a relay may only use: look [tag], go <room>, rooms, who, init, recap, logout"))
+
+
+def main():
+    argv = sys.argv[1:]
+    store = None
+    if "--store" in argv:
+        i = argv.index("--store")
+        store = argv[i + 1]
+        argv = argv[:i] + argv[i + 2:]
+
+    if len(argv) < 1:
+        print "usage: python relay.py <publisher port> [listen port] [--store <spec>]"
+        return
+
+    publisher_port = int(argv[0])
+    listen_port = 8090
+    if len(argv) >= 2:
+        listen_port = int(argv[1])
+
+    # the server owns the store; the relay only reads it
+    persist.initializeProfiles(store, readonly=True)
+
+    relay = Relay('127.0.0.1', publisher_port)
+    relay.start()
+
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.bind(('', listen_port))
+    server_socket.listen(0)
+    print "Relay: Serving spectators on port " + str(listen_port) + ", press control+C to exit.\n"
+
+    try:
+        while relay.running or relay.is_alive():
+            client_socket, address = server_socket.accept()
+            refusal = admission.gate.connect(address[0])
+            if refusal is not None:
+                try:
+                    client_socket.send(refusal + "\n")
+                    client_socket.close()
+                except:
+                    pass
+                continue
+            print "Relay: Accepting spectator from " + address[0] + "..."
+            SpectatorProxy(client_socket, relay, address[0]).start()
+    except KeyboardInterrupt:
+        print ""
+    server_socket.close()
+    print "Relay: Bye!"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+import os
+import sys
+import time
+import tempfile
+import cStringIO
+
+import dice
+import entity
+import inventory
+import persist
+import session
+import commands
+import sessionlog
+import commandparser
+import functionmapper
+
+"""
+Re-runs a session log recorded with "server.py --record <path>" against a
+fresh session, at full speed, through an in-memory transport. Every byte
+sent to every connection is collected so runs can be compared exactly.
+
+usage: python replay.py <log> [--save <output>] [--expect <output>]
+
+    --save      write the collected output to a file
+    --expect    compare the collected output against a previous --save
+
+Profiles written during the replay go to a throwaway directory. Commands
+that open the editor are skipped, since the editor reads its own input.
+"""
+
+
+class MemorySocket(object):
+    """Just enough of a socket for ClientProxy and Entity.sendMessage"""
+
+    def __init__(self, name, output):
+        self.name = name
+        self.output = output
+
+    def send(self, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        self.output.write("[" + self.name + "] " + data)
+        return len(data)
+
+    def recv(self, size):
+        return ""
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
+
+
+class ReplayDispatcher(commandparser.Dispatcher):
+    """A Dispatcher that is drained by hand instead of running as a thread"""
+
+    def notify(self):
+        pass
+
+    def drain(self):
+        while len(self.queue) > 0:
+            self.dispatch(self.queue.pop())
+
+
+def _join(running_session, state, output):
+    e = entity.Entity(name=state["name"])
+    e.dm = state["dm"]
+    e.spectator = state["spectator"]
+    e.languages = state["languages"]
+    e.aliases = state["aliases"]
+    e.settings = state["settings"]
+    e.tallies = state["tallies"]
+    e.tallies_persist = e.tallies.keys()
+    # lazy fields nobody had read yet come later, as F records
+    e.bags = inventory.loadAll(state.get("bags", {}))
+    e.bags_persist = e.bags.keys()
+    e.facade = state.get("facade")
+    e.aspects = state["aspects"]
+    e.hookProxy(entity.ClientProxy(MemorySocket(e.name, output)))
+    e.session = running_session
+    running_session.add(e)
+
+
+def replay(path):
+    """Returns (output bytes, commands run, commands skipped, seconds, diverged)"""
+    output = cStringIO.StringIO()
+    dispatcher = ReplayDispatcher()
+    parser = commandparser.CommandParser(dispatcher=dispatcher)
+    if parser.dispatcher is not dispatcher:
+        raise RuntimeError("The CommandParser was created before the replay started")
+
+    rng = sessionlog.ReplayRandom()
+    dice.rng = rng
+    running_session = session.Session()
+
+    ran = 0
+    skipped = 0
+    start = time.time()
+    for kind, timestamp, data in sessionlog.readLog(path):
+        if kind == "J":
+            _join(running_session, data, output)
+        elif kind == "L":
+            if data in running_session:
+                running_session.remove(running_session.connections[data.lower()])
+        elif kind == "F":
+            e = running_session.connections.get(data["name"].lower())
+            if e is None:
+                continue
+            if data["field"] == "bags":
+                e.bags = inventory.loadAll(data["value"])
+                e.bags_persist = e.bags.keys()
+            else:
+                setattr(e, data["field"], data["value"])
+        elif kind == "C":
+            actor, line, draws = data
+            rng.feed(draws)
+            name = line.strip().split(" ")[0]
+            if (actor.lower() not in running_session.connections or
+                    (name in functionmapper.commandFunctions and
+                     functionmapper.commandFunctions[name] in commands.INPUT_BLOCK)):
+                skipped += 1
+                continue
+            parser.parseLine(line, running_session.connections[actor.lower()])
+            dispatcher.drain()
+            ran += 1
+    elapsed = time.time() - start
+
+    return output.getvalue(), ran, skipped, elapsed, rng.diverged
+
+
+def main():
+    if len(sys.argv) < 2:
+        print "usage: python replay.py <log> [--save <output>] [--expect <output>]"
+        sys.exit(2)
+
+    log = os.path.abspath(sys.argv[1])
+    save = None
+    expect = None
+    if "--save" in sys.argv:
+        save = os.path.abspath(sys.argv[sys.argv.index("--save") + 1])
+    if "--expect" in sys.argv:
+        expect = os.path.abspath(sys.argv[sys.argv.index("--expect") + 1])
+
+    # keep the replay away from the real profiles
+    os.chdir(tempfile.mkdtemp(prefix="mushy-replay-"))
+    persist.initializeProfiles()
+
+    output, ran, skipped, elapsed, diverged = replay(log)
+
+    rate = ran / elapsed if elapsed > 0 else 0
+    print "Replay: " + str(ran) + " commands in " + ("%.3f" % elapsed) + "s (" + ("%.0f" % rate) + " commands/s)."
+    print "Replay: " + str(len(output)) + " bytes of output."
+    if skipped:
+        print "Replay: Skipped " + str(skipped) + " commands (editor, or actor not connected)."
+    if diverged:
+        print "Replay: Dice draws no longer line up with the log."
+
+    if save is not None:
+        f = open(save, "wb")
+        f.write(output)
+        f.close()
+        print "Replay: Output saved to " + save + "."
+
+    if expect is not None:
+        f = open(expect, "rb")
+        expected = f.read()
+        f.close()
+        if expected == output:
+            print "Replay: Output matches " + expect + "."
+        else:
+            i = 0
+            while i < min(len(expected), len(output)) and expected[i] == output[i]:
+                i += 1
+            print "Replay: Output differs from " + expect + " at byte " + str(i) + "."
+            print "  expected: " + repr(expected[i:i + 60])
+            print "  got:      " + repr(output[i:i + 60])
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
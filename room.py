@@ -0,0 +1,44 @@
+import stage
+
+
+class Room(object):
+    """
+    A named location with its own scene. Rooms know who is inside them, so
+    speech only has to visit the people who can actually hear it.
+    """
+
+    __slots__ = ("name", "stage", "occupants", "exits")
+
+    def __init__(self, name):
+        self.name = name
+        self.stage = stage.Stage()
+        self.occupants = {}
+        self.exits = set()
+
+    def enter(self, entity):
+        self.occupants[entity.name.lower()] = entity
+
+    def leave(self, entity):
+        key = entity.name.lower()
+        if key in self.occupants and self.occupants[key] is entity:
+            del self.occupants[key]
+
+    def link(self, other):
+        self.exits.add(other.name.lower())
+        other.exits.add(self.name.lower())
+
+    def unlink(self, other):
+        self.exits.discard(other.name.lower())
+        other.exits.discard(self.name.lower())
+
+    def snapshot(self):
+        return {"name": self.name, "stage": self.stage.snapshot(), "exits": sorted(self.exits)}
+
+    def __contains__(self, entity):
+        return entity.name.lower() in self.occupants
+
+    def __iter__(self):
+        return iter(self.occupants.values())
+
+    def __len__(self):
+        return len(self.occupants)
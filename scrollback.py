@@ -0,0 +1,106 @@
+import zlib
+import marshal
+import threading
+import collections
+
+"""
+What was said recently, so late joiners and players coming back from a
+dropped connection can catch up. The Scrollback listens to the session's
+broadcast events and keeps the newest ones as they are; every BLOCK of them
+is then compressed into a block of its own, and the oldest blocks fall off
+the end, so memory stays bounded however long the session runs.
+
+Speech in a language is kept along with what it sounded like to those who
+don't know the language, and readers are shown whichever they would have
+heard.
+"""
+
+# Messages per compressed block, and how many blocks to keep
+BLOCK = 50
+BLOCKS = 40
+
+# Most messages a recap will show at once
+RECAP_MAX = 200
+
+# Messages shown to someone joining the session
+RECAP_JOIN = 10
+
+
+class Scrollback(object):
+
+    __slots__ = ("lock", "current", "blocks", "sequence", "marks")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # [sequence, rooms, text, language, garbled text] entries not yet
+        # compressed, oldest first
+        self.current = []
+        # (first sequence, compressed entries), oldest first
+        self.blocks = collections.deque(maxlen=BLOCKS)
+        self.sequence = 0
+        # name.lower() -> the last sequence number a dropped player saw
+        self.marks = {}
+
+    def record(self, event):
+        """Session listener"""
+        if event["kind"] != "broadcast":
+            return
+        with self.lock:
+            self.sequence += 1
+            self.current.append([self.sequence, event.get("rooms"), event["text"],
+                                 event.get("language"), event.get("garbled")])
+            if len(self.current) >= BLOCK:
+                self.blocks.append((self.current[0][0], zlib.compress(marshal.dumps(self.current))))
+                self.current = []
+
+    def mark(self, name):
+        """Remember where a player dropped off, for catchUp"""
+        with self.lock:
+            self.marks[name.lower()] = self.sequence
+
+    def _entries(self, after, limit):
+        """Up to limit of the newest entries with a sequence past after, oldest first"""
+        with self.lock:
+            entries = [entry for entry in self.current if entry[0] > after]
+            blocks = list(self.blocks)
+        # only open as many old blocks as it takes
+        for first, packed in reversed(blocks):
+            if len(entries) >= limit or first + BLOCK <= after:
+                break
+            older = [entry for entry in marshal.loads(zlib.decompress(packed)) if entry[0] > after]
+            entries = older + entries
+        return entries
+
+    def recent(self, count, location=None, after=0, languages=()):
+        """
+        The text of the last count messages someone in the given room could
+        have heard, oldest first. Speech in a language not among languages
+        is shown as it sounded to those who don't know it; languages=None
+        understands everything, as spectators do.
+        """
+        count = min(count, RECAP_MAX)
+        if location is not None:
+            location = location.lower()
+        ret = []
+        # messages for other rooms are skipped, so fetch until there are enough
+        limit = count
+        while True:
+            entries = self._entries(after, limit)
+            ret = []
+            for sequence, rooms, text, language, garbled in entries:
+                if rooms is None or location is None or location in [r.lower() for r in rooms]:
+                    if language is not None and languages is not None and language not in languages:
+                        text = garbled
+                    ret.append(text)
+            if len(ret) >= count or len(entries) < limit:
+                break
+            limit = limit * 2
+        return ret[-count:]
+
+    def catchUp(self, name, location=None, languages=()):
+        """What a player missed since they dropped, or a short recap if they never did"""
+        with self.lock:
+            mark = self.marks.pop(name.lower(), None)
+        if mark is None:
+            return self.recent(RECAP_JOIN, location, languages=languages)
+        return self.recent(RECAP_MAX, location, after=mark, languages=languages)
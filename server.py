@@ -1,4 +1,6 @@
+import os
 import sys
+import time
 import traceback
 import socket
 import threading
@@ -7,18 +9,31 @@ import entity
 import persist
 import session
 import commandparser
+import relay
+import sessionlog
+import checkpoint
+import admission
+import transcript
+import history
+import helpindex
+import docstore
+import commands
+import functionmapper
 
 from mushyutils import colorfy, wrap
 
 
 class LoginProxy(threading.Thread):
 
-    def __init__(self, socket, session, proxy_pool):
+    def __init__(self, socket, session, proxy_pool, address):
         threading.Thread.__init__(self)
         self.socket = socket
+        self.address = address
         self.running = False
         self.session = session
         self.proxy_pool = proxy_pool
+        # when the login gives up, see admission.LOGIN_TIMEOUT
+        self.deadline = None
 
     def setEntity(self, entity):
         self.entity = entity
@@ -34,22 +49,99 @@ class LoginProxy(threading.Thread):
             pass
 
     def killClone(self, username):
-        if username in self.session:
-            clone = self.session.getEntity(username)
-            clone.proxy.kill()
+        clone = self.session.connections.get(username.lower())
+        if clone is not None:
+            # out of the session first, so its proxy does not take this for a drop
             del self.session.connections[username.lower()]
+            clone.proxy.kill()
+        return clone
+
+    def resume(self, token):
+        """The entity a resume token belongs to, taken over from any old connection"""
+        player = self.session.resume(token)
+        if player is not None and self.session.connections.get(player.name.lower()) is player:
+            self.killClone(player.name)
+        return player
+
+    def join(self, player, reconnected):
+        # logged in, so the connection may idle as long as it likes
+        self.socket.settimeout(None)
+
+        # hook up the proxy stuff
+        proxy = entity.ClientProxy(self.socket)
+        player.hookProxy(proxy)
+
+        # pick up where they were when the server last went down
+        checkpoint.reclaim(self.session, player)
+
+        # connect player to the session
+        player.session = self.session
+        self.session.add(player)
+
+        # start the proxy and notify everyone of the new connection
+        player.proxy.start()
+        player.sendMessage("")
+
+        # what they missed, in one block rather than message by message
+        languages = player.languages
+        if player.spectator:
+            languages = None
+        missed = self.session.scrollback.catchUp(player.name, self.session.locate(player).name, languages)
+
+        if reconnected:
+            self.session.broadcastExclude(colorfy("[SERVER] " + player.name + " has reconnected.", "bright yellow"), player)
+            player.sendMessage(colorfy("[SERVER] You have reconnected.", "bright yellow"))
+            if len(missed) > 0:
+                player.sendMessage(colorfy("------WHILE YOU WERE AWAY------", "cyan") + "\n" + "\n".join(missed))
+        else:
+            self.session.broadcastExclude(colorfy("[SERVER] " + player.name + " has joined the session.", "bright yellow"), player)
+            player.sendMessage(colorfy("[SERVER] You have joined the session.", "bright yellow"))
+            player.sendMessage(colorfy("[SERVER] You may type 'help' at any time for a list of commands.", 'bright green'))
+            
+            # Send them the newest changes as dictaded by the banner.txt file
+            try:
+                banner_file = open("banner.txt")
+                banner = banner_file.read()
+                if banner:
+                    player.sendMessage(colorfy("*"*80, "bright yellow"))
+                    player.sendMessage(wrap(banner))
+                    player.sendMessage(colorfy("*"*80, "bright yellow"))
+                    banner_file.close()
+            except IOError:
+                pass
+
+            if len(missed) > 0:
+                player.sendMessage(colorfy("------RECENTLY------", "cyan") + "\n" + "\n".join(missed))
+
+        # a way back in that skips the password, should the connection drop
+        token = self.session.issueToken(player)
+        player.sendMessage(colorfy("[SERVER] If you lose your connection, enter 'resume " + token +
+                                   "' at the name prompt within " + str(int(session.LINGER)) + " seconds.", "bright green"))
 
     def run(self):
         try:
             player = None
             self.running = True
+            self.deadline = time.time() + admission.LOGIN_TIMEOUT
             reconnected = False
             username = ""
             self.socket.send("-- Welcome to Mushy --\n")
             while len(username) < 1 or len(username.split()) != 1:
                 self.socket.send("What will you use for a name?\n")
-                username = self.socket.recv(4096).strip()
+                username = admission.receive(self.socket, self.deadline).strip()
                 self.socket.send("\n")
+
+                # someone who dropped, coming back with their resume token
+                tokens = username.split()
+                if len(tokens) == 2 and tokens[0].lower() == "resume":
+                    player = self.resume(tokens[1])
+                    if player is not None:
+                        self.join(player, True)
+                        return
+                    self.socket.send("That resume token is no longer valid. Log in with your name.\n")
+                    username = ""
+                    continue
+
                 # validate username
                 if len(username) < 1:
                     self.socket.send("Choose a REAL name!\n")
@@ -58,8 +150,10 @@ class LoginProxy(threading.Thread):
 
             username = username[0].upper() + username[1:]
 
-            # see if it is a new user or not
+            # see if it is a new user or not, names match whatever their case
             already_exists = persist.profileExists(username)
+            if already_exists:
+                username = persist.resolveName(username)
 
             # Grab the password
             password = ""
@@ -70,42 +164,57 @@ class LoginProxy(threading.Thread):
                 self.socket.send("Enter in your password:\n")
                 validated = False
                 while tries < 3 and not validated:
-                    password = self.socket.recv(4096).strip()
+                    password = admission.receive(self.socket, self.deadline).strip()
                     self.socket.send("\n")
+                    refusal = admission.gate.attempt(self.address, username)
+                    if refusal is not None:
+                        self.socket.send(refusal + " Disconnected.\n")
+                        self.kill()
+                        return
                     validated = persist.validate(username, password)
-                    if not validated and tries < 2:
-                        self.socket.send("Incorrect, try again:\n")
+                    if not validated:
+                        admission.gate.failed(self.address, username)
                         tries += 1
+                        if tries < 3:
+                            self.socket.send("Incorrect, try again:\n")
                 if not validated:
                     self.socket.send("Tried too many times. Disconnected.\n")
                     self.kill()
                     return
+                admission.gate.succeeded(self.address, username)
+
+                # they dropped a moment ago, and their entity is still warm
+                player = self.session.reclaim(username)
+                if player is not None:
+                    reconnected = True
 
                 # sanity check to make sure the player is not already connected
                 if username in self.session:
                     choice = ''
                     while not choice in ('y', 'n'):
                         self.socket.send("Another instance of you is already connected. Kick it and take its place? (y/n)\n")
-                        choice = self.socket.recv(4096).strip()
+                        choice = admission.receive(self.socket, self.deadline).strip()
                         self.socket.send("\n")
 
                         if choice.lower() == 'y':
                             reconnected = True
-                            self.killClone(username)
+                            player = self.killClone(username)
                         elif choice.lower() == 'n':
                             self.kill()
                             self.socket.send("Disconnecting.\n")
                             return
 
                 self.socket.send("Welcome back, " + username + ".\n")
-                player = persist.loadEntity(username)
+                if player is None:
+                    player = persist.loadEntity(username)
+                persist.upgradePassword(player, password)
 
             # player does not have a profile
             else:
                 self.socket.send("User " + username + " does not yet exist, creating a new user.\n")
                 while len(password) < 4:
                     self.socket.send("Enter in your password:\n")
-                    password = self.socket.recv(4096).strip()
+                    password = admission.receive(self.socket, self.deadline).strip()
                     self.socket.send("\n")
 
                     # length check
@@ -114,7 +223,7 @@ class LoginProxy(threading.Thread):
                         continue
                     repeat = ""
                     self.socket.send("Enter again to verify:\n")
-                    repeat = self.socket.recv(4096).strip()
+                    repeat = admission.receive(self.socket, self.deadline).strip()
                     self.socket.send("\n")
 
                     # repeat check
@@ -128,7 +237,7 @@ class LoginProxy(threading.Thread):
                 player = entity.Entity(name=username, hcode=hcode, salt=salt)
 
                 self.socket.send("Are you the DM for the group (y if yes)?\n")
-                choice = self.socket.recv(4096).strip()
+                choice = admission.receive(self.socket, self.deadline).strip()
                 self.socket.send("\n")
                 dm = False
                 if choice.lower() == 'y':
@@ -137,7 +246,7 @@ class LoginProxy(threading.Thread):
                 player.dm = dm
 
                 self.socket.send("Are you a spectator (y if yes)?\n")
-                choice = self.socket.recv(4096).strip()
+                choice = admission.receive(self.socket, self.deadline).strip()
                 self.socket.send("\n")
                 spectator = False
                 if choice.lower() == 'y':
@@ -148,37 +257,15 @@ class LoginProxy(threading.Thread):
                 self.socket.send("Profile created. Saving...\n")
                 persist.saveEntity(player)
 
-            # hook up the proxy stuff
-            proxy = entity.ClientProxy(self.socket)
-            player.hookProxy(proxy)
-
-            # connect player to the session
-            player.session = self.session
-            self.session.add(player)
-
-            # start the proxy and notify everyone of the new connection
-            player.proxy.start()
-            player.sendMessage("")
-
-            if reconnected:
-                self.session.broadcastExclude(colorfy("[SERVER] " + player.name + " has reconnected.", "bright yellow"), player)
-                player.sendMessage(colorfy("[SERVER] You have reconnected.", "bright yellow"))
-            else:
-                self.session.broadcastExclude(colorfy("[SERVER] " + player.name + " has joined the session.", "bright yellow"), player)
-                player.sendMessage(colorfy("[SERVER] You have joined the session.", "bright yellow"))
-                player.sendMessage(colorfy("[SERVER] You may type 'help' at any time for a list of commands.", 'bright green'))
-                
-                # Send them the newest changes as dictaded by the banner.txt file
-                try:
-                    banner_file = open("banner.txt")
-                    banner = banner_file.read()
-                    if banner:
-                        player.sendMessage(colorfy("*"*80, "bright yellow"))
-                        player.sendMessage(wrap(banner))
-                        player.sendMessage(colorfy("*"*80, "bright yellow"))
-                        banner_file.close()
-                except IOError:
-                    pass
+            self.join(player, reconnected)
+        except socket.timeout:
+            self.running = False
+            try:
+                self.socket.send("Took too long to log in. Disconnected.\n")
+            except:
+                pass
+            self.socket.close()
+            print "Server: Client connection closed. Login timed out."
         except:
             exc_type, exc_value, exc_traceback = sys.exc_info()
             traceback.print_exception(exc_type, exc_value, exc_traceback, limit=None, file=sys.stdout)
@@ -186,27 +273,112 @@ class LoginProxy(threading.Thread):
             self.socket.close()
             print "Server: Client connection closed. Exception during login."
         finally:
+            admission.gate.release()
             if self in self.proxy_pool:
                 self.proxy_pool.remove(self)
 
 
+def _option(argv, flag):
+    """Pull "flag value" out of the argument list"""
+    if flag not in argv:
+        return None, argv
+    i = argv.index(flag)
+    if i + 1 >= len(argv):
+        return None, argv[:i]
+    return argv[i + 1], argv[:i] + argv[i + 2:]
+
+
 def main():
     listen_port = 8080
-    if len(sys.argv) >= 2:
+    argv = sys.argv[1:]
+
+    # --publish <port> streams session events to relays
+    publish_port, argv = _option(argv, "--publish")
+    if publish_port is not None:
+        try:
+            publish_port = int(publish_port)
+        except:
+            print "Server: --publish needs a port number. Not publishing events."
+            publish_port = None
+
+    # --record <path> appends every command to a session log for replay.py
+    record_path, argv = _option(argv, "--record")
+
+    # --transcript <directory> keeps a log of everything said in the session,
+    # --plain leaves the colors out of it. Transcripts are indexed for the
+    # history command in an index directory beside them.
+    transcript_directory, argv = _option(argv, "--transcript")
+    plain = "--plain" in argv
+    if plain:
+        argv.remove("--plain")
+
+    # --store <spec> picks the profile backend, e.g. sqlite:profiles.db
+    store, argv = _option(argv, "--store")
+
+    # --checkpoint <path> is where session state is kept between restarts
+    checkpoint_path, argv = _option(argv, "--checkpoint")
+    if checkpoint_path is None:
+        checkpoint_path = checkpoint.CHECKPOINT_PATH
+
+    # --documents <directory> is where shared documents are kept
+    documents, argv = _option(argv, "--documents")
+    if documents is not None:
+        docstore.store = docstore.DocumentStore(documents)
+
+    # --linger <seconds> is how long a dropped player can resume their entity
+    linger, argv = _option(argv, "--linger")
+    if linger is not None:
+        session.LINGER = float(linger)
+
+    # --encoding binary writes compact binary profiles (json is the default)
+    encoding, argv = _option(argv, "--encoding")
+    if encoding is not None:
+        persist.ENCODING = encoding
+
+    if len(argv) >= 1:
         try:
-            listen_port = int(sys.argv[1])
+            listen_port = int(argv[0])
         except:
-            print "Server: Issue when listening on port " + sys.argv[1] + ". Using default (8080)."
+            print "Server: Issue when listening on port " + argv[0] + ". Using default (8080)."
 
     print "Server: Initializing profiles."
-    persist.initializeProfiles()
+    persist.initializeProfiles(store)
+    persist.startSaver()
 
     print "Server: Setting up session."
     running_session = session.Session()
+    if checkpoint.restore(running_session, checkpoint_path):
+        print "Server: Restored the session from " + checkpoint_path + "."
+    checkpointer = checkpoint.Checkpointer(running_session, checkpoint_path)
+    checkpointer.start()
 
     print "Server: Creating the CommandParser"
     parser = commandparser.CommandParser()
 
+    publisher = None
+    if publish_port is not None:
+        print "Server: Starting the relay event publisher."
+        publisher = relay.EventPublisher(running_session, publish_port)
+        publisher.start()
+
+    recorder = None
+    if record_path is not None:
+        print "Server: Recording the session to " + record_path + "."
+        recorder = sessionlog.Recorder(record_path)
+        recorder.start(running_session)
+
+    writer = None
+    if transcript_directory is not None:
+        print "Server: Writing transcripts to " + transcript_directory + "."
+        writer = transcript.Transcript(transcript_directory, plain=plain)
+        writer.index = history.Index(os.path.join(transcript_directory, "index"))
+        history.index = writer.index
+        running_session.subscribe(writer.record)
+        writer.start()
+
+    print "Server: Compiling help files..."
+    helpindex.build(commands, functionmapper.commandFunctions)
+
     print "Server: Initialization Complete."
     print "Server: Setting up network communications."
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -222,9 +394,18 @@ def main():
         try:
             # client connects to the server
             client_socket, address = server_socket.accept()
+            refusal = admission.gate.connect(address[0])
+            if refusal is not None:
+                print "Server: Turned away " + address[0] + ". " + refusal
+                try:
+                    client_socket.send(refusal + "\n")
+                    client_socket.close()
+                except:
+                    pass
+                continue
             print "Server: Accepting connection from " + address[0] + "..."
             # spawn up a client proxy here
-            proxy = LoginProxy(client_socket, running_session, proxy_pool)
+            proxy = LoginProxy(client_socket, running_session, proxy_pool, address[0])
             proxy_pool.append(proxy)
             proxy.start()
         except KeyboardInterrupt:
@@ -232,11 +413,26 @@ def main():
             print "Server: Closing server socket and dispatcher..."
             server_socket.close()
             parser.kill()
+            if publisher is not None:
+                publisher.kill()
+            if recorder is not None:
+                recorder.stop()
+            if writer is not None:
+                running_session.unsubscribe(writer.record)
+                history.index = None
+                writer.kill()
             print "Server: Closing client connections..."
             for connection in running_session:
                 connection.proxy.kill()
             for proxy in proxy_pool:
                 proxy.kill()
+            print "Server: Checkpointing the session..."
+            checkpointer.kill()
+            print "Server: Flushing profiles..."
+            persist.saver.kill()
+            persist.backend.close()
+            print ("Server: " + str(persist.stats["requested"]) + " saves requested, " +
+                   str(persist.stats["written"]) + " written, " + str(persist.stats["avoided"]) + " avoided.")
             done = True
         except:
             exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -1,24 +1,208 @@
-import stage
+import os
+import time
+import threading
+
+import room
+import party
 import entity
+import persist
 import turnqueue
+import scrollback
+
+
+# Everyone starts here, and it cannot be destroyed
+LOBBY = "Lobby"
+
+# Seconds a dropped player's entity is kept, so they can resume it
+LINGER = 120.0
 
 
 class Session(object):
 
-    __slots__ = ("connections", "stage", "entity_map", "tracker")
+    __slots__ = ("connections", "stage", "entity_map", "tracker", "listeners",
+                 "rooms", "lobby", "lingering", "tokens", "lock", "party",
+                 "scrollback")
 
     def __init__(self):
         self.connections = {}
-        self.stage = stage.Stage()
+        self.listeners = []
+        # name.lower() -> (entity, expiry timer) for players who dropped
+        self.lingering = {}
+        # resume token -> entity
+        self.tokens = {}
+        self.lock = threading.Lock()
+        self.rooms = {}
+        self.lobby = self.createRoom(LOBBY)
+        # the lobby's stage doubles as the session-wide one (brushes live here)
+        self.stage = self.lobby.stage
         self.tracker = turnqueue.TurnQueue()
+        self.tracker.observer = self._trackerChanged
+        # tallies and bags everyone shares
+        self.party = party.Party()
+        self.scrollback = scrollback.Scrollback()
+        self.subscribe(self.scrollback.record)
 
     def add(self, player):
         self.connections[player.name.lower()] = player
+        location = player.location
+        if location is None or self.rooms.get(location.name.lower()) is not location:
+            location = self.lobby
+        location.enter(player)
+        player.location = location
+        self.publish("who", players=self.roster())
 
     def remove(self, player):
         key = player.name.lower()
         if key in self.connections:
             del self.connections[key]
+            if player.location is not None:
+                player.location.leave(player)
+            self.publish("who", players=self.roster())
+
+    def linger(self, player):
+        """
+        Take a player who lost their connection out of the session, but keep
+        their entity, mask, tallies and bags as they are for LINGER seconds.
+        """
+        self.remove(player)
+        self.scrollback.mark(player.name)
+        timer = threading.Timer(LINGER, self._expire, [player])
+        timer.daemon = True
+        with self.lock:
+            self.lingering[player.name.lower()] = (player, timer)
+        timer.start()
+
+    def reclaim(self, username):
+        """A lingering entity, no longer lingering, or None"""
+        with self.lock:
+            entry = self.lingering.pop(username.lower(), None)
+        if entry is None:
+            return None
+        entry[1].cancel()
+        return entry[0]
+
+    def issueToken(self, player):
+        """A fresh resume token for the player. Any older one stops working."""
+        token = os.urandom(16).encode("hex")
+        with self.lock:
+            self._revoke(player)
+            self.tokens[token] = player
+        return token
+
+    def revokeTokens(self, player):
+        """Stop the player's resume token working, as when they log out"""
+        with self.lock:
+            self._revoke(player)
+
+    def _revoke(self, player):
+        for old in [t for t in self.tokens if self.tokens[t] is player]:
+            del self.tokens[old]
+
+    def resume(self, token):
+        """
+        The entity a resume token belongs to, if it is still lingering or
+        connected. Tokens are good for one use.
+        """
+        with self.lock:
+            player = self.tokens.pop(token, None)
+        if player is None:
+            return None
+        if self.reclaim(player.name) is player:
+            return player
+        if self.connections.get(player.name.lower()) is player:
+            return player
+        return None
+
+    def _expire(self, player):
+        key = player.name.lower()
+        with self.lock:
+            entry = self.lingering.get(key)
+            if entry is None or entry[0] is not player:
+                return
+            del self.lingering[key]
+            self._revoke(player)
+        try:
+            persist.flushEntity(player)
+        except:
+            print "Server: Exception thrown while saving " + player.name + "'s profile."
+        print "Server: " + player.name + " did not come back, let them go."
+
+    def createRoom(self, name):
+        key = name.lower()
+        if key in self.rooms:
+            return self.rooms[key]
+        new_room = room.Room(name)
+        new_room.stage.observer = lambda scene: self._sceneChanged(new_room)
+        self.rooms[key] = new_room
+        self._roomsChanged()
+        return new_room
+
+    def destroyRoom(self, target):
+        """Remove a room, sending anyone inside it back to the lobby"""
+        if target is self.lobby:
+            return False
+        for occupant in list(target):
+            self.move(occupant, self.lobby)
+        for key in list(target.exits):
+            if key in self.rooms:
+                target.unlink(self.rooms[key])
+        del self.rooms[target.name.lower()]
+        self._roomsChanged()
+        return True
+
+    def getRoom(self, name):
+        return self.rooms.get(name.lower())
+
+    def linkRooms(self, a, b):
+        a.link(b)
+        self._roomsChanged()
+
+    def unlinkRooms(self, a, b):
+        a.unlink(b)
+        self._roomsChanged()
+
+    def move(self, player, destination):
+        if player.location is not None:
+            player.location.leave(player)
+        destination.enter(player)
+        player.location = destination
+        self.publish("who", players=self.roster())
+
+    def locate(self, player):
+        """The room a player is in. Husks from masks may not have one yet."""
+        if player.location is None:
+            return self.lobby
+        return player.location
+
+    def hearers(self, player, near=False):
+        """
+        Everyone who can hear the player: their room, and with near=True,
+        the rooms next to it as well.
+        """
+        location = self.locate(player)
+        audience = list(location)
+        if near:
+            for key in location.exits:
+                if key in self.rooms:
+                    audience.extend(self.rooms[key])
+        return audience
+
+    def nearby(self, player, near=False):
+        location = self.locate(player)
+        names = [location.name]
+        if near:
+            for key in location.exits:
+                if key in self.rooms:
+                    names.append(self.rooms[key].name)
+        return names
+
+    def broadcastRoom(self, location, message, source=None, exclude=None):
+        for connection in location:
+            if connection == exclude:
+                continue
+            connection.sendMessage(message)
+        self.publish("broadcast", text=message, source=source, rooms=[location.name],
+                     hearers=[connection.name for connection in location])
 
     def getEntity(self, username):
         username = username.lower()
@@ -31,15 +215,75 @@ class Session(object):
     def getAllEntities(self):
         return self.connections.values()
 
-    def broadcast(self, message):
+    def broadcast(self, message, source=None, paged=False):
         for connection in self.connections.values():
-            connection.sendMessage(message)
+            if paged:
+                connection.page(message, behind=True)
+            else:
+                connection.sendMessage(message)
+        self.publish("broadcast", text=message, source=source, rooms=None)
 
-    def broadcastExclude(self, message, ignored):
+    def broadcastExclude(self, message, ignored, paged=False):
         for connection in self.connections.values():
             if connection == ignored:
                 continue
-            connection.sendMessage(message)
+            if paged:
+                connection.page(message, behind=True)
+            else:
+                connection.sendMessage(message)
+        self.publish("broadcast", text=message, source=ignored.name, rooms=None)
+
+    def subscribe(self, listener):
+        """Register a callable that receives every published session event"""
+        if listener not in self.listeners:
+            self.listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def publish(self, kind, **fields):
+        """
+        Hand an event to every listener. Events are plain dicts so they can
+        be serialized as-is by the relay publisher.
+        """
+        if len(self.listeners) == 0:
+            return
+        event = fields
+        event["kind"] = kind
+        event["time"] = time.time()
+        for listener in list(self.listeners):
+            try:
+                listener(event)
+            except:
+                print "Server: Exception thrown by a session event listener."
+
+    def roster(self):
+        ret = []
+        for e in self.connections.values():
+            ret.append({"name": e.name, "dm": e.dm, "spectator": e.spectator,
+                        "location": self.locate(e).name})
+        return ret
+
+    def snapshot(self):
+        return {
+            "rooms": [r.snapshot() for r in self.rooms.values()],
+            "lobby": self.lobby.name,
+            "tracker": self.tracker.snapshot(),
+            "players": self.roster()
+        }
+
+    def _sceneChanged(self, location):
+        self.publish("scene", room=location.name, scene=location.stage.snapshot())
+
+    def _roomsChanged(self):
+        layout = []
+        for r in self.rooms.values():
+            layout.append({"name": r.name, "exits": sorted(r.exits)})
+        self.publish("rooms", rooms=layout)
+
+    def _trackerChanged(self, tracker):
+        self.publish("tracker", tracker=tracker.snapshot())
 
     def __contains__(self, key):
         # Can take in a name or an entity object
@@ -50,4 +294,4 @@ class Session(object):
         return key in self.connections
 
     def __iter__(self):
-        return iter(filter(lambda e: not e.spectator, self.connections.values()))
\ No newline at end of file
+        return iter(filter(lambda e: not e.spectator, self.connections.values()))
@@ -0,0 +1,259 @@
+import json
+import time
+import struct
+import threading
+import collections
+
+import dice
+import entity
+
+"""
+Binary session log. Every command accepted from a connection is appended
+along with its actor, the time it was accepted, and every dice draw made
+while it ran. Commands it set off in turn, like the expansion of an alias
+or a masked command, count as part of it: their draws go in its record,
+which is written once the last of them has run. Joins and departures are
+logged too, so a replay can rebuild the same set of connections. See
+replay.py for the tool that re-runs a log.
+
+A join does not load an entity's lazy fields just to log them. Any still
+unloaded are logged when something first reads them, before the command
+that did so.
+
+File layout: the MAGIC header, then records of
+    kind (1 byte) | timestamp (double) | payload length (uint32) | payload
+
+    J - an entity joined, payload is its state as JSON
+    L - an entity left, payload is its name
+    F - a lazy field was loaded, payload is {"name", "field", "value"} as JSON
+    C - a command ran: actor length (uint16), line length (uint16),
+        draw count (uint16), actor, line, draws (int32 each)
+"""
+
+MAGIC = "MUSHYLOG\x01"
+
+_header = struct.Struct("<cdI")
+_command = struct.Struct("<HHH")
+
+# The active Recorder, if the server was started with --record
+recorder = None
+
+
+def _bytes(text):
+    if isinstance(text, unicode):
+        return text.encode("utf-8")
+    return text
+
+
+def fieldState(field, value):
+    """A lazy field's value as it goes in the log"""
+    if field == "bags":
+        return dict((tag, value[tag].serialize()) for tag in value)
+    return value
+
+
+def actorState(e):
+    """
+    The parts of an entity that change how commands behave or render. Lazy
+    fields are left out until they are loaded.
+    """
+    state = {
+        "name": e.name,
+        "dm": e.dm,
+        "spectator": e.spectator,
+        "languages": e.languages,
+        "aliases": e.aliases,
+        "settings": e.settings,
+        "tallies": e.tallies,
+        "aspects": e.aspects
+    }
+    for field in entity.LAZY:
+        if e.isLoaded(field):
+            state[field] = fieldState(field, getattr(e, field))
+    return state
+
+
+class RecordingRandom(object):
+    """Stands in for dice.rng and remembers every draw"""
+
+    def __init__(self, source):
+        self.source = source
+        self.draws = []
+
+    def randint(self, a, b):
+        value = self.source.randint(a, b)
+        self.draws.append(value)
+        return value
+
+
+class ReplayRandom(object):
+    """Stands in for dice.rng and hands back the draws from a log"""
+
+    def __init__(self):
+        self.draws = collections.deque()
+        self.diverged = False
+
+    def feed(self, draws):
+        self.draws.extend(draws)
+
+    def randint(self, a, b):
+        try:
+            value = self.draws.popleft()
+        except IndexError:
+            value = a
+            self.diverged = True
+        if value < a or value > b:
+            self.diverged = True
+            value = max(a, min(b, value))
+        return value
+
+
+class Recorder(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.log = open(path, "ab")
+        if self.log.tell() == 0:
+            self.log.write(MAGIC)
+        self.pending = []
+        self.known = set()
+        self.rng = RecordingRandom(dice.rng)
+        self.session = None
+
+    def start(self, session):
+        global recorder
+        self.session = session
+        dice.rng = self.rng
+        session.subscribe(self.sessionEvent)
+        for e in session.getAllEntities():
+            self.joined(e)
+        recorder = self
+
+    def stop(self):
+        global recorder
+        recorder = None
+        dice.rng = self.rng.source
+        if self.session is not None:
+            self.session.unsubscribe(self.sessionEvent)
+        with self.lock:
+            self.log.close()
+
+    def sessionEvent(self, event):
+        if event["kind"] != "who":
+            return
+        names = set(player["name"] for player in event["players"])
+        for name in names - self.known:
+            e = self.session.connections.get(name.lower())
+            if e is not None:
+                self.joined(e)
+        for name in self.known - names:
+            self._write("L", event["time"], _bytes(name))
+            self.known.discard(name)
+
+    def joined(self, e):
+        self.known.add(e.name)
+        self._write("J", time.time(), json.dumps(actorState(e)))
+        if all(e.isLoaded(field) for field in entity.LAZY):
+            return
+        if getattr(e.loader, "recorder", None) is self:
+            return
+        loader = e.loader
+
+        def recording(field):
+            value = loader(field)
+            self.loaded(e, field, value)
+            return value
+        recording.recorder = self
+        e.loader = recording
+
+    def loaded(self, e, field, value):
+        """Called when a lazy field of a logged entity is read in"""
+        if recorder is not self:
+            return
+        state = {"name": e.name, "field": field,
+                 "value": fieldState(field, value)}
+        self._write("F", time.time(), json.dumps(state))
+
+    def _find(self, args):
+        for i in range(len(self.pending)):
+            if any(waiting is args for waiting in self.pending[i][0]):
+                return i
+        return None
+
+    def accept(self, args, entity, line):
+        """Called by the CommandParser for input read off a connection"""
+        with self.lock:
+            # commands still to run for this line, and the draws so far
+            self.pending.append(([args], entity.name, line, time.time(), []))
+
+    def spawned(self, parent, args):
+        """Called when a running command queues another to run after it"""
+        with self.lock:
+            i = self._find(parent)
+            if i is not None:
+                self.pending[i][0].append(args)
+
+    def executed(self, args):
+        """Called by the Dispatcher once a command has run"""
+        with self.lock:
+            # whatever was drawn since the last command finished was drawn
+            # by this one
+            draws = self.rng.draws
+            self.rng.draws = []
+            i = self._find(args)
+            if i is None:
+                return
+            waiting, actor, line, timestamp, taken = self.pending[i]
+            taken.extend(draws)
+            waiting[:] = [other for other in waiting if other is not args]
+            if len(waiting) > 0:
+                return
+            self.pending.pop(i)
+            draws = taken
+        actor = _bytes(actor)
+        line = _bytes(line)
+        payload = _command.pack(len(actor), len(line), len(draws))
+        payload += actor + line + struct.pack("<%di" % len(draws), *draws)
+        self._write("C", timestamp, payload)
+
+    def _write(self, kind, timestamp, payload):
+        with self.lock:
+            header = _header.pack(kind, timestamp, len(payload))
+            self.log.write(header + payload)
+            self.log.flush()
+
+
+def readLog(path):
+    """
+    Yields (kind, timestamp, data) for each record. Joins yield the entity
+    state dict, departures the name, loaded fields their dict, and commands
+    (actor, line, draws).
+    """
+    f = open(path, "rb")
+    try:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise IOError(path + " is not a Mushy session log")
+        while True:
+            header = f.read(_header.size)
+            if len(header) < _header.size:
+                break
+            kind, timestamp, length = _header.unpack(header)
+            payload = f.read(length)
+            if kind == "J":
+                yield kind, timestamp, json.loads(payload)
+            elif kind == "L":
+                yield kind, timestamp, payload
+            elif kind == "F":
+                yield kind, timestamp, json.loads(payload)
+            elif kind == "C":
+                actor_len, line_len, count = _command.unpack_from(payload)
+                offset = _command.size
+                actor = payload[offset:offset + actor_len]
+                offset += actor_len
+                line = payload[offset:offset + line_len]
+                offset += line_len
+                draws = struct.unpack_from("<%di" % count, payload, offset)
+                yield kind, timestamp, (actor, line, draws)
+    finally:
+        f.close()
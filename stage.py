@@ -3,9 +3,10 @@ from mushyutils import swatch
 
 class Stage(object):
 
-    __slots__ = ("objects", "title", "body", "brushes")
+    __slots__ = ("objects", "title", "body", "brushes", "observer")
 
     def __init__(self):
+        self.observer = None
         self.brushes = {}
         self.objects = {}
         self.title = ""
@@ -13,9 +14,11 @@ class Stage(object):
 
     def paintSceneTitle(self, title):
         self.title = title
+        self._changed()
 
     def paintSceneBody(self, body):
         self.body = body
+        self._changed()
 
     def viewScene(self):
         ret = ""
@@ -41,6 +44,7 @@ class Stage(object):
 
     def paintObject(self, identifier, description):
         self.objects[identifier.lower()] = description
+        self._changed()
 
     def viewObject(self, identifier):
         if identifier.lower() in self.objects:
@@ -50,13 +54,23 @@ class Stage(object):
     def eraseObject(self, identifier):
         if identifier.lower() in self.objects:
             del self.objects[identifier.lower()]
+            self._changed()
 
     def wipeScene(self):
         self.title = ""
         self.body = ""
+        self._changed()
 
     def wipeObjects(self):
         self.objects.clear()
+        self._changed()
+
+    def snapshot(self):
+        return {"title": self.title, "body": self.body, "objects": dict(self.objects)}
+
+    def _changed(self):
+        if self.observer is not None:
+            self.observer(self)
 
     def _initBrush(self, entity):
         if not entity in self.brushes:
@@ -0,0 +1,917 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import zlib
+import marshal
+import sqlite3
+import threading
+
+"""
+Storage backends for persist. A backend maps a profile name to its data, a
+plain dict, and knows nothing about entities. Every backend provides:
+
+    initialize(readonly=False)
+                            create whatever the store needs; a read-only
+                            store only reads one another process writes
+    exists(name)            is there a profile by this name
+    load(name)              the profile's data, or None
+    save(name, data)        write one profile
+    saveMany(items)         write a batch of (name, data) pairs together
+    delete(name)            remove a profile, and its fields
+    names()                 iterate over every stored profile name
+    loadField(name, field)  a large field kept apart from the profile, or None
+    saveField(name, field, value)
+    close()
+
+Backends are picked with a spec string, "json:<directory>" (the default),
+"sharded:<directory>" or "sqlite:<file>". Any of them may be prefixed with
+"journal+" to put a Journal in front of it. See openStore.
+
+Profiles are encoded as JSON, or with encoding="binary" as marshal data with
+large text fields compressed. Loading always sniffs the format, so a store
+can hold a mix of both while it is being converted.
+"""
+
+DEFAULT_SPEC = "json:./profiles/"
+
+# Seconds between journal compactions
+COMPACT_INTERVAL = 60.0
+
+# Compact early once the journal grows past this many bytes
+COMPACT_SIZE = 4 * 1024 * 1024
+
+# Binary profiles start with this, JSON ones never can
+MAGIC = "MUSHYP\x01"
+
+# Text fields at least this long are zlib compressed in binary profiles
+COMPRESS_SIZE = 512
+
+# Extension of the file a JsonDirectory batch is committed through
+BATCH_EXTENSION = ".batch"
+
+# Commit files a JsonDirectory keeps before syncing the profiles they cover
+# and retiring them
+SYNC_BATCHES = 16
+
+
+def openStore(spec=DEFAULT_SPEC, fsync=False, encoding="json"):
+    if spec.startswith("journal+"):
+        base = openStore(spec[len("journal+"):], fsync=fsync, encoding=encoding)
+        path = spec.partition(":")[2] or "./profiles"
+        return Journal(base, path.rstrip("/\\") + ".journal", fsync=fsync)
+
+    kind, unused, path = spec.partition(":")
+    if kind == "json":
+        return JsonDirectory(path or "./profiles/", fsync=fsync, encoding=encoding)
+    elif kind == "sharded":
+        return JsonDirectory(path or "./profiles/", fsync=fsync, encoding=encoding, sharded=True)
+    elif kind == "sqlite":
+        return Sqlite(path or "./profiles.db", fsync=fsync, encoding=encoding)
+    raise ValueError("Unknown profile store " + spec)
+
+
+def encode(data, encoding="json"):
+    if encoding != "binary":
+        return json.dumps(data)
+    data = dict(data)
+    packed = []
+    for field in data:
+        value = data[field]
+        if isinstance(value, basestring) and len(value) >= COMPRESS_SIZE:
+            if isinstance(value, unicode):
+                value = value.encode("utf-8")
+            data[field] = zlib.compress(value)
+            packed.append(field)
+    data["_z"] = packed
+    return MAGIC + marshal.dumps(data)
+
+
+def decode(raw):
+    if not raw.startswith(MAGIC):
+        return json.loads(raw)
+    data = marshal.loads(raw[len(MAGIC):])
+    for field in data.pop("_z", []):
+        data[field] = zlib.decompress(data[field]).decode("utf-8")
+    return data
+
+
+def _syncDirectory(directory):
+    if os.name == "nt":
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class JsonDirectory(object):
+    """
+    One JSON file per profile, so entries can be hand-modified. Files are
+    written to a temporary name and renamed over the old profile, so a crash
+    mid-save leaves either the old profile or the new one, never neither.
+
+    With encoding="binary", profiles are written as .mpf files instead, and
+    the .json file is removed once its replacement is in place.
+
+    Fields kept apart from the profile go in files beside it, named
+    Name.<field>.field.
+
+    With sharded=True, profiles live two directories down, under the first
+    two pairs of hex digits of a hash of their name (ab/cd/Name.json), so no
+    single directory grows past a few hundred entries. Profiles are found in
+    either layout; anything still in the other one is moved over in the
+    background by a LayoutMigrator, and every save moves its profile too.
+
+    With fsync=True, every save is first written whole to a commit file,
+    which is synced before the profiles are renamed into place. The profiles
+    themselves are only synced every SYNC_BATCHES commits, once each however
+    often they were saved in between, and only then are those commit files
+    removed. Commit files still on disk after a crash are replayed, oldest
+    first, on the next start.
+    """
+
+    __slots__ = ("directory", "fsync", "encoding", "sharded", "lock", "migrator",
+                 "commits", "unsynced")
+
+    EXTENSIONS = {"json": ".json", "binary": ".mpf"}
+
+    FIELD_EXTENSION = ".field"
+
+    def __init__(self, directory="./profiles/", fsync=False, encoding="json", sharded=False):
+        self.directory = os.path.join(directory, "")
+        self.fsync = fsync
+        self.encoding = encoding
+        self.sharded = sharded
+        # held while files are renamed into place or between layouts
+        self.lock = threading.Lock()
+        self.migrator = None
+        # commit files still on disk, and the profiles saved since the last
+        # sync that they cover
+        self.commits = []
+        self.unsynced = set()
+
+    def initialize(self, migrate=True, readonly=False):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        # temporary files left behind by a crash mid-save, unless they might
+        # be the writer's saves in progress
+        if not readonly:
+            for directory, filename in self._files():
+                if ".tmp." in filename:
+                    os.remove(directory + filename)
+            self._recommit()
+
+        # moving files about is left to the process that writes the store
+        if migrate and not readonly and len(self.misplaced()) > 0:
+            self.migrator = LayoutMigrator(self)
+            self.migrator.start()
+
+    def shard(self, name):
+        key = name.lower()
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        digest = hashlib.md5(key).hexdigest()
+        return os.path.join(self.directory, digest[0:2], digest[2:4], "")
+
+    def path(self, name, encoding=None, sharded=None):
+        if sharded is None:
+            sharded = self.sharded
+        if sharded:
+            directory = self.shard(name)
+        else:
+            directory = self.directory
+        return directory + name + self.EXTENSIONS[encoding or self.encoding]
+
+    def candidates(self, name):
+        """Every path a profile might be at, the one we write first"""
+        paths = [self.path(name)]
+        for sharded in (self.sharded, not self.sharded):
+            for encoding in self.EXTENSIONS:
+                path = self.path(name, encoding, sharded)
+                if path not in paths:
+                    paths.append(path)
+        return paths
+
+    def locate(self, name):
+        """Where a profile is on disk right now, whichever layout it is in"""
+        for path in self.candidates(name):
+            if os.path.exists(path):
+                return path
+        return None
+
+    def exists(self, name):
+        return self.locate(name) is not None
+
+    def load(self, name):
+        for path in self.candidates(name):
+            try:
+                f = open(path, "rb")
+            except IOError:
+                continue
+            raw = f.read()
+            f.close()
+            return decode(raw)
+        return None
+
+    def save(self, name, data):
+        self.saveMany([(name, data)])
+
+    def fieldPath(self, name, field, sharded=None):
+        return os.path.splitext(self.path(name, sharded=sharded))[0] + "." + field + self.FIELD_EXTENSION
+
+    def loadField(self, name, field):
+        for sharded in (self.sharded, not self.sharded):
+            try:
+                f = open(self.fieldPath(name, field, sharded), "rb")
+            except IOError:
+                continue
+            raw = f.read()
+            f.close()
+            return decode(raw)["value"]
+        return None
+
+    def saveField(self, name, field, value):
+        path = self.fieldPath(name, field)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+        temp = path + ".tmp." + uuid.uuid4().hex
+        f = open(temp, "wb")
+        f.write(encode({"value": value}, self.encoding))
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+        f.close()
+        with self.lock:
+            if os.name == "nt" and os.path.exists(path):
+                os.remove(path)
+            os.rename(temp, path)
+            stale = self.fieldPath(name, field, not self.sharded)
+            if os.path.exists(stale):
+                os.remove(stale)
+
+    def _recommit(self):
+        """Put back every batch whose commit file made it to disk before a crash"""
+        found = sorted(filename for filename in os.listdir(self.directory)
+                       if filename.endswith(BATCH_EXTENSION))
+        for filename in found:
+            path = self.directory + filename
+            f = open(path, "rb")
+            try:
+                items = json.loads(f.read())
+            except ValueError:
+                # cut off before it was synced, so none of it was renamed
+                # into place either
+                items = []
+            f.close()
+            self.saveMany([(name, data) for name, data in items])
+        with self.lock:
+            self._sync()
+            for filename in found:
+                os.remove(self.directory + filename)
+
+    def _sync(self):
+        """Sync every profile saved since the last sync, then retire the commit files"""
+        directories = set()
+        for name in self.unsynced:
+            path = self.locate(name)
+            if path is None:
+                continue
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            directories.add(os.path.dirname(path))
+        for directory in directories:
+            _syncDirectory(directory)
+        for path in self.commits:
+            os.remove(path)
+        self.commits = []
+        self.unsynced = set()
+
+    def saveMany(self, items):
+        """
+        Group commit: the batch is written to a commit file and only that is
+        synced before the profiles are renamed into place. See SYNC_BATCHES.
+        """
+        with self.lock:
+            self._saveMany(items)
+
+    def _saveMany(self, items):
+        batch = None
+        if self.fsync and len(items) > 0:
+            # named so that commit files sort in the order they were made
+            batch = "%scommit.%020.6f.%s%s" % (self.directory, time.time(), uuid.uuid4().hex, BATCH_EXTENSION)
+            f = open(batch, "wb")
+            f.write(json.dumps(items))
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+
+        written = []
+        for name, data in items:
+            path = self.path(name)
+            if self.sharded and not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    # made by a concurrent save to the same shard
+                    pass
+            temp = path + ".tmp." + uuid.uuid4().hex
+            f = open(temp, "wb")
+            f.write(encode(data, self.encoding))
+            f.flush()
+            written.append((temp, path, f))
+
+        for temp, path, f in written:
+            f.close()
+
+        for temp, path, f in written:
+            if os.name == "nt" and os.path.exists(path):
+                # Windows will not rename over an existing file
+                os.remove(path)
+            os.rename(temp, path)
+
+        # copies in the other encoding or layout are now out of date
+        for name, data in items:
+            for stale in self.candidates(name)[1:]:
+                if os.path.exists(stale):
+                    os.remove(stale)
+
+        if batch is not None:
+            self.commits.append(batch)
+            self.unsynced.update(name for name, data in items)
+            if len(self.commits) >= SYNC_BATCHES:
+                self._sync()
+
+    def delete(self, name):
+        with self.lock:
+            # or a replayed commit file could bring the profile back
+            if len(self.commits) > 0:
+                self._sync()
+            for path in self.candidates(name):
+                if os.path.exists(path):
+                    os.remove(path)
+            for sharded in (True, False):
+                directory = os.path.dirname(self.path(name, sharded=sharded))
+                if not os.path.isdir(directory):
+                    continue
+                for filename in os.listdir(directory):
+                    if self._owner(filename) == name and filename.endswith(self.FIELD_EXTENSION):
+                        os.remove(os.path.join(directory, filename))
+
+    def _owner(self, filename):
+        """The profile a file in the store belongs to, or None for other files"""
+        if ".tmp." in filename:
+            return None
+        base, extension = os.path.splitext(filename)
+        if extension == self.FIELD_EXTENSION:
+            return os.path.splitext(base)[0]
+        if extension in (".json", ".mpf"):
+            return base
+        return None
+
+    def _files(self):
+        """(directory, filename) for every file in the store, in both layouts"""
+        for filename in os.listdir(self.directory):
+            top = os.path.join(self.directory, filename)
+            if not os.path.isdir(top):
+                yield self.directory, filename
+                continue
+            for sub in os.listdir(top):
+                bottom = os.path.join(top, sub, "")
+                if os.path.isdir(bottom):
+                    for leaf in os.listdir(bottom):
+                        yield bottom, leaf
+
+    def names(self):
+        seen = set()
+        for directory, filename in self._files():
+            name, extension = os.path.splitext(filename)
+            if extension in (".json", ".mpf") and name not in seen:
+                seen.add(name)
+                yield name
+
+    def misplaced(self):
+        """Profile files that are not where this layout would put them"""
+        ret = []
+        for directory, filename in self._files():
+            name = self._owner(filename)
+            if name is None:
+                continue
+            if directory != os.path.dirname(self.path(name)) + os.sep:
+                ret.append(directory + filename)
+        return ret
+
+    def migrate(self, path):
+        """
+        Move one profile file into this layout. Safe while the server runs:
+        saves already write to the new layout, so a profile that has been
+        saved there since is newer, and the old file is simply dropped.
+        """
+        filename = os.path.basename(path)
+        name = self._owner(filename)
+        with self.lock:
+            if not os.path.exists(path):
+                return False
+            target = os.path.join(os.path.dirname(self.path(name)), filename)
+            newer = [target]
+            if not filename.endswith(self.FIELD_EXTENSION):
+                newer = [p for p in self.candidates(name) if os.path.dirname(p) == os.path.dirname(target)]
+            if any(os.path.exists(p) for p in newer):
+                os.remove(path)
+            else:
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                os.rename(path, target)
+
+            # leaving the sharded layout, tidy up shards as they empty out
+            shard = os.path.dirname(path)
+            if shard + os.sep != self.directory:
+                for empty in (shard, os.path.dirname(shard)):
+                    try:
+                        os.rmdir(empty)
+                    except OSError:
+                        break
+            return True
+
+    def close(self):
+        if self.migrator is not None:
+            self.migrator.kill()
+            self.migrator = None
+        with self.lock:
+            if len(self.commits) > 0:
+                self._sync()
+
+
+class Sqlite(object):
+    """
+    Every profile in one SQLite file, keyed by name. The database runs in WAL
+    mode, so readers are not blocked by the saver, and the statements below
+    are fixed strings so sqlite3's statement cache keeps them prepared.
+    """
+
+    __slots__ = ("path", "fsync", "encoding", "connection", "lock")
+
+    def __init__(self, path="./profiles.db", fsync=False, encoding="json"):
+        self.path = path
+        self.fsync = fsync
+        self.encoding = encoding
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def initialize(self, readonly=False):
+        if readonly and not os.path.exists(self.path):
+            # connecting would create it
+            raise IOError("There is no profile store at " + self.path)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.text_factory = str
+        if readonly:
+            # the schema and journal mode are the writer's to set up
+            return
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        if self.fsync:
+            self.connection.execute("PRAGMA synchronous=FULL")
+        else:
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS profiles "
+                                "(name TEXT PRIMARY KEY, data BLOB NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS fields "
+                                "(name TEXT, field TEXT, data BLOB NOT NULL, PRIMARY KEY (name, field))")
+        self.connection.commit()
+
+    def exists(self, name):
+        with self.lock:
+            row = self.connection.execute("SELECT 1 FROM profiles WHERE name = ?", (name,)).fetchone()
+        return row is not None
+
+    def load(self, name):
+        with self.lock:
+            row = self.connection.execute("SELECT data FROM profiles WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        return decode(str(row[0]))
+
+    def save(self, name, data):
+        self.saveMany([(name, data)])
+
+    def saveMany(self, items):
+        if self.encoding == "binary":
+            rows = [(name, buffer(encode(data, "binary"))) for name, data in items]
+        else:
+            rows = [(name, encode(data)) for name, data in items]
+        with self.lock:
+            with self.connection:
+                self.connection.executemany("INSERT OR REPLACE INTO profiles (name, data) VALUES (?, ?)", rows)
+
+    def loadField(self, name, field):
+        with self.lock:
+            row = self.connection.execute("SELECT data FROM fields WHERE name = ? AND field = ?", (name, field)).fetchone()
+        if row is None:
+            return None
+        return decode(str(row[0]))["value"]
+
+    def saveField(self, name, field, value):
+        raw = encode({"value": value}, self.encoding)
+        if self.encoding == "binary":
+            raw = buffer(raw)
+        with self.lock:
+            with self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO fields (name, field, data) VALUES (?, ?, ?)", (name, field, raw))
+
+    def delete(self, name):
+        with self.lock:
+            with self.connection:
+                self.connection.execute("DELETE FROM profiles WHERE name = ?", (name,))
+                self.connection.execute("DELETE FROM fields WHERE name = ?", (name,))
+
+    def names(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT name FROM profiles").fetchall()
+        for row in rows:
+            yield row[0]
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+
+class Journal(object):
+    """
+    Sits in front of another backend and turns saves into appends. Only the
+    fields that changed since a profile was last loaded or saved are written,
+    one JSON line per profile, to the end of the journal. Loads rebuild a
+    profile from the base backend's copy plus its journaled changes. Fields
+    kept apart from the profile are journaled the same way, each saveField a
+    line of its own, and folded into the base backend's fields.
+
+    A background Compactor folds the journal into the base backend every
+    COMPACT_INTERVAL seconds, or sooner once it passes COMPACT_SIZE bytes.
+    """
+
+    __slots__ = ("base", "path", "fsync", "lock", "log", "pending", "folding",
+                 "known", "compactor", "readonly", "seen")
+
+    # Journaled fields are kept among a profile's changes under this prefix
+    FIELD = "field:"
+
+    def __init__(self, base, path, fsync=False):
+        self.base = base
+        self.path = path
+        self.fsync = fsync
+        self.lock = threading.RLock()
+        self.log = None
+        # name -> {field: value}, or None for a deleted profile. Fields kept
+        # apart from the profile are in here too, named FIELD + field.
+        self.pending = {}
+        # changes from the journal being compacted right now
+        self.folding = {}
+        # name -> data as of the last load or save, to work out what changed
+        self.known = {}
+        self.compactor = None
+        self.readonly = False
+        # sizes and times of the journal files when a read-only journal last
+        # read them
+        self.seen = None
+
+    def initialize(self, readonly=False):
+        self.base.initialize(readonly=readonly)
+        self.readonly = readonly
+        if readonly:
+            # leave the files to the server that writes them, and follow
+            # along with what it journals
+            self._refresh()
+            return
+
+        # a compaction that never finished still has its journal lying around
+        for path in (self.path + ".old", self.path):
+            if os.path.exists(path):
+                self._replay(path)
+        if len(self.pending) > 0:
+            self.folding = self.pending
+            self.pending = {}
+            self._fold()
+            self.folding = {}
+        for path in (self.path + ".old", self.path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.log = open(self.path, "a")
+
+        self.compactor = Compactor(self)
+        self.compactor.start()
+
+    def _replay(self, path, changes=None):
+        if changes is None:
+            changes = self.pending
+        f = open(path)
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the tail of a write that was cut off by a crash
+                break
+            self._apply(changes, record)
+        f.close()
+
+    def _refresh(self):
+        """Read the journal again if the writer has changed it since"""
+        seen = []
+        for path in (self.path + ".old", self.path):
+            try:
+                stat = os.stat(path)
+                seen.append((stat.st_size, stat.st_mtime))
+            except OSError:
+                seen.append(None)
+        if seen == self.seen:
+            return
+        changes = {}
+        for path in (self.path + ".old", self.path):
+            try:
+                self._replay(path, changes)
+            except IOError:
+                # folded away by the writer in the meantime
+                pass
+        with self.lock:
+            self.pending = changes
+            self.seen = seen
+
+    def _apply(self, changes, record):
+        name = record["n"]
+        if record.get("d"):
+            changes[name] = None
+            return
+        if changes.get(name) is None:
+            changes[name] = {}
+        if "x" in record:
+            changes[name][self.FIELD + record["x"]] = record["v"]
+        else:
+            changes[name].update(record["f"])
+
+    def _split(self, changes):
+        """Changes to a profile, and to the fields kept apart from it"""
+        profile = {}
+        fields = {}
+        for key in changes:
+            if key.startswith(self.FIELD):
+                fields[key[len(self.FIELD):]] = changes[key]
+            else:
+                profile[key] = changes[key]
+        return profile, fields
+
+    def exists(self, name):
+        if self.readonly:
+            self._refresh()
+        with self.lock:
+            for changes in (self.pending, self.folding):
+                if name in changes:
+                    return changes[name] is not None
+        return self.base.exists(name)
+
+    def load(self, name):
+        if self.readonly:
+            self._refresh()
+        with self.lock:
+            layers = [changes[name] for changes in (self.folding, self.pending) if name in changes]
+        data = self.base.load(name)
+        for layer in layers:
+            if layer is None:
+                data = None
+                continue
+            layer = self._split(layer)[0]
+            if len(layer) > 0:
+                data = dict(data or {})
+                data.update(layer)
+        if data is not None:
+            with self.lock:
+                self.known[name] = json.loads(json.dumps(data))
+        return data
+
+    def save(self, name, data):
+        self.saveMany([(name, data)])
+
+    def saveMany(self, items):
+        with self.lock:
+            for name, data in items:
+                # round trip so tuples and lists, str and unicode compare equal
+                data = json.loads(json.dumps(data))
+                before = self.known.get(name, {})
+                changed = {}
+                for field in data:
+                    if field not in before or before[field] != data[field]:
+                        changed[field] = data[field]
+                self.known[name] = data
+                if len(changed) == 0:
+                    continue
+                record = {"n": name, "f": changed}
+                self.log.write(json.dumps(record) + "\n")
+                self._apply(self.pending, record)
+            self._commit()
+
+    def _commit(self):
+        """Make what was written to the log durable. Called with the lock held."""
+        self.log.flush()
+        if self.fsync:
+            os.fsync(self.log.fileno())
+        if self.log.tell() > COMPACT_SIZE and self.compactor is not None:
+            self.compactor.wakeup.set()
+
+    def loadField(self, name, field):
+        if self.readonly:
+            self._refresh()
+        with self.lock:
+            for changes in (self.pending, self.folding):
+                if name not in changes:
+                    continue
+                if changes[name] is None:
+                    return None
+                if self.FIELD + field in changes[name]:
+                    return changes[name][self.FIELD + field]
+        return self.base.loadField(name, field)
+
+    def saveField(self, name, field, value):
+        with self.lock:
+            record = {"n": name, "x": field, "v": value}
+            self.log.write(json.dumps(record) + "\n")
+            self._apply(self.pending, record)
+            self._commit()
+
+    def delete(self, name):
+        self.base.delete(name)
+        with self.lock:
+            record = {"n": name, "d": True}
+            self.log.write(json.dumps(record) + "\n")
+            self.log.flush()
+            self._apply(self.pending, record)
+            self.known.pop(name, None)
+
+    def names(self):
+        with self.lock:
+            changes = dict(self.folding)
+            changes.update(self.pending)
+        for name in self.base.names():
+            if name not in changes:
+                yield name
+        for name in changes:
+            if changes[name] is not None:
+                yield name
+
+    def compact(self):
+        """
+        Fold everything journaled so far into the base backend. If the last
+        fold failed, its changes are still in folding and in the .old
+        journal; newer ones are merged in and the whole lot is tried again,
+        and .old only goes once a fold has succeeded.
+        """
+        with self.lock:
+            if len(self.pending) == 0 and len(self.folding) == 0:
+                return
+            # start a fresh journal so saves keep flowing while we fold
+            self.log.close()
+            if len(self.folding) > 0:
+                older = open(self.path + ".old", "a")
+                newer = open(self.path)
+                older.write(newer.read())
+                newer.close()
+                older.flush()
+                if self.fsync:
+                    os.fsync(older.fileno())
+                older.close()
+                os.remove(self.path)
+                for name in self.pending:
+                    changes = self.pending[name]
+                    if changes is None:
+                        self.folding[name] = None
+                        continue
+                    if self.folding.get(name) is None:
+                        self.folding[name] = {}
+                    self.folding[name].update(changes)
+            else:
+                os.rename(self.path, self.path + ".old")
+                self.folding = self.pending
+            self.log = open(self.path, "a")
+            self.pending = {}
+
+        self._fold()
+
+        with self.lock:
+            self.folding = {}
+            os.remove(self.path + ".old")
+
+    def _fold(self):
+        snapshots = []
+        for name in self.folding:
+            changes = self.folding[name]
+            if changes is None:
+                self.base.delete(name)
+                continue
+            profile, fields = self._split(changes)
+            for field in fields:
+                self.base.saveField(name, field, fields[field])
+            if len(profile) > 0:
+                data = self.base.load(name) or {}
+                data.update(profile)
+                snapshots.append((name, data))
+        self.base.saveMany(snapshots)
+
+    def close(self):
+        if self.compactor is not None:
+            self.compactor.kill()
+            self.compactor = None
+        if self.log is not None and not self.readonly:
+            self.compact()
+            with self.lock:
+                self.log.close()
+                self.log = None
+        self.base.close()
+
+
+class LayoutMigrator(threading.Thread):
+    """
+    Moves a JsonDirectory's profiles into its layout a few at a time, so a
+    large store can be resharded without taking the server down.
+    """
+
+    __slots__ = ("store", "running", "wakeup")
+
+    # Profiles moved between pauses, and the pause in seconds
+    BATCH = 100
+    PAUSE = 0.05
+
+    def __init__(self, store):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.store = store
+        self.running = True
+        self.wakeup = threading.Event()
+
+    def kill(self):
+        self.running = False
+        self.wakeup.set()
+
+    def run(self):
+        moved = 0
+        try:
+            for path in self.store.misplaced():
+                if not self.running:
+                    break
+                if not self.store.migrate(path):
+                    continue
+                moved += 1
+                # let saves in between each full batch
+                if moved % self.BATCH == 0:
+                    self.wakeup.wait(self.PAUSE)
+        except:
+            print "Server: Exception thrown while moving profiles to the new layout."
+        if moved > 0:
+            print "Server: Moved " + str(moved) + " profiles to the new directory layout."
+
+
+class Compactor(threading.Thread):
+
+    __slots__ = ("journal", "running", "wakeup", "lock", "held")
+
+    def __init__(self, journal):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.journal = journal
+        self.running = True
+        self.wakeup = threading.Event()
+        # taken for each compaction, so hold waits out one in progress
+        self.lock = threading.Lock()
+        # while above zero, compactions are put off
+        self.held = 0
+
+    def hold(self):
+        """Put off compacting, once any compaction under way has finished"""
+        with self.lock:
+            self.held += 1
+
+    def release(self):
+        with self.lock:
+            self.held = max(0, self.held - 1)
+
+    def kill(self):
+        self.running = False
+        self.wakeup.set()
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(COMPACT_INTERVAL)
+            self.wakeup.clear()
+            if not self.running:
+                break
+            try:
+                with self.lock:
+                    if self.held == 0:
+                        self.journal.compact()
+            except:
+                print "Server: Exception thrown while compacting the profile journal."
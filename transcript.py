@@ -0,0 +1,131 @@
+import os
+import re
+import gzip
+import time
+import shutil
+import threading
+import collections
+
+"""
+Session transcripts. The Transcript listens to the session's broadcast
+events and drops each one on a deque, which never blocks the thread that
+said it. Its own thread wakes every FLUSH_INTERVAL seconds and writes all
+that has piled up in one go, through a large file buffer.
+
+Each server run starts a new file in the transcript directory, and a file
+that grows past ROTATE_SIZE is closed and a new one started. Closed files
+are gzipped. Lines look like
+
+    [2026-10-19 21:04:05] Ann says, "Shall we?"
+
+with any further lines of a message indented by two spaces.
+"""
+
+# Seconds between writes
+FLUSH_INTERVAL = 1.0
+
+# Bytes written to a transcript before starting the next one
+ROTATE_SIZE = 16 * 1024 * 1024
+
+# Buffer size for transcript files
+BUFFER = 256 * 1024
+
+_ansi = re.compile(r'\x1b\[[0-9;]*m')
+
+
+def stripAnsi(text):
+    return _ansi.sub('', text)
+
+
+class Transcript(threading.Thread):
+
+    __slots__ = ("directory", "plain", "queue", "running", "wakeup", "file",
+                 "path", "size", "part", "started", "index")
+
+    def __init__(self, directory, plain=False):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.directory = directory
+        self.plain = plain
+        # appends and pops on a deque are atomic, no lock needed
+        self.queue = collections.deque()
+        self.running = True
+        self.wakeup = threading.Event()
+        self.file = None
+        self.path = None
+        self.size = 0
+        self.part = 0
+        self.started = time.strftime("%Y%m%d-%H%M%S")
+        # a history.Index fed everything written, if searching is wanted
+        self.index = None
+
+    def record(self, event):
+        """Session listener"""
+        if event["kind"] == "broadcast":
+            self.queue.append((event["time"], event.get("source"), event.get("hearers"), event["text"],
+                               event.get("language")))
+
+    def _open(self):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self.part += 1
+        name = "transcript-" + self.started
+        if self.part > 1:
+            name = name + "-" + str(self.part)
+        self.path = os.path.join(self.directory, name + ".log")
+        self.file = open(self.path, "ab", BUFFER)
+        self.size = self.file.tell()
+
+    def _rotate(self):
+        """Close the current file and compress it"""
+        self.file.close()
+        self.file = None
+        closed = self.path
+        source = open(closed, "rb")
+        target = gzip.open(closed + ".gz", "wb")
+        shutil.copyfileobj(source, target, BUFFER)
+        target.close()
+        source.close()
+        os.remove(closed)
+
+    def flush(self):
+        if len(self.queue) == 0:
+            return
+        if self.file is None:
+            self._open()
+        while len(self.queue) > 0:
+            stamp, source, hearers, text, language = self.queue.popleft()
+            if isinstance(text, unicode):
+                text = text.encode("utf-8")
+            if self.plain:
+                text = stripAnsi(text)
+            line = time.strftime("[%Y-%m-%d %H:%M:%S] ", time.localtime(stamp)) + text.replace("\n", "\n  ") + "\n"
+            self.file.write(line)
+            self.size += len(line)
+            if self.index is not None:
+                self.index.add(stamp, source, text, hearers, language)
+            if self.size >= ROTATE_SIZE:
+                self._rotate()
+                self._open()
+        self.file.flush()
+        if self.index is not None:
+            self.index.commit()
+
+    def kill(self):
+        """Write what is left and compress the last file"""
+        self.running = False
+        self.wakeup.set()
+        self.join()
+        self.flush()
+        if self.file is not None:
+            self._rotate()
+        if self.index is not None:
+            self.index.close()
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except:
+                print "Server: Exception thrown while writing the transcript."
@@ -5,9 +5,10 @@ class TurnQueue(object):
 
     # queue is the initiative queue
     # order is the in-progress ordering
-    __slots__ = ("queue", "order")
+    __slots__ = ("queue", "order", "observer")
 
     def __init__(self):
+        self.observer = None
         self.queue = []
         self.order = []
 
@@ -15,10 +16,12 @@ class TurnQueue(object):
         """Wipe everything"""
         self.queue = []
         self.order = []
+        self._changed()
 
     def reset(self):
         """Reset the current ordering"""
         self.order = []
+        self._changed()
 
     def add(self, name, initiative):
         """Add a new entry to the queue"""
@@ -28,12 +31,14 @@ class TurnQueue(object):
         else:
             self.queue.append((name.lower(), initiative))
         self.queue = sorted(self.queue, key=lambda x: x[1], reverse=True)
+        self._changed()
 
     def remove(self, name):
         i = self._index(name.lower())
         if i == -1:
             raise AttributeError
         self.queue.pop(i)
+        self._changed()
 
     def promote(self, name):
         name = name.lower()
@@ -47,6 +52,7 @@ class TurnQueue(object):
         newval = self.queue[i - 1][1] + 0.001
         self.queue[i] = (name, newval)
         self.queue = sorted(self.queue, key=lambda x: x[1], reverse=True)
+        self._changed()
         return True
 
     def demote(self, name):
@@ -61,6 +67,7 @@ class TurnQueue(object):
         newval = self.queue[i + 1][1] - 0.001
         self.queue[i] = (name, newval)
         self.queue = sorted(self.queue, key=lambda x: x[1], reverse=True)
+        self._changed()
         return True
 
     def commit(self):
@@ -68,6 +75,7 @@ class TurnQueue(object):
         self.order = []
         for entry in self.queue:
             self.order.append(entry[0])
+        self._changed()
 
     def tick(self):
         """Take a turn"""
@@ -78,6 +86,7 @@ class TurnQueue(object):
 
         temp = self.order.pop(0)
         self.order.append(temp)
+        self._changed()
         return True
 
     def peek(self):
@@ -85,6 +94,13 @@ class TurnQueue(object):
             return AttributeError
         return self.order[0]
 
+    def snapshot(self):
+        return {"queue": list(self.queue), "order": list(self.order)}
+
+    def _changed(self):
+        if self.observer is not None:
+            self.observer(self)
+
     def _index(self, name):
         for i in range(len(self.queue)):
             entry = self.queue[i]